@@ -1,16 +1,199 @@
 # coding=UTF-8
 
+import threading
 
 from flask import Flask
-from flask import render_template, request, make_response
+from flask import render_template, request, make_response, stream_with_context, Response
 from flask import json
-from werkzeug.datastructures import MultiDict
 
-from forms import StockRecordForm, TradeRecordForm
-from models import StockRecord, Stock, Trade, TRADE_TYPE, StockRecordExistsError
+from events import EventBus
+from models import StockRecord, Stock, StockAnalytics, Trade, TRADE_TYPE, StockRecordExistsError, CANDLE_RESOLUTIONS
 
 
 app = Flask(__name__)
+app.config.update(
+    # Minutes trades are kept in memory, trades are never compacted when it's None
+    TRADES_HOT_PERIOD=None,
+    # File compacted trades are archived to, they are dropped when it's None
+    TRADES_ARCHIVE_PATH=None,
+    TRADES_COMPACTION_INTERVAL=60,
+    # Store trades in compact typed columns instead of the trade record objects
+    TRADES_COMPACT_STORAGE=False,
+    # VWSP periods in minutes VWSP and GBCE index are maintained for and may be requested with /stocks?windows=
+    VWSP_WINDOWS=[1, 5, 15, 60],
+    # Directory of the stocks and trades journal the market is recovered from on start, nothing is kept when it's None
+    JOURNAL_PATH=None,
+    # Seconds between writes of the journal, trades made during the last interval may be lost on a crash
+    JOURNAL_SYNC_INTERVAL=0.05,
+    # Seconds between snapshots of the market, they bound the journal replayed on start
+    JOURNAL_SNAPSHOT_INTERVAL=3600,
+    # Addresses of the market shards shared by all web workers, the market is kept in process when it's empty
+    MARKET_SHARDS=[],
+    MARKET_AUTHKEY='sssm',
+    # Validate requests with the schemas compiled from the forms instead of constructing WTForms forms
+    FAST_VALIDATION=True,
+    # Time the model operations and requests and expose them with the market state at /metrics, instrumentation
+    # is installed by create_app and not at all when it's False
+    METRICS_ENABLED=True,
+    # Recover the journal in the background when the application is created by create_app, the market state
+    # recovered so far is served meanwhile and requests changing it are refused
+    MARKET_BACKGROUND_RECOVERY=True
+)
+app.config.from_envvar('SSSM_SETTINGS', silent=True)
+
+events = EventBus()
+
+
+def publish_trades(trades):
+    """
+    Publish made trades, updated metrics of the traded stocks and GBCE index, metrics are calculated once
+    whatever the number of subscribers is
+
+    :param trades: List of trade records
+    :return: Nothing
+    """
+    if not len(events):
+        return
+    symbols = []
+    for trade in trades:
+        events.publish('trade', trade.json())
+        if trade.symbol not in symbols:
+            symbols.append(trade.symbol)
+    publish_stocks(symbols)
+
+
+def publish_stocks(symbols):
+    """
+    Publish metrics of the stocks and GBCE index
+
+    :param symbols: List of stock symbols
+    :return: Nothing
+    """
+    for symbol in symbols:
+        stock = Stock.get_instance().get_stock_by_symbol(symbol)
+        if stock is not None:
+            events.publish('stock', stock.json())
+    events.publish('index', {'gbce_index': Trade.get_instance().gbce_index})
+
+
+Trade.add_listener(publish_trades)
+
+
+class ExpiryPublisher(threading.Thread):
+    """
+    Background thread publishing the stocks which trades have left VWSP periods, so the subscribers see VWSP and
+    GBCE index change without new trades. It wakes up when the next trade expires or every interval to notice
+    the new trades.
+
+    :param trade: Trade container instance
+    :param interval: Maximum seconds between the checks
+    """
+
+    def __init__(self, trade, interval=1.0):
+        super(ExpiryPublisher, self).__init__(name='expiry-publisher')
+        self.daemon = True
+        self.trade = trade
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        while True:
+            symbols, expires_at = self.trade.pop_expired()
+            if symbols and len(events):
+                publish_stocks(symbols)
+            timeout = self.interval
+            if expires_at is not None:
+                timeout = min(timeout, max(expires_at - self.trade.clock.now(), 0) / 1e9)
+            if self._stopped.wait(timeout):
+                return
+
+    def stop(self):
+        self._stopped.set()
+
+
+def validate(schema, payload, **context):
+    """
+    Validate request payload with the compiled form schema or with the WTForms form if fast validation is off
+
+    :param schema: Name of the form schema in forms module, the forms and WTForms are imported by the first
+                   validation rather than on start
+    :param payload: Request json
+    :param context: Attributes of the form the inline validators may use
+    :return: Tuple of the dictionary of fields data and dictionary of errors per field
+    """
+    import forms
+    schema = getattr(forms, schema)
+    if app.config['FAST_VALIDATION']:
+        return schema.validate(payload, **context)
+    return schema.validate_with_form(payload, **context)
+
+
+# Serialized stocks per symbol and requested windows together with the versions of the stock and its trades
+# they were serialized at
+_serialized_stocks = {}
+# Number of stocks taken from the serialized stocks cache and serialized again
+_serialization_stats = {'hits': 0, 'misses': 0}
+
+
+def serialize_stocks(stocks, windows=()):
+    """
+    Serialize stocks to json, only stocks which data or trades have changed since they were serialized last time
+    are serialized again and their metrics are calculated at once
+
+    :param stocks: List of stock records
+    :param windows: Tuple of VWSP periods in minutes VWSP is also serialized for
+    :return: List of serialized stocks
+    """
+    versions = zip([st.version for st in stocks], Trade.get_instance().get_versions([st.symbol for st in stocks]))
+    stale = [position for position, st in enumerate(stocks)
+             if _serialized_stocks.get((st.symbol, windows), (None, None))[0] != versions[position]]
+    _serialization_stats['hits'] += len(stocks) - len(stale)
+    _serialization_stats['misses'] += len(stale)
+    if stale:
+        analytics = StockAnalytics([stocks[position] for position in stale], windows)
+        for position, obj in zip(stale, analytics.json()):
+            _serialized_stocks[(stocks[position].symbol, windows)] = (versions[position], json.dumps(obj))
+    return [_serialized_stocks[(st.symbol, windows)][1] for st in stocks]
+
+
+def requested_windows():
+    """
+    Parse comma separated VWSP periods of the 'windows' query parameter
+
+    :return: Tuple of the sorted unique periods in minutes and list of errors
+    """
+    value = request.args.get('windows')
+    if not value:
+        return (), []
+    maintained = Trade.get_instance().windows
+    try:
+        windows = tuple(sorted(set(int(period) for period in value.split(','))))
+    except ValueError:
+        windows = None
+    if windows is None or not set(windows) <= set(maintained):
+        return (), ['Windows should be comma separated periods of: %s.'
+                    % ', '.join(str(period) for period in maintained)]
+    return windows, []
+
+
+def windows_error(errors):
+    response = make_response(json.dumps({'status': 'error',
+                                         'errors': {'windows': errors}}), 400)
+    response.headers['Content-Type'] = 'application/json'
+    return response
+
+
+def conditional_response(body):
+    """
+    Make json response tagged with the body hash, it has status code 304 and no body when the client has it already
+
+    :param body: Serialized response
+    :return: Response
+    """
+    response = make_response(body)
+    response.headers['Content-Type'] = 'application/json'
+    response.add_etag()
+    return response.make_conditional(request)
 
 
 @app.route('/')
@@ -21,15 +204,26 @@ def hello_world():
 @app.route('/stocks', methods=['GET'])
 def get_stocks():
     """
-    Return list of successful trades
+    Return list of registered stocks and GBCE All Share Index
+
+    :return: Status code 200 and the list of stocks
+             Status code 304 when the client has the same list already
+             Status code 400 and list of errors if requested windows are not maintained
 
-    :return: Status code 200 and the list of trades
+    Query string may contain following parameters:
+    :param windows: Comma separated VWSP periods in minutes, VWSP of every stock ('vwsp_windows') and GBCE index
+                    ('gbce_index_windows') are returned for them too
     """
-    response = make_response(json.dumps({'status': 'ok',
-                                         'stocks': [st.json() for st in Stock.get_instance()],
-                                         'gbce_index': Trade.get_instance().gbce_index}))
-    response.headers['Content-Type'] = 'application/json'
-    return response
+    windows, errors = requested_windows()
+    if errors:
+        return windows_error(errors)
+    stocks = ', '.join(serialize_stocks(list(Stock.get_instance()), windows))
+    if windows:
+        indexes = dict((str(period), Trade.get_instance().get_gbce_index(period)) for period in windows)
+        return conditional_response('{"gbce_index": %s, "gbce_index_windows": %s, "status": "ok", "stocks": [%s]}'
+                                    % (json.dumps(Trade.get_instance().gbce_index), json.dumps(indexes), stocks))
+    return conditional_response('{"gbce_index": %s, "status": "ok", "stocks": [%s]}'
+                                % (json.dumps(Trade.get_instance().gbce_index), stocks))
 
 
 @app.route('/stocks', methods=['POST'])
@@ -49,18 +243,19 @@ def create_stock():
     :param fixed_dividend: Fixed dividend
     :param par_value: Par-value
     """
-    form = StockRecordForm(MultiDict(mapping=request.get_json()))
-    if form.validate():
+    data, errors = validate('STOCK_RECORD_SCHEMA', request.get_json())
+    if not errors:
         try:
-            stock = StockRecord(**form.data)
+            stock = StockRecord(**data)
             Stock.get_instance().add(stock)
         except StockRecordExistsError as e:
             return make_response(json.dumps({'status': 'error',
                                              'errors': {'symbol': [str(e)]}}), 400)
+        events.publish('stock', stock.json())
         return make_response(json.dumps({'status': 'ok',
                                          'stock': stock.json()}), 201)
     response = make_response(json.dumps({'status': 'error',
-                                         'errors': form.errors}), 400)
+                                         'errors': errors}), 400)
     response.headers['Content-Type'] = 'application/json'
     return response
 
@@ -72,7 +267,41 @@ def get_stock(stock_symbol):
 
     :param stock_symbol: Stock symbol
     :return: Status code 200 and stock information
+             Status code 304 when the client has the same information already
+             Status code 400 and list of errors if requested windows are not maintained
+             Status code 404 in case stock in not registered
+
+    Query string may contain following parameters:
+    :param windows: Comma separated VWSP periods in minutes, VWSP is returned for them too ('vwsp_windows')
+    """
+    stock = Stock.get_instance().get_stock_by_symbol(stock_symbol)
+    if stock is None:
+        response = make_response(json.dumps({'status': 'error',
+                                             'text': 'Stock \'%s\' is not found' % stock_symbol}), 404)
+        response.headers['Content-Type'] = 'application/json'
+        return response
+    windows, errors = requested_windows()
+    if errors:
+        return windows_error(errors)
+    return conditional_response('{"status": "ok", "stock": %s}' % serialize_stocks([stock], windows)[0])
+
+
+@app.route('/stocks/<stock_symbol>/candles', methods=['GET'])
+def get_candles(stock_symbol):
+    """
+    Return OHLCV candles of the stock
+
+    :param stock_symbol: Stock symbol
+    :return: Status code 200 and the list of candles ordered by time, each candle has 'timestamp' (its start),
+             'open', 'high', 'low', 'close', 'volume' and 'vwap' fields
+             Status code 400 and list of errors if resolution is unknown
              Status code 404 in case stock in not registered
+
+    Query string may contain following parameters:
+    :param resolution: Candle width: 1s, 1m (default), 5m or 1h
+    :param since: Return only candles ending after this timestamp
+    :param until: Return only candles starting before this timestamp
+    :param limit: Maximum number of the latest candles to return
     """
     stock = Stock.get_instance().get_stock_by_symbol(stock_symbol)
     if stock is None:
@@ -80,8 +309,23 @@ def get_stock(stock_symbol):
                                              'text': 'Stock \'%s\' is not found' % stock_symbol}), 404)
         response.headers['Content-Type'] = 'application/json'
         return response
+    resolution = request.args.get('resolution', '1m')
+    if resolution not in CANDLE_RESOLUTIONS:
+        response = make_response(json.dumps({'status': 'error',
+                                             'errors': {'resolution': ['Resolution should be one of: %s.'
+                                                                       % ', '.join(sorted(CANDLE_RESOLUTIONS))]}}),
+                                 400)
+        response.headers['Content-Type'] = 'application/json'
+        return response
+    limit = request.args.get('limit', None, type=int)
+    candles = Trade.get_instance().get_candles(stock_symbol, resolution,
+                                               since=request.args.get('since', None, type=int),
+                                               until=request.args.get('until', None, type=int),
+                                               limit=None if limit is None else max(limit, 0))
     response = make_response(json.dumps({'status': 'ok',
-                                         'stock': stock.json()}))
+                                         'symbol': stock_symbol,
+                                         'resolution': resolution,
+                                         'candles': candles}))
     response.headers['Content-Type'] = 'application/json'
     return response
 
@@ -109,16 +353,18 @@ def update_stock(stock_symbol):
         return make_response(json.dumps({'status': 'error',
                                          'text': 'Stock \'%s\' is not found' % stock_symbol}), 404)
 
-    form = StockRecordForm(MultiDict(mapping=request.get_json()))
-    if form.validate():
-        form.populate_obj(stock)
+    data, errors = validate('STOCK_RECORD_SCHEMA', request.get_json())
+    if not errors:
+        for name, value in data.items():
+            setattr(stock, name, value)
         Stock.get_instance().update(stock)
+        events.publish('stock', stock.json())
         response = make_response(json.dumps({'status': 'ok',
                                              'stock': stock.json()}))
         response.headers['Content-Type'] = 'application/json'
         return response
     response = make_response(json.dumps({'status': 'error',
-                                         'errors': form.errors}), 400)
+                                         'errors': errors}), 400)
     response.headers['Content-Type'] = 'application/json'
     return response
 
@@ -126,16 +372,57 @@ def update_stock(stock_symbol):
 @app.route('/trades', methods=['GET'])
 def get_trades():
     """
-    Return list of successful trades
-
-    :return: Status code 200 and the list of trades
+    Return list of successful trades including archived ones
+
+    :return: Status code 200 and the list of trades with the cursor of the next page (null for the last page),
+             or the trades as newline delimited json stream when 'application/x-ndjson' is accepted or
+             'format=ndjson' is requested
+
+    Query string may contain following parameters:
+    :param cursor: Position in the trades history to start from
+    :param limit: Maximum number of trades to return
+    :param symbol: Return only trades of the stock symbol
+    :param since: Return only trades made at or after this timestamp
+    :param until: Return only trades made before this timestamp
     """
+    cursor = max(request.args.get('cursor', 0, type=int), 0)
+    limit = request.args.get('limit', None, type=int)
+    if limit is not None:
+        limit = max(limit, 0)
+    filters = {
+        'symbol': request.args.get('symbol'),
+        'since': request.args.get('since', None, type=int),
+        'until': request.args.get('until', None, type=int)
+    }
+
+    if request.args.get('format') == 'ndjson' or \
+            request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson']) == 'application/x-ndjson':
+        history = Trade.get_instance().history(cursor=cursor, limit=limit, **filters)
+        return Response(stream_with_context(_ndjson(history)), mimetype='application/x-ndjson')
+
+    history = Trade.get_instance().history(cursor=cursor, limit=None if limit is None else limit + 1, **filters)
+    trades = list(history)
+    next_cursor = None
+    if limit is not None and len(trades) > limit:
+        next_cursor = trades.pop()[0]
     response = make_response(json.dumps({'status': 'ok',
-                                         'trades': [tr.json() for tr in Trade.get_instance()]}))
+                                         'trades': [tr.json() for _, tr in trades],
+                                         'next_cursor': next_cursor}))
     response.headers['Content-Type'] = 'application/json'
     return response
 
 
+def _ndjson(history):
+    lines = []
+    for _, trade in history:
+        lines.append(json.dumps(trade.json()))
+        if len(lines) == Trade.HISTORY_CHUNK:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+
 @app.route('/trades', methods=['POST'])
 def trade_shares():
     """
@@ -158,22 +445,334 @@ def trade_shares():
         return make_response(json.dumps({'status': 'error',
                                          'text': 'Stock \'%s\' is not found' % stock_symbol}), 404)
 
-    form = TradeRecordForm(MultiDict(mapping=data))
-    if form.validate():
-        action = getattr(Trade.get_instance(), form.data['indicator'])
-        trade = action(symbol=form.data['symbol'],
-                       price=form.data['price'],
-                       quantity=form.data['quantity'])
+    data, errors = validate('TRADE_RECORD_SCHEMA', data, stock=stock)
+    if not errors:
+        action = getattr(Trade.get_instance(), data['indicator'])
+        trade = action(symbol=data['symbol'],
+                       price=data['price'],
+                       quantity=data['quantity'])
         response = make_response(json.dumps({'status': 'ok',
                                              'trade': trade.json(),
                                              'gbce_index': Trade.get_instance().gbce_index}))
         response.headers['Content-Type'] = 'application/json'
         return response
     response = make_response(json.dumps({'status': 'error',
-                                         'errors': form.errors}), 400)
+                                         'errors': errors}), 400)
+    response.headers['Content-Type'] = 'application/json'
+    return response
+
+
+def matching_engine():
+    """
+    Matching engine of the orders, the orders module is imported by the first orders request rather than on start
+
+    :return: MatchingEngine instance
+    """
+    from orders import MatchingEngine
+    return MatchingEngine.get_instance()
+
+
+@app.route('/orders', methods=['POST'])
+def place_order():
+    """
+    Place limit order, it is matched with the resting orders of the stock book at their prices and its unfilled
+    quantity rests in the book
+
+    :return: Status code 201, the order and the trades it has made
+             Status code 400 and list of errors if provided data is incorrect
+             Status code 404 when place order on non-registered stock
+
+    Request body should contain following fields:
+    :param symbol: Stock symbol
+    :param price: Limit price
+    :param quantity: Shares quantity
+    :param indicator: Buy or sell
+    """
+    data = request.get_json()
+    stock_symbol = data['symbol']
+    stock = Stock.get_instance().get_stock_by_symbol(stock_symbol)
+    if stock is None:
+        return make_response(json.dumps({'status': 'error',
+                                         'text': 'Stock \'%s\' is not found' % stock_symbol}), 404)
+
+    data, errors = validate('TRADE_RECORD_SCHEMA', data, stock=stock)
+    if not errors:
+        order, trades = matching_engine().submit(data['symbol'], data['indicator'], data['price'],
+                                                 data['quantity'])
+        response = make_response(json.dumps({'status': 'ok',
+                                             'order': order.json(),
+                                             'trades': [tr.json() for tr in trades],
+                                             'gbce_index': Trade.get_instance().gbce_index}), 201)
+        response.headers['Content-Type'] = 'application/json'
+        return response
+    response = make_response(json.dumps({'status': 'error',
+                                         'errors': errors}), 400)
+    response.headers['Content-Type'] = 'application/json'
+    return response
+
+
+def order_not_found(stock_symbol, order_id):
+    response = make_response(json.dumps({'status': 'error',
+                                         'text': 'Order %d of \'%s\' is not open' % (order_id, stock_symbol)}), 404)
+    response.headers['Content-Type'] = 'application/json'
+    return response
+
+
+@app.route('/stocks/<stock_symbol>/orders/<int:order_id>', methods=['GET'])
+def get_order(stock_symbol, order_id):
+    """
+    Get open order
+
+    :param stock_symbol: Stock symbol
+    :param order_id: Order id
+    :return: Status code 200 and the order
+             Status code 404 when there is no such open order
+    """
+    order = matching_engine().get_order(stock_symbol, order_id)
+    if order is None:
+        return order_not_found(stock_symbol, order_id)
+    response = make_response(json.dumps({'status': 'ok',
+                                         'order': order.json()}))
+    response.headers['Content-Type'] = 'application/json'
+    return response
+
+
+@app.route('/stocks/<stock_symbol>/orders/<int:order_id>', methods=['DELETE'])
+def cancel_order(stock_symbol, order_id):
+    """
+    Cancel open order
+
+    :param stock_symbol: Stock symbol
+    :param order_id: Order id
+    :return: Status code 200 and the cancelled order
+             Status code 404 when there is no such open order
+    """
+    order = matching_engine().cancel(stock_symbol, order_id)
+    if order is None:
+        return order_not_found(stock_symbol, order_id)
+    response = make_response(json.dumps({'status': 'ok',
+                                         'order': order.json()}))
+    response.headers['Content-Type'] = 'application/json'
+    return response
+
+
+@app.route('/stocks/<stock_symbol>/book', methods=['GET'])
+def get_book(stock_symbol):
+    """
+    Return the best price levels of the stock order book
+
+    :param stock_symbol: Stock symbol
+    :return: Status code 200 and 'bids' and 'asks' lists of price levels with 'price', 'quantity' and 'orders'
+             (number of orders) fields, the best prices first
+
+    Query string may contain following parameters:
+    :param levels: Maximum number of levels of each side, 10 by default
+    """
+    depth = matching_engine().get_depth(stock_symbol, max(request.args.get('levels', 10, type=int), 0))
+    response = make_response(json.dumps(dict(depth, status='ok')))
+    response.headers['Content-Type'] = 'application/json'
+    return response
+
+
+@app.route('/events', methods=['GET'])
+def get_events():
+    """
+    Stream market events as Server-Sent Events
+
+    :return: Status code 200 and the stream of events:
+             'trade' with the trade made, 'stock' with the stock created, updated or traded,
+             'index' with the new GBCE index value
+    """
+    response = Response(events.stream(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@app.route('/trades/bulk', methods=['POST'])
+def bulk_trade_shares():
+    """
+    Perform many trade actions at once
+
+    :return: Status code 200, successful trades and errors of the failed ones
+             Status code 400 and errors if none of trades was successful
+
+    Request body should be a list of trades or contain it in the 'trades' field, each trade contains the same
+    fields as for a single trade action. Errors are returned per position of the trade in the list.
+    """
+    data = request.get_json()
+    if isinstance(data, dict):
+        data = data.get('trades')
+    if not isinstance(data, list):
+        return make_response(json.dumps({'status': 'error',
+                                         'errors': {'trades': ['List of trades is expected.']}}), 400)
+
+    trades, errors = Trade.get_instance().bulk_record(data)
+    response = make_response(json.dumps({'status': 'error' if errors else 'ok',
+                                         'trades': [tr.json() for tr in trades],
+                                         'errors': dict((str(position), e) for position, e in errors.items()),
+                                         'gbce_index': Trade.get_instance().gbce_index}),
+                             400 if errors and not trades else 200)
+    response.headers['Content-Type'] = 'application/json'
+    return response
+
+
+def get_metrics():
+    """
+    Return metrics in the Prometheus text format, the route is registered only when metrics are enabled
+
+    :return: Status code 200 and the metrics
+    """
+    return Response(app.extensions['metrics'].render(), mimetype='text/plain; version=0.0.4')
+
+
+def serialization_collector():
+    """
+    Collect the serialized stocks cache metrics
+
+    :return: List of metrics
+    """
+    import metrics
+    lookups = metrics.Counter('sssm_stock_cache_lookups_total', 'Number of stocks looked up in the serialized '
+                              'stocks cache', ('result',))
+    lookups.inc(_serialization_stats['hits'], ('hit',))
+    lookups.inc(_serialization_stats['misses'], ('miss',))
+    return [lookups]
+
+
+def install_metrics():
+    """
+    Time the model operations and the requests and register /metrics route, the registry is kept in the 'metrics'
+    application extension
+
+    :return: Metrics registry
+    """
+    global serialize_stocks
+    import metrics
+    registry = metrics.Registry()
+    operations = metrics.instrument_models(registry)
+    serialize_stocks = metrics.timed(operations, 'serialize_stocks', serialize_stocks)
+    metrics.instrument_app(app, registry)
+    registry.add_collector(metrics.market_collector)
+    registry.add_collector(serialization_collector)
+    app.add_url_rule('/metrics', 'get_metrics', get_metrics)
+    app.extensions['metrics'] = registry
+    return registry
+
+
+# Set when the market state is recovered, requests changing the market are refused until then
+market_ready = threading.Event()
+market_ready.set()
+# Guards the setup of the application parts
+_setup_lock = threading.RLock()
+
+
+@app.before_request
+def refuse_changes_while_recovering():
+    """
+    Refuse requests changing the market while its state is recovered in the background: they could conflict with
+    the replayed records and wouldn't be journaled. Reads are served with the state recovered so far.
+
+    :return: Status code 503 for the changing requests during the recovery, None otherwise
+    """
+    if market_ready.is_set() or request.method in ('GET', 'HEAD', 'OPTIONS'):
+        return None
+    response = make_response(json.dumps({'status': 'error',
+                                         'text': 'Market state is being recovered'}), 503)
     response.headers['Content-Type'] = 'application/json'
+    response.headers['Retry-After'] = '1'
     return response
 
 
+@app.after_request
+def mark_recovering(response):
+    if not market_ready.is_set():
+        response.headers['X-Market-Recovering'] = 'true'
+    return response
+
+
+def recover_market():
+    """
+    Apply retention of the trades and recover the market from the journal, the market is marked ready afterwards.
+    It stays not ready when the recovery fails, so the trades are never made without the journal. Started journal
+    writer is kept in the 'journal_writer' application extension.
+
+    :return: Nothing
+    """
+    if app.config['TRADES_HOT_PERIOD'] is not None:
+        from retention import RetentionPolicy
+        RetentionPolicy(hot_period=app.config['TRADES_HOT_PERIOD'],
+                        archive_path=app.config['TRADES_ARCHIVE_PATH'],
+                        interval=app.config['TRADES_COMPACTION_INTERVAL']).apply(Trade.get_instance())
+    if app.config['JOURNAL_PATH'] is not None:
+        from journal import Journal
+        journal = Journal(app.config['JOURNAL_PATH'],
+                          sync_interval=app.config['JOURNAL_SYNC_INTERVAL'],
+                          snapshot_interval=app.config['JOURNAL_SNAPSHOT_INTERVAL'])
+        app.extensions['journal_writer'] = journal.apply(Stock.get_instance(), Trade.get_instance())
+    market_ready.set()
+
+
+def setup_market(background=False):
+    """
+    Configure the market of the server process: the VWSP windows, retention of the trades, the journal and
+    publishing of the trades expiry. Market shards keep, compact and journal the trades themselves, so nothing is
+    configured with them.
+
+    The market is set up once: it's not touched again while the Trade instance set up is in use, and Trade instance
+    which has recorded trades already is kept rather than reinitialized with the settings.
+
+    :param background: Recover the market in the background thread, the server may answer meanwhile
+    :return: Recovery thread when the market is recovered in the background, None otherwise
+    """
+    with _setup_lock:
+        if app.config['MARKET_SHARDS']:
+            return None
+        trade = Trade._instance
+        if trade is not None and app.extensions.get('market') is trade:
+            recovery = app.extensions.get('market_recovery')
+            return recovery if recovery is not None and recovery.is_alive() else None
+        if trade is None or next(iter(trade), None) is None:
+            trade = Trade(compact_storage=app.config['TRADES_COMPACT_STORAGE'], windows=app.config['VWSP_WINDOWS'])
+        app.extensions['market'] = trade
+        publisher = app.extensions.get('expiry_publisher')
+        if publisher is not None:
+            publisher.stop()
+        publisher = app.extensions['expiry_publisher'] = ExpiryPublisher(trade)
+        publisher.start()
+        app.extensions['market_recovery'] = None
+        if not background:
+            recover_market()
+            return None
+        market_ready.clear()
+        thread = app.extensions['market_recovery'] = threading.Thread(target=recover_market, name='market-recovery')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+def create_app(background=None):
+    """
+    Application factory, it's the entry point of the servers: it connects the market shards, installs the metrics
+    and sets up the market. The server starts answering as soon as Flask and the models are imported, rarely used
+    components are imported by the first requests using them and the journal is recovered in the background.
+    Every part is configured once, so the factory may be called again.
+
+    :param background: Recover the market in the background, MARKET_BACKGROUND_RECOVERY setting when it's None
+    :return: Flask application
+    """
+    with _setup_lock:
+        if app.config['MARKET_SHARDS'] and 'market_shards' not in app.extensions:
+            import backends
+            backends.connect(app.config['MARKET_SHARDS'], app.config['MARKET_AUTHKEY'])
+            app.extensions['market_shards'] = app.config['MARKET_SHARDS']
+        if app.config['METRICS_ENABLED'] and 'metrics' not in app.extensions:
+            install_metrics()
+        if background is None:
+            background = app.config['MARKET_BACKGROUND_RECOVERY']
+        setup_market(background=background)
+    return app
+
+
 if __name__ == '__main__':
-    app.run()
+    create_app().run()
@@ -0,0 +1,624 @@
+# coding=UTF-8
+
+import argparse
+import asynchat
+import asyncore
+import errno
+import logging
+import os
+import select
+import socket
+import sys
+import threading
+import time
+import urllib
+from collections import deque
+from cStringIO import StringIO
+from email.utils import formatdate
+from Queue import Queue
+
+
+__author__ = 'Konstantin Kolesnikov'
+
+
+logger = logging.getLogger(__name__)
+
+# Maximum size of the request line and headers
+MAX_HEADER_SIZE = 65536
+STREAM_HEADERS = ('HTTP/1.1 200 OK\r\n'
+                  'Content-Type: text/event-stream; charset=utf-8\r\n'
+                  'Cache-Control: no-cache\r\n'
+                  'X-Accel-Buffering: no\r\n'
+                  'Connection: close\r\n\r\n')
+ERROR_RESPONSE = 'HTTP/1.1 %s\r\nContent-Type: text/plain\r\nContent-Length: %d\r\nConnection: close\r\n\r\n%s'
+# Maximum number of the chunks of the streamed response the worker may produce ahead of the client
+STREAM_WINDOW = 16
+
+
+class ChannelMap(dict):
+    """
+    Dictionary of the event loop dispatchers per file descriptor, which records the descriptors added, removed
+    or marked changed since the loop has updated their polling
+
+    :param changed: Set of the changed file descriptors
+    """
+
+    def __init__(self):
+        super(ChannelMap, self).__init__()
+        self.changed = set()
+
+    def __setitem__(self, fd, dispatcher):
+        super(ChannelMap, self).__setitem__(fd, dispatcher)
+        self.changed.add(fd)
+
+    def __delitem__(self, fd):
+        super(ChannelMap, self).__delitem__(fd)
+        self.changed.add(fd)
+
+
+class EpollLoop(object):
+    """
+    Class represents event loop polling with epoll. asyncore asks every dispatcher whether it's readable and
+    writable on every pass, so a pass takes time proportional to the number of connections even when they are
+    idle. The loop keeps the registrations instead and asks only the dispatchers which had events or were
+    marked changed, so idle connections cost nothing.
+
+    :param map: ChannelMap of the dispatchers
+    :param _masks: Dictionary of the registered events masks per file descriptor
+    """
+
+    def __init__(self, map):
+        self.map = map
+        self._epoll = select.epoll()
+        self._masks = {}
+
+    def _update(self, fd):
+        dispatcher = self.map.get(fd)
+        if dispatcher is None:
+            if self._masks.pop(fd, None) is not None:
+                try:
+                    self._epoll.unregister(fd)
+                except (IOError, OSError):
+                    # Closed descriptors are removed from epoll by the kernel
+                    pass
+            return
+        mask = 0
+        if dispatcher.readable():
+            mask |= select.EPOLLIN | select.EPOLLPRI
+        if dispatcher.writable() and not dispatcher.accepting:
+            mask |= select.EPOLLOUT
+        previous = self._masks.get(fd)
+        if previous == mask:
+            return
+        self._masks[fd] = mask
+        try:
+            if previous is None:
+                self._epoll.register(fd, mask)
+            else:
+                self._epoll.modify(fd, mask)
+        except (IOError, OSError) as e:
+            # Descriptor was closed and reused by another dispatcher meanwhile
+            if e.errno == errno.EEXIST:
+                self._epoll.modify(fd, mask)
+            elif e.errno == errno.ENOENT:
+                self._epoll.register(fd, mask)
+            else:
+                raise
+
+    def poll(self, timeout):
+        """
+        Run single pass of the loop
+
+        :param timeout: Seconds to wait for the events
+        :return: Nothing
+        """
+        changed = list(self.map.changed)
+        self.map.changed.clear()
+        for fd in changed:
+            self._update(fd)
+        try:
+            events = self._epoll.poll(timeout)
+        except IOError as e:
+            if e.errno != errno.EINTR:
+                raise
+            events = []
+        for fd, flags in events:
+            dispatcher = self.map.get(fd)
+            if dispatcher is not None:
+                # Event flags of epoll are the same as of poll
+                asyncore.readwrite(dispatcher, flags)
+                self.map.changed.add(fd)
+
+    def close(self):
+        self._epoll.close()
+
+
+class Trigger(asyncore.file_dispatcher):
+    """
+    Class represents pipe waking up the event loop to run callbacks passed from the other threads
+
+    :param _callbacks: Queue of (callback, args) tuples to run in the loop
+    """
+
+    def __init__(self, map):
+        self._reader, self._writer = os.pipe()
+        asyncore.file_dispatcher.__init__(self, self._reader, map)
+        self._callbacks = deque()
+        self._lock = threading.Lock()
+
+    def call(self, callback, *args):
+        """
+        Run callback in the event loop thread, it may be called from any thread
+
+        :param callback: Callable
+        :param args: Callable arguments
+        :return: Nothing
+        """
+        with self._lock:
+            # The loop is woken up once for all the callbacks queued before it runs them
+            wake = not self._callbacks
+            self._callbacks.append((callback, args))
+        if wake:
+            os.write(self._writer, 'x')
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(4096)
+        while True:
+            with self._lock:
+                if not self._callbacks:
+                    return
+                callback, args = self._callbacks.popleft()
+            try:
+                callback(*args)
+            except Exception:
+                logger.exception('Event loop callback failed')
+
+    def close(self):
+        asyncore.file_dispatcher.close(self)
+        os.close(self._writer)
+
+
+class WorkerPool(object):
+    """
+    Class represents threads running the blocking functions, their results are passed back to the event loop
+
+    :param size: Number of the threads
+    :param trigger: Trigger of the event loop the callbacks are run in
+    """
+
+    def __init__(self, size, trigger):
+        self._tasks = Queue()
+        self._trigger = trigger
+        self._threads = [threading.Thread(target=self._run) for _ in range(size)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, function, callback):
+        """
+        Run function in a worker thread and then its result callback in the event loop
+
+        :param function: Callable without arguments, it should handle its exceptions
+        :param callback: Callable of the function result
+        :return: Nothing
+        """
+        self._tasks.put((function, callback))
+
+    def _run(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                return
+            function, callback = task
+            self._trigger.call(callback, function())
+
+    def stop(self):
+        for _ in self._threads:
+            self._tasks.put(None)
+
+
+class HTTPChannel(asynchat.async_chat):
+    """
+    Class represents HTTP/1.1 client connection. Requests of the connection are handled one after another,
+    so pipelined requests are answered in order.
+
+    :param server: AsyncServer the connection was accepted by
+    :param _request: Parsed request line and headers waiting for the body
+    :param _pending: Queue of the requests received while the previous one is handled
+    """
+
+    ac_in_buffer_size = 65536
+    ac_out_buffer_size = 65536
+
+    def __init__(self, server, sock, address):
+        asynchat.async_chat.__init__(self, sock, server.map)
+        self._changed = server.map.changed
+        self.server = server
+        self.address = address
+        self.set_terminator('\r\n\r\n')
+        self._buffer = []
+        self._size = 0
+        self._request = None
+        self._pending = deque()
+        self._busy = False
+        self.streaming = False
+        # Semaphore of the streamed response window and the number of its chunks waiting for the client
+        self._window = None
+        self._unsent = 0
+
+    def collect_incoming_data(self, data):
+        self._buffer.append(data)
+        self._size += len(data)
+        if self._request is None and self._size > MAX_HEADER_SIZE:
+            self._buffer = []
+            self.error('431 Request Header Fields Too Large')
+
+    def found_terminator(self):
+        data = ''.join(self._buffer)
+        self._buffer = []
+        self._size = 0
+        if self._request is None:
+            try:
+                self._request = self._parse(data)
+            except ValueError:
+                return self.error('400 Bad Request')
+            headers = self._request[4]
+            if 'transfer-encoding' in headers:
+                return self.error('411 Length Required')
+            length = int(headers.get('content-length') or 0)
+            if length:
+                if headers.get('expect', '').lower() == '100-continue':
+                    self.push('HTTP/1.1 100 Continue\r\n\r\n')
+                self.set_terminator(length)
+                return
+            data = ''
+        self.set_terminator('\r\n\r\n')
+        request, self._request = self._request + (data,), None
+        self._pending.append(request)
+        self._next()
+
+    @staticmethod
+    def _parse(data):
+        lines = data.lstrip('\r\n').split('\r\n')
+        method, target, version = lines[0].split()
+        if not version.startswith('HTTP/1.'):
+            raise ValueError(version)
+        headers = {}
+        for line in lines[1:]:
+            name, value = line.split(':', 1)
+            name = name.strip().lower()
+            headers[name] = headers[name] + ',' + value.strip() if name in headers else value.strip()
+        int(headers.get('content-length') or 0)
+        path, _, query = target.partition('?')
+        return method, path, query, version, headers
+
+    def _next(self):
+        if self._busy or self.streaming or not self._pending:
+            return
+        method, path, query, version, headers, body = self._pending.popleft()
+        if method == 'GET' and path == self.server.stream_path:
+            self.streaming = True
+            self.server.stream(self)
+            return
+        self._busy = True
+        environ = self.server.environ(self, method, path, query, version, headers, body)
+        close = headers.get('connection', '').lower() == 'close' if version == 'HTTP/1.1' else \
+            headers.get('connection', '').lower() != 'keep-alive'
+        self.server.pool.submit(lambda: self.server.call_app(environ, close, self), self._respond)
+
+    def _respond(self, result):
+        data, close = result
+        self._window = None
+        self._unsent = 0
+        if not self.connected:
+            return
+        self.push(data)
+        self._busy = False
+        if close:
+            self.close_when_done()
+        else:
+            self._next()
+
+    def push(self, data):
+        # Data left after the immediate send makes the connection writable
+        asynchat.async_chat.push(self, data)
+        self._changed.add(self._fileno)
+
+    def push_stream(self, window, data):
+        """
+        Push chunk of the response streamed by the worker, the window slot of the chunk is released when the
+        output buffered for the client is short again
+
+        :param window: Semaphore of the response window
+        :param data: Chunk
+        :return: Nothing
+        """
+        self._window = window
+        self._unsent += 1
+        if self.connected:
+            self.push(data)
+        self._release()
+
+    def _release(self):
+        if self._window is None:
+            return
+        if not self.connected:
+            # Worker stops producing the chunks when it sees the connection closed
+            for _ in range(STREAM_WINDOW):
+                self._window.release()
+            return
+        while self._unsent and len(self.producer_fifo) < STREAM_WINDOW:
+            self._unsent -= 1
+            self._window.release()
+
+    def initiate_send(self):
+        asynchat.async_chat.initiate_send(self)
+        if self._unsent:
+            self._release()
+
+    def close_when_done(self):
+        asynchat.async_chat.close_when_done(self)
+        self._changed.add(self._fileno)
+
+    def error(self, status):
+        body = status + '\n'
+        self.push(ERROR_RESPONSE % (status, len(body), body))
+        self.close_when_done()
+
+    def handle_close(self):
+        self.server.forget(self)
+        self.close()
+
+    def close(self):
+        asynchat.async_chat.close(self)
+        self._release()
+
+
+class AsyncServer(asyncore.dispatcher):
+    """
+    Class represents HTTP server of WSGI application on the event loop. Connections are accepted, read and written
+    by the loop thread without blocking, requests are run by the worker threads, so idle keep-alive connections
+    and slow clients don't hold threads. Server-Sent Events of the event bus are streamed by the loop itself,
+    every message is broadcast to all the open streams and a stream doesn't cost a thread.
+
+    :param app: WSGI application
+    :param host: Host to listen at
+    :param port: Port to listen at, 0 picks a free one
+    :param workers: Number of the worker threads running the application
+    :param events: EventBus streamed at stream_path, None disables streaming
+    :param stream_path: Path of the events stream
+    :param keep_alive: Seconds of inactivity after which comment is sent to the streams
+    :param backlog: Listen queue size
+    """
+
+    def __init__(self, app, host='127.0.0.1', port=5000, workers=8, events=None, stream_path='/events',
+                 keep_alive=15, backlog=1024):
+        self.map = ChannelMap()
+        asyncore.dispatcher.__init__(self, map=self.map)
+        self.app = app
+        self.events = events
+        self.stream_path = stream_path if events is not None else None
+        self.keep_alive = keep_alive
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(backlog)
+        self.host, self.port = self.socket.getsockname()[:2]
+        self.trigger = Trigger(self.map)
+        self.pool = WorkerPool(workers, self.trigger)
+        self._streams = set()
+        self._sent = time.time()
+        self._running = False
+
+    def handle_accept(self):
+        # Every pass of the loop polls all the connections, so all the waiting connections are accepted at once
+        while True:
+            pair = self.accept()
+            if pair is None:
+                return
+            sock, address = pair
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            HTTPChannel(self, sock, address)
+
+    def handle_error(self):
+        # Listening socket is kept when accept fails, e.g. when the process runs out of file descriptors
+        logger.exception('Accepting connection failed')
+
+    def environ(self, channel, method, path, query, version, headers, body):
+        """
+        Build WSGI environment of the request
+
+        :return: Dictionary of the environment
+        """
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': urllib.unquote(path),
+            'QUERY_STRING': query,
+            'SERVER_NAME': self.host,
+            'SERVER_PORT': str(self.port),
+            'SERVER_PROTOCOL': version,
+            'REMOTE_ADDR': channel.address[0] if channel.address else '',
+            'CONTENT_LENGTH': str(len(body)) if body else '',
+            'CONTENT_TYPE': headers.get('content-type', ''),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': StringIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False
+        }
+        for name, value in headers.items():
+            if name not in ('content-type', 'content-length'):
+                environ['HTTP_' + name.upper().replace('-', '_')] = value
+        return environ
+
+    def call_app(self, environ, close, channel):
+        """
+        Run the application in a worker thread. Responses without the length which the application generates,
+        e.g. trades exports, are streamed: every chunk is passed to the loop as soon as it's produced, so the
+        client gets the first bytes before the response is complete and at most STREAM_WINDOW chunks are buffered
+        for a slow client.
+
+        :param environ: WSGI environment
+        :param close: Whether the connection is closed after the response
+        :param channel: HTTPChannel of the request
+        :return: Tuple of the whole response, or the rest of the streamed one, and the close flag
+        """
+        state = []
+
+        def start_response(status, headers, exc_info=None):
+            state[:] = [status, headers]
+            return chunks.append
+
+        chunks = []
+        try:
+            result = self.app(environ, start_response)
+            try:
+                body = iter(result)
+                if not state:
+                    # Generator applications call start_response when their first chunk is taken
+                    first = next(body, '')
+                    if first:
+                        chunks.append(first)
+                status, headers = state
+                if self._streamed(environ, status, headers, result):
+                    return self._stream(channel, environ, status, headers, chunks, body, close)
+                chunks.extend(body)
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        except Exception:
+            logger.exception('Application failed')
+            status, headers, chunks, close = '500 Internal Server Error', [('Content-Type', 'text/plain')], \
+                ['500 Internal Server Error\n'], True
+        body = ''.join(chunks)
+        return self._head(status, headers, close, 'Content-Length: %d' % len(body)) + body, close
+
+    @staticmethod
+    def _streamed(environ, status, headers, result):
+        if isinstance(result, (list, tuple)) or environ['REQUEST_METHOD'] == 'HEAD' or status[:3] in ('204', '304'):
+            return False
+        return all(name.lower() != 'content-length' for name, _ in headers)
+
+    @staticmethod
+    def _head(status, headers, close, length):
+        lines = ['HTTP/1.1 ' + status]
+        lines.extend('%s: %s' % header for header in headers)
+        if length is not None and all(name.lower() != 'content-length' for name, _ in headers):
+            lines.append(length)
+        if all(name.lower() != 'date' for name, _ in headers):
+            lines.append('Date: ' + formatdate(usegmt=True))
+        lines.append('Connection: close' if close else 'Connection: keep-alive')
+        return '\r\n'.join(lines) + '\r\n\r\n'
+
+    def _stream(self, channel, environ, status, headers, chunks, result, close):
+        # HTTP/1.0 clients don't know the chunked encoding, the end of their response is the connection close
+        chunked = environ['SERVER_PROTOCOL'] == 'HTTP/1.1'
+        close = close or not chunked
+        window = threading.Semaphore(STREAM_WINDOW)
+        head = self._head(status, headers, close, 'Transfer-Encoding: chunked' if chunked else None)
+        self.trigger.call(channel.push_stream, window, head + ''.join(chunks))
+        try:
+            for chunk in result:
+                if not chunk:
+                    continue
+                window.acquire()
+                if not channel.connected:
+                    return '', True
+                self.trigger.call(channel.push_stream, window, '%x\r\n%s\r\n' % (len(chunk), chunk)
+                                  if chunked else chunk)
+        except Exception:
+            # Status is sent already, the client notices the incomplete response by the closed connection
+            logger.exception('Application failed')
+            return '', True
+        return '0\r\n\r\n' if chunked else '', close
+
+    def stream(self, channel):
+        """
+        Start streaming events to the connection, the server subscribes to the event bus with the first stream
+
+        :param channel: HTTPChannel of the request
+        :return: Nothing
+        """
+        channel.push(STREAM_HEADERS)
+        self._streams.add(channel)
+        if len(self._streams) == 1:
+            self.events.subscribe(self)
+
+    def forget(self, channel):
+        if channel in self._streams:
+            self._streams.discard(channel)
+            if not self._streams:
+                self.events.unsubscribe(self)
+
+    def put_nowait(self, message):
+        # Called by the event bus in the publishing thread
+        self.trigger.call(self._broadcast, message)
+
+    def _broadcast(self, message):
+        self._sent = time.time()
+        limit = self.events.queue_size
+        for channel in list(self._streams):
+            # Streams which don't keep up lose the events like the subscribers queues of the event bus
+            if len(channel.producer_fifo) < limit:
+                channel.push(message)
+
+    def serve_forever(self):
+        """
+        Run the event loop until shutdown is called
+
+        :return: Nothing
+        """
+        self._running = True
+        loop = EpollLoop(self.map) if hasattr(select, 'epoll') else None
+        try:
+            while self._running:
+                if loop is not None:
+                    loop.poll(1.0)
+                else:
+                    asyncore.loop(timeout=1.0, use_poll=True, map=self.map, count=1)
+                if self._streams and time.time() - self._sent >= self.keep_alive:
+                    self._broadcast(': keep-alive\n\n')
+        finally:
+            if loop is not None:
+                loop.close()
+
+    def shutdown(self):
+        """
+        Stop the event loop and close all connections, it may be called from any thread
+
+        :return: Nothing
+        """
+        self.trigger.call(self._stop)
+
+    def _stop(self):
+        self._running = False
+        if self._streams:
+            self.events.unsubscribe(self)
+            self._streams.clear()
+        self.pool.stop()
+        asyncore.close_all(self.map)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the application on the event loop')
+    parser.add_argument('--host', default='127.0.0.1', help='Host to listen at')
+    parser.add_argument('--port', type=int, default=5000, help='Port to listen at')
+    parser.add_argument('--workers', type=int, default=8, help='Number of the threads running the requests')
+    args = parser.parse_args()
+
+    from app import create_app, events
+    server = AsyncServer(create_app(), args.host, args.port, workers=args.workers, events=events)
+    sys.stderr.write('Serving on http://%s:%d/\n' % (server.host, server.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
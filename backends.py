@@ -0,0 +1,345 @@
+# coding=UTF-8
+
+import argparse
+import zlib
+from multiprocessing.managers import BaseManager
+
+from journal import Journal
+from models import GBCEIndex, Stock, StockAnalytics, Trade, TradeStockRecord, VWSP_PERIOD, _validate_trades
+from orders import MatchingEngine
+
+
+__author__ = 'Konstantin Kolesnikov'
+
+
+class MarketService(object):
+    """
+    Class represents market shard served to the web workers, it keeps the stocks and trades of the shard symbols
+    in the process Stock and Trade containers
+    """
+
+    def add_stock(self, stock_record):
+        Stock.get_instance().add(stock_record)
+
+    def update_stock(self, stock_record):
+        Stock.get_instance().update(stock_record)
+
+    def get_stock_by_symbol(self, symbol):
+        return Stock.get_instance().get_stock_by_symbol(symbol)
+
+    def get_stocks(self):
+        return list(Stock.get_instance())
+
+    def record(self, trades):
+        """
+        Record trades already validated by the web worker
+
+        :param trades: List of trade records
+        :return: List of recorded trades
+        """
+        trade = Trade.get_instance()
+        return [trade._record(tr) for tr in trades]
+
+    def get_trades_for_symbol(self, symbol, time_range):
+        return Trade.get_instance().get_trades_for_symbol(symbol, time_range)
+
+    def get_vwsps(self, symbols, period=VWSP_PERIOD):
+        return Trade.get_instance().get_vwsps(symbols, period)
+
+    def get_versions(self, symbols):
+        return Trade.get_instance().get_versions(symbols)
+
+    def get_candles(self, symbol, resolution, since, until, limit):
+        return Trade.get_instance().get_candles(symbol, resolution, since, until, limit)
+
+    def get_window_sizes(self):
+        return Trade.get_instance().get_window_sizes()
+
+    def get_index_state(self, period=VWSP_PERIOD):
+        return Trade.get_instance().get_index_state(period)
+
+    def get_windows(self):
+        return Trade.get_instance().windows
+
+    def rebuild_index(self):
+        Trade.get_instance().rebuild_index()
+
+    def history_chunk(self, position, symbol, since, until):
+        return Trade.get_instance().history_chunk(position, symbol, since, until)
+
+    def match(self, symbol, side, price, quantity):
+        return MatchingEngine.get_instance().match(symbol, side, price, quantity)
+
+    def cancel_order(self, symbol, order_id):
+        return MatchingEngine.get_instance().cancel(symbol, order_id)
+
+    def get_order(self, symbol, order_id):
+        return MatchingEngine.get_instance().get_order(symbol, order_id)
+
+    def get_depth(self, symbol, count):
+        return MatchingEngine.get_instance().get_depth(symbol, count)
+
+
+class MarketManager(BaseManager):
+    pass
+
+
+def serve(address, authkey, compact_storage=False, journal_path=None, windows=(VWSP_PERIOD,)):
+    """
+    Serve market shard until the process is terminated
+
+    :param address: Unix socket path or (host, port) tuple to listen at
+    :param authkey: Key the web workers authenticate with
+    :param compact_storage: Store trades in compact typed columns
+    :param journal_path: Directory of the shard journal the shard is recovered from, nothing is kept when it's None
+    :param windows: VWSP periods in minutes VWSP and GBCE index are maintained for
+    :return: Nothing
+    """
+    Stock()
+    Trade(compact_storage=compact_storage, windows=windows)
+    if journal_path is not None:
+        Journal(journal_path).apply(Stock.get_instance(), Trade.get_instance())
+    service = MarketService()
+    MarketManager.register('market', callable=lambda: service)
+    MarketManager(address=address, authkey=authkey).get_server().serve_forever()
+
+
+def shard_of(symbol, shards):
+    """
+    Return position of the shard the stock belongs to, it is the same in every process
+
+    :param symbol: Stock symbol
+    :param shards: Number of shards
+    :return: Shard position
+    """
+    return (zlib.crc32(symbol.encode('utf-8')) & 0xffffffff) % shards
+
+
+class ShardedStock(object):
+    """
+    Class represents Stock Market which stocks are kept by the market shards, it has the same interface as Stock
+
+    :param shards: List of market shards proxies
+    """
+
+    def __init__(self, shards):
+        self.shards = shards
+
+    def __iter__(self):
+        for shard in self.shards:
+            for stock in shard.get_stocks():
+                yield stock
+
+    def _shard(self, symbol):
+        return self.shards[shard_of(symbol, len(self.shards))]
+
+    def add(self, stock_record):
+        self._shard(stock_record.symbol).add_stock(stock_record)
+
+    def update(self, stock_record):
+        self._shard(stock_record.symbol).update_stock(stock_record)
+
+    def get_stock_by_symbol(self, symbol):
+        return self._shard(symbol).get_stock_by_symbol(symbol)
+
+    def analytics(self):
+        return StockAnalytics(list(self))
+
+
+class ShardedTrade(object):
+    """
+    Class represents container of trades kept by the market shards, it has the same interface as Trade except
+    compaction which is done by the shards themselves. GBCE index is combined from the exact shards states, so
+    every web worker gets the same value.
+
+    Positions in the trades history are position in the shard history multiplied by number of shards plus shard
+    position, history returns trades of the shards one after another.
+
+    :param shards: List of market shards proxies
+    """
+
+    HISTORY_CHUNK = Trade.HISTORY_CHUNK
+
+    def __init__(self, shards):
+        self.shards = shards
+        self.windows = tuple(shards[0].get_windows())
+
+    def __iter__(self):
+        for _, trade in self.history():
+            yield trade
+
+    def _shard(self, symbol):
+        return self.shards[shard_of(symbol, len(self.shards))]
+
+    def _record(self, trades):
+        batches = {}
+        for trade in trades:
+            batches.setdefault(shard_of(trade.symbol, len(self.shards)), []).append(trade)
+        recorded = []
+        for shard, batch in batches.items():
+            recorded.extend(self.shards[shard].record(batch))
+        return recorded
+
+    def _trade(self, symbol, price, quantity, indicator):
+        trade = self._record([TradeStockRecord(symbol=symbol, price=price, quantity=quantity, indicator=indicator)])[0]
+        self._notify([trade])
+        return trade
+
+    def _notify(self, trades):
+        # Listeners are notified only about the trades made through this web worker
+        for callback in Trade._listeners:
+            callback(trades)
+
+    def bulk_record(self, items):
+        records, errors = _validate_trades(items, Stock.get_instance())
+        trades = self._record(records)
+        if trades:
+            self._notify(trades)
+        return trades, errors
+
+    def buy(self, symbol, price, quantity):
+        return self._trade(symbol, price, quantity, indicator='buy')
+
+    def sell(self, symbol, price, quantity):
+        return self._trade(symbol, price, quantity, indicator='sell')
+
+    def get_trades_for_symbol(self, symbol, time_range=VWSP_PERIOD):
+        return self._shard(symbol).get_trades_for_symbol(symbol, time_range)
+
+    def get_vwsp(self, symbol, period=VWSP_PERIOD):
+        return self._shard(symbol).get_vwsps([symbol], period)[0]
+
+    def _gather(self, method, symbols, default, *args):
+        # Call the method of every shard with its symbols and put the results back in the symbols order
+        positions = {}
+        for position, symbol in enumerate(symbols):
+            positions.setdefault(shard_of(symbol, len(self.shards)), []).append(position)
+        results = [default] * len(symbols)
+        for shard, shard_positions in positions.items():
+            shard_results = getattr(self.shards[shard], method)([symbols[p] for p in shard_positions], *args)
+            for position, result in zip(shard_positions, shard_results):
+                results[position] = result
+        return results
+
+    def get_vwsps(self, symbols, period=VWSP_PERIOD):
+        return self._gather('get_vwsps', symbols, 0.0, period)
+
+    def get_versions(self, symbols):
+        return self._gather('get_versions', symbols, None)
+
+    def get_candles(self, symbol, resolution, since=None, until=None, limit=None):
+        return self._shard(symbol).get_candles(symbol, resolution, since, until, limit)
+
+    def get_window_sizes(self):
+        sizes = {}
+        for shard in self.shards:
+            sizes.update(shard.get_window_sizes())
+        return sizes
+
+    def get_index_state(self, period=VWSP_PERIOD):
+        log_sum, count = 0, 0
+        for shard in self.shards:
+            shard_log_sum, shard_count = shard.get_index_state(period)
+            log_sum += shard_log_sum
+            count += shard_count
+        return log_sum, count
+
+    @property
+    def gbce_index(self):
+        return self.get_gbce_index()
+
+    def get_gbce_index(self, period=VWSP_PERIOD):
+        return GBCEIndex.geometric_mean(*self.get_index_state(period))
+
+    def rebuild_index(self):
+        for shard in self.shards:
+            shard.rebuild_index()
+
+    def history(self, cursor=0, limit=None, symbol=None, since=None, until=None):
+        position = cursor
+        while position is not None and (limit is None or limit > 0):
+            trades, position = self.history_chunk(position, symbol, since, until)
+            for item in trades[:limit]:
+                yield item
+            if limit is not None:
+                limit -= len(trades)
+
+    def history_chunk(self, position, symbol=None, since=None, until=None):
+        count = len(self.shards)
+        shard, shard_position = position % count, position // count
+        if symbol is not None and shard_of(symbol, count) != shard:
+            if shard_of(symbol, count) < shard:
+                return [], None
+            shard, shard_position = shard_of(symbol, count), 0
+        trades, next_position = self.shards[shard].history_chunk(shard_position, symbol, since, until)
+        trades = [(p * count + shard, trade) for p, trade in trades]
+        if next_position is not None:
+            return trades, next_position * count + shard
+        if symbol is None and shard + 1 < count:
+            return trades, shard + 1
+        return trades, None
+
+
+class ShardedMatchingEngine(object):
+    """
+    Class represents order books kept by the market shards, it has the same interface as MatchingEngine. Orders
+    are matched by the shard of the stock, order ids are unique per shard.
+
+    :param shards: List of market shards proxies
+    """
+
+    def __init__(self, shards):
+        self.shards = shards
+
+    def _shard(self, symbol):
+        return self.shards[shard_of(symbol, len(self.shards))]
+
+    def match(self, symbol, side, price, quantity):
+        return self._shard(symbol).match(symbol, side, price, quantity)
+
+    def submit(self, symbol, side, price, quantity):
+        order, trades = self.match(symbol, side, price, quantity)
+        if trades:
+            Trade.get_instance()._notify(trades)
+        return order, trades
+
+    def cancel(self, symbol, order_id):
+        return self._shard(symbol).cancel_order(symbol, order_id)
+
+    def get_order(self, symbol, order_id):
+        return self._shard(symbol).get_order(symbol, order_id)
+
+    def get_depth(self, symbol, count=10):
+        return self._shard(symbol).get_depth(symbol, count)
+
+
+def connect(addresses, authkey):
+    """
+    Connect to the market shards and make Stock, Trade and MatchingEngine instances use them
+
+    :param addresses: List of the shards addresses, every web worker should list them in the same order
+    :param authkey: Key to authenticate with
+    :return: Nothing
+    """
+    MarketManager.register('market')
+    shards = []
+    for address in addresses:
+        manager = MarketManager(address=address, authkey=authkey)
+        manager.connect()
+        shards.append(manager.market())
+    Stock._instance = ShardedStock(shards)
+    Trade._instance = ShardedTrade(shards)
+    MatchingEngine._instance = ShardedMatchingEngine(shards)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve market shard')
+    parser.add_argument('address', help='Unix socket path to listen at')
+    parser.add_argument('--authkey', default='sssm', help='Key the web workers authenticate with')
+    parser.add_argument('--compact-storage', action='store_true', help='Store trades in compact typed columns')
+    parser.add_argument('--journal', help='Directory of the shard journal')
+    parser.add_argument('--windows', default=str(VWSP_PERIOD),
+                        help='Comma separated VWSP periods in minutes VWSP and GBCE index are maintained for')
+    args = parser.parse_args()
+    serve(args.address, args.authkey, compact_storage=args.compact_storage, journal_path=args.journal,
+          windows=[int(period) for period in args.windows.split(',')])
@@ -0,0 +1,321 @@
+# coding=UTF-8
+
+import argparse
+import json
+import math
+import platform
+import random
+import sys
+import time
+
+from app import app
+from models import Stock, StockRecord, Trade, TradeStockRecord, VWSP_PERIOD
+from orders import MatchingEngine
+from workload import symbol_name
+
+
+__author__ = 'Konstantin Kolesnikov'
+
+
+SCALES = {
+    'quick': ([10, 100], [1000, 10000]),
+    'default': ([10, 100, 1000], [1000, 10000, 100000]),
+    'full': ([10, 100, 1000, 10000], [1000, 10000, 100000, 1000000, 10000000])
+}
+# Maximum number of the resting orders of the benchmarked order book, the book has as many orders as the market
+# has trades up to this number
+BOOK_ORDERS = 1000000
+
+
+def build_market(symbols, trades, seed=0, compact_storage=False):
+    """
+    Replace the market with synthetic one, trades are made during the last two VWSP periods in timestamp order
+
+    :param symbols: Number of stocks
+    :param trades: Number of trades
+    :param seed: Seed of the random generator, the same seed gives the same market
+    :param compact_storage: Store trades in compact typed columns
+    :return: List of the stocks symbols
+    """
+    rnd = random.Random(seed)
+    Stock._instance = None
+    Trade._instance = None
+    Trade(compact_storage=compact_storage)
+    names = [symbol_name(position) for position in range(symbols)]
+    for name in names:
+        preferred = rnd.random() < 0.2
+        Stock.get_instance().add(StockRecord(symbol=name,
+                                             price=rnd.uniform(1.0, 1000.0),
+                                             type='preferred' if preferred else 'common',
+                                             last_dividend=rnd.randint(0, 20),
+                                             fixed_dividend=0.02 if preferred else 0.0,
+                                             par_value=rnd.choice([1, 10, 100])))
+    now = int(time.time())
+    start = now - 2 * VWSP_PERIOD * 60
+    trade = Trade.get_instance()
+    for position in range(trades):
+        trade._record(TradeStockRecord(timestamp=start + position * 2 * VWSP_PERIOD * 60 // trades,
+                                       symbol=names[rnd.randrange(symbols)],
+                                       price=round(rnd.uniform(1.0, 1000.0), 2),
+                                       quantity=rnd.randint(1, 1000),
+                                       indicator=rnd.choice(['buy', 'sell'])))
+    # Expire the trades made before the VWSP period now, so the first measured calls don't pay for it
+    trade.get_vwsps(names)
+    trade.gbce_index
+    return names
+
+
+def build_book(symbol, orders, seed=0):
+    """
+    Replace order books with the book of the stock, which has the resting orders on both sides: 10 orders per price
+    level around the price of 100.0
+
+    :param symbol: Stock symbol
+    :param orders: Number of the resting orders
+    :param seed: Seed of the random generator
+    :return: List of the resting orders
+    """
+    rnd = random.Random(seed)
+    MatchingEngine._instance = None
+    engine = MatchingEngine.get_instance()
+    resting = []
+    for position in range(orders):
+        level = position // 20 + 1
+        side = 'buy' if position % 2 else 'sell'
+        price = round(100.0 - level * 0.01 if side == 'buy' else 100.0 + level * 0.01, 2)
+        resting.append(engine.submit(symbol, side, price, rnd.randint(1, 100))[0])
+    return resting
+
+
+def measure(operation, min_time=0.2, repeat=3):
+    """
+    Measure time of the operation, it is called in a loop until it takes at least min time
+
+    :param operation: Callable without arguments
+    :param min_time: Minimum time in seconds of a single measurement
+    :param repeat: Number of measurements
+    :return: Tuple of the best time per call in seconds and number of calls per measurement
+    """
+    iterations = 1
+    while True:
+        started = time.time()
+        for _ in range(iterations):
+            operation()
+        elapsed = time.time() - started
+        if elapsed >= min_time or iterations >= 1000000:
+            break
+        iterations *= 10 if elapsed < min_time / 10 else 2
+    best = elapsed / iterations
+    for _ in range(repeat - 1):
+        started = time.time()
+        for _ in range(iterations):
+            operation()
+        best = min(best, (time.time() - started) / iterations)
+    return best, iterations
+
+
+def benchmarks(names, seed=0, book=None):
+    """
+    Return benchmarked operations of the current market, every operation picks stocks pseudo randomly
+
+    :param names: List of the stocks symbols
+    :param seed: Seed of the random generator
+    :param book: List of the resting orders of the first stock book, order book operations are benchmarked when
+                 it's given
+    :return: List of (name, operation) tuples
+    """
+    rnd = random.Random(seed)
+    client = app.test_client()
+    trade = Trade.get_instance()
+    stocks = Stock.get_instance()
+    body = json.dumps({'symbol': names[0], 'price': 10.0, 'quantity': 10, 'indicator': 'buy'})
+
+    def pick():
+        return names[rnd.randrange(len(names))]
+
+    def gbce_index_after_trade():
+        trade.sell(pick(), 10.0, 10)
+        return trade.gbce_index
+
+    engine = MatchingEngine.get_instance()
+
+    def book_insert():
+        # Order rests inside the book without crossing it
+        order = book[rnd.randrange(len(book))]
+        engine.submit(names[0], order.side, order.price, 10)
+
+    def book_cancel():
+        # Cancelled order is replaced with the same one, so the book depth stays the same
+        position = rnd.randrange(len(book))
+        order = book[position]
+        engine.cancel(names[0], order.id)
+        book[position] = engine.submit(names[0], order.side, order.price, order.quantity)[0]
+
+    def book_match():
+        # Order fills the first order of the best ask level, which is put back to keep the book depth
+        price = engine.get_depth(names[0], 1)['asks'][0]['price']
+        order, trades = engine.submit(names[0], 'buy', price, 1)
+        engine.submit(names[0], 'sell', price, trades[0].quantity if trades else 1)
+
+    book_benchmarks = [
+        ('book.insert', book_insert),
+        ('book.cancel', book_cancel),
+        ('book.match', book_match)
+    ] if book is not None else []
+
+    # Operations which make trades go last, so they don't grow the market the others are measured at
+    return book_benchmarks[:2] + [
+        ('trade.get_trades_for_symbol', lambda: trade.get_trades_for_symbol(pick())),
+        ('stock.vwsp', lambda: stocks.get_stock_by_symbol(pick()).vwsp),
+        ('trade.gbce_index', lambda: trade.gbce_index),
+        ('GET /stocks', lambda: client.get('/stocks')),
+        ('GET /stocks/<symbol>', lambda: client.get('/stocks/%s' % pick())),
+        ('GET /trades?limit=100', lambda: client.get('/trades?limit=100')),
+        ('trade.buy', lambda: trade.buy(pick(), 10.0, 10)),
+        ('trade.sell', lambda: trade.sell(pick(), 10.0, 10)),
+        ('trade.gbce_index_after_trade', gbce_index_after_trade),
+        ('POST /trades', lambda: client.post('/trades', data=body, content_type='application/json'))
+    ] + book_benchmarks[2:]
+
+
+def run(symbols, trades, min_time=0.2, repeat=3, seed=0, compact_storage=False, only=None, log=None):
+    """
+    Run benchmarks over every combination of the market sizes
+
+    :param symbols: List of numbers of stocks
+    :param trades: List of numbers of trades
+    :param min_time: Minimum time in seconds of a single measurement
+    :param repeat: Number of measurements, the best one is taken
+    :param seed: Seed of the random generator
+    :param compact_storage: Store trades in compact typed columns
+    :param only: List of benchmark names to run, all of them when None
+    :param log: File the progress is written to
+    :return: Dictionary of the results
+    """
+    results = []
+    for symbols_count in symbols:
+        for trades_count in trades:
+            names = build_market(symbols_count, trades_count, seed=seed, compact_storage=compact_storage)
+            book = None
+            if only is None or any(name.startswith('book.') for name in only):
+                book = build_book(names[0], min(trades_count, BOOK_ORDERS), seed=seed)
+            for name, operation in benchmarks(names, seed=seed, book=book):
+                if only is not None and name not in only:
+                    continue
+                seconds, iterations = measure(operation, min_time=min_time, repeat=repeat)
+                results.append({'name': name,
+                                'symbols': symbols_count,
+                                'trades': trades_count,
+                                'seconds': seconds,
+                                'iterations': iterations})
+                if log is not None:
+                    log.write('%-30s %6d symbols %9d trades %12.1f us\n'
+                              % (name, symbols_count, trades_count, seconds * 1e6))
+    Stock._instance = None
+    Trade._instance = None
+    MatchingEngine._instance = None
+    return {'meta': {'python': platform.python_version(),
+                     'platform': platform.platform(),
+                     'timestamp': int(time.time()),
+                     'seed': seed,
+                     'compact_storage': compact_storage},
+            'results': results,
+            'scaling': scaling(results)}
+
+
+def _exponent(points):
+    # Least squares slope of log(seconds) over log(size)
+    xs = [math.log(size) for size, _ in points]
+    ys = [math.log(seconds) for _, seconds in points]
+    mean_x, mean_y = sum(xs) / len(xs), sum(ys) / len(ys)
+    variance = sum((x - mean_x) ** 2 for x in xs)
+    return sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / variance
+
+
+def scaling(results):
+    """
+    Estimate how time of every benchmark grows with the number of stocks and trades, exponent 0 means constant
+    time, 1 means linear time, 2 means quadratic time. Exponents don't depend on the machine speed.
+
+    :param results: List of the benchmark results
+    :return: List of dictionaries with the benchmark name, dimension, size of the other dimension and exponent
+    """
+    curves = {}
+    for result in results:
+        curves.setdefault((result['name'], 'trades', result['symbols']), []).append((result['trades'],
+                                                                                    result['seconds']))
+        curves.setdefault((result['name'], 'symbols', result['trades']), []).append((result['symbols'],
+                                                                                    result['seconds']))
+    return [{'name': name, 'dimension': dimension, 'fixed': fixed, 'exponent': _exponent(points)}
+            for (name, dimension, fixed), points in sorted(curves.items()) if len(points) > 1]
+
+
+def compare(current, baseline, threshold=2.0, tolerance=0.5):
+    """
+    Compare results with the baseline
+
+    :param current: Dictionary of the results
+    :param baseline: Dictionary of the baseline results
+    :param threshold: Maximum ratio of the current time to the baseline time
+    :param tolerance: Maximum increase of the scaling exponent
+    :return: List of regression messages, empty when there are no regressions
+    """
+    regressions = []
+    times = dict(((r['name'], r['symbols'], r['trades']), r['seconds']) for r in baseline['results'])
+    for result in current['results']:
+        expected = times.get((result['name'], result['symbols'], result['trades']))
+        if expected is not None and result['seconds'] > expected * threshold:
+            regressions.append('%s with %d symbols and %d trades takes %.1f us, baseline is %.1f us'
+                               % (result['name'], result['symbols'], result['trades'],
+                                  result['seconds'] * 1e6, expected * 1e6))
+    exponents = dict(((s['name'], s['dimension'], s['fixed']), s['exponent']) for s in baseline['scaling'])
+    for curve in current['scaling']:
+        expected = exponents.get((curve['name'], curve['dimension'], curve['fixed']))
+        if expected is not None and curve['exponent'] > expected + tolerance:
+            regressions.append('%s grows as %s^%.2f at %d, baseline is %s^%.2f'
+                               % (curve['name'], curve['dimension'], curve['exponent'], curve['fixed'],
+                                  curve['dimension'], expected))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark models and REST endpoints over synthetic markets')
+    parser.add_argument('--scale', choices=sorted(SCALES), default='default', help='Market sizes to benchmark')
+    parser.add_argument('--symbols', help='Comma separated numbers of stocks, overrides the scale')
+    parser.add_argument('--trades', help='Comma separated numbers of trades, overrides the scale')
+    parser.add_argument('--benchmark', action='append', help='Benchmark to run, may be repeated')
+    parser.add_argument('--min-time', type=float, default=0.2, help='Minimum seconds of a single measurement')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of measurements, the best one is taken')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic markets')
+    parser.add_argument('--compact-storage', action='store_true', help='Store trades in compact typed columns')
+    parser.add_argument('--output', help='File the json results are written to')
+    parser.add_argument('--baseline', help='File of the baseline json results to compare with')
+    parser.add_argument('--threshold', type=float, default=2.0, help='Maximum ratio of the time to the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.5, help='Maximum increase of the scaling exponent')
+    args = parser.parse_args(argv)
+
+    symbols, trades = SCALES[args.scale]
+    if args.symbols:
+        symbols = [int(value) for value in args.symbols.split(',')]
+    if args.trades:
+        trades = [int(value) for value in args.trades.split(',')]
+    results = run(symbols, trades, min_time=args.min_time, repeat=args.repeat, seed=args.seed,
+                  compact_storage=args.compact_storage, only=args.benchmark, log=sys.stderr)
+    for curve in results['scaling']:
+        sys.stderr.write('%-30s %-7s at %8d grows as ^%.2f\n'
+                         % (curve['name'], curve['dimension'], curve['fixed'], curve['exponent']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), threshold=args.threshold, tolerance=args.tolerance)
+        for message in regressions:
+            sys.stderr.write('REGRESSION: %s\n' % message)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,106 @@
+# coding=UTF-8
+
+import threading
+import time
+
+
+__author__ = 'Konstantin Kolesnikov'
+
+
+# Nanoseconds per second, trades are stamped with integer nanoseconds since the epoch
+NANOSECONDS = 1000000000
+
+
+def to_nanoseconds(seconds):
+    """
+    Convert timestamp in seconds to nanoseconds
+
+    :param seconds: Integer or float seconds since the epoch
+    :return: Integer nanoseconds since the epoch
+    """
+    if isinstance(seconds, (int, long)):
+        return seconds * NANOSECONDS
+    return int(round(seconds * NANOSECONDS))
+
+
+class SystemClock(object):
+    """
+    Class represents wall clock returning strictly increasing timestamps, so every trade gets its own timestamp and
+    the trades order never goes backwards when the system time is adjusted or several trades are made within the
+    clock resolution
+    """
+
+    def __init__(self):
+        self._last = 0
+        self._lock = threading.Lock()
+
+    def now(self):
+        """
+        Current time
+
+        :return: Integer nanoseconds since the epoch
+        """
+        wall = int(time.time() * NANOSECONDS)
+        with self._lock:
+            self._last = wall if wall > self._last else self._last + 1
+            return self._last
+
+    def observe(self, timestamp):
+        """
+        Notice timestamp of the recorded trade, event time clocks are advanced by the trades
+
+        :param timestamp: Integer nanoseconds since the epoch
+        :return: Nothing
+        """
+
+
+class ManualClock(SystemClock):
+    """
+    Class represents clock which time is set explicitly, e.g. by tests checking the VWSP windows edges
+
+    :param start: Initial time, integer nanoseconds since the epoch
+    """
+
+    def __init__(self, start=0):
+        super(ManualClock, self).__init__()
+        self._last = start
+
+    def now(self):
+        return self._last
+
+    def set(self, timestamp):
+        with self._lock:
+            self._last = timestamp
+
+    def advance(self, seconds=0, nanoseconds=0):
+        """
+        Move the time forward
+
+        :param seconds: Integer or float seconds
+        :param nanoseconds: Integer nanoseconds
+        :return: New time
+        """
+        with self._lock:
+            self._last += to_nanoseconds(seconds) + nanoseconds
+            return self._last
+
+
+class EventClock(ManualClock):
+    """
+    Class represents event time: the latest timestamp of the recorded trades. VWSP windows then slide with the
+    trades rather than the wall clock, so recorded trading days are replayed as fast as they are read with the
+    same windows and candles they had.
+
+    :param start: Initial time, integer nanoseconds since the epoch
+    """
+
+    def observe(self, timestamp):
+        # Single comparison is enough when trades are recorded in order, the lock is taken to move the time only
+        if timestamp > self._last:
+            with self._lock:
+                if timestamp > self._last:
+                    self._last = timestamp
+
+
+# Clock the trades are stamped by unless other clock is specified
+SYSTEM_CLOCK = SystemClock()
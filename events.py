@@ -0,0 +1,80 @@
+# coding=UTF-8
+
+import threading
+from Queue import Queue, Empty, Full
+
+from flask import json
+
+
+__author__ = 'Konstantin Kolesnikov'
+
+
+class EventBus(object):
+    """
+    Class represents publisher of the market events to the subscribed clients. Every event is serialized once
+    and put to the queue of each subscriber, subscribers which don't keep up lose the events.
+
+    :param queue_size: Maximum number of events waiting for a subscriber
+    :param _subscribers: Set of subscribers queues
+    """
+
+    def __init__(self, queue_size=1000):
+        self.queue_size = queue_size
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._subscribers)
+
+    def subscribe(self, queue=None):
+        """
+        Register new subscriber
+
+        :param queue: Object with put_nowait method the events will be put to, new bounded queue by default
+        :return: Queue the events will be put to
+        """
+        if queue is None:
+            queue = Queue(self.queue_size)
+        with self._lock:
+            self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        with self._lock:
+            self._subscribers.discard(queue)
+
+    def publish(self, event, data):
+        """
+        Publish event to all subscribers
+
+        :param event: Event name
+        :param data: Event data, should be json serializable
+        :return: Nothing
+        """
+        with self._lock:
+            subscribers = list(self._subscribers)
+        if not subscribers:
+            return
+        message = 'event: %s\ndata: %s\n\n' % (event, json.dumps(data))
+        for queue in subscribers:
+            try:
+                queue.put_nowait(message)
+            except Full:
+                pass
+
+    def stream(self, keep_alive=15):
+        """
+        Subscribe and return generator of the Server-Sent Events messages
+
+        :param keep_alive: Seconds of inactivity after which comment is sent to keep the connection open
+        :return: Generator of messages
+        """
+        queue = self.subscribe()
+        try:
+            while True:
+                try:
+                    yield queue.get(timeout=keep_alive)
+                except Empty:
+                    yield ': keep-alive\n\n'
+        finally:
+            self.unsubscribe(queue)
@@ -1,14 +1,45 @@
 # coding=UTF-8
 
+import math
 
+from werkzeug.datastructures import MultiDict
 from wtforms import Form, IntegerField, FloatField, StringField, SelectField, validators
 
-from models import Stock, STOCK_TYPE, TRADE_TYPE
+from models import INT64_MAX, Stock, STOCK_TYPE, TRADE_TYPE
 
 
 __author__ = 'Konstantin Kolesnikov'
 
 
+class Finite(object):
+    """
+    Validates that the number is finite, NumberRange lets NaN and the infinities of the unbounded side through
+
+    :param message: Error message
+    """
+
+    def __init__(self, message=None):
+        self.message = message
+
+    def __call__(self, form, field):
+        data = field.data
+        if data is not None and (math.isnan(data) or math.isinf(data)):
+            raise validators.StopValidation(self.message or field.gettext('Number must be finite.'))
+
+
+class FiniteIntegerField(IntegerField):
+    """
+    Integer field which reports infinite json numbers as invalid values instead of raising OverflowError
+    """
+
+    def process_formdata(self, valuelist):
+        try:
+            super(FiniteIntegerField, self).process_formdata(valuelist)
+        except OverflowError:
+            self.data = None
+            raise ValueError(self.gettext('Not a valid integer value'))
+
+
 class StockRecordForm(Form):
     """
     Stock record form provides incoming data validation
@@ -21,26 +52,36 @@ class StockRecordForm(Form):
     """
     symbol = StringField('Stock Symbol', [validators.Length(min=3, max=5), validators.InputRequired()])
     type = SelectField('Type', [validators.InputRequired()], choices=STOCK_TYPE.items())
-    last_dividend = IntegerField('Last dividend', [validators.NumberRange(min=0)])
-    fixed_dividend = FloatField('Fixed dividend', [validators.NumberRange(min=0.0, max=1.0)], default=0.0)
-    par_value = IntegerField('Par value', [validators.NumberRange(min=0), validators.InputRequired()])
-    price = FloatField('Stock price', [validators.NumberRange(min=0.0), validators.InputRequired()])
+    last_dividend = FiniteIntegerField('Last dividend', [validators.NumberRange(min=0)])
+    fixed_dividend = FloatField('Fixed dividend', [Finite(), validators.NumberRange(min=0.0, max=1.0)], default=0.0)
+    par_value = FiniteIntegerField('Par value', [validators.NumberRange(min=0), validators.InputRequired()])
+    price = FloatField('Stock price', [Finite(), validators.NumberRange(min=0.0), validators.InputRequired()])
 
     def validate(self):
         success = super(StockRecordForm, self).validate()
-        type_field = self._fields.get('type')
-        fixed_field = self._fields.get('fixed_dividend')
-        if STOCK_TYPE.get(type_field.data) == STOCK_TYPE['preferred']:
-            if fixed_field.data <= 0.0:
-                if 'fixed_dividend' not in self.errors:
-                    self.errors['fixed_dividend'] = []
-                self.errors['fixed_dividend'].append('Fixed dividend should be defined for Preferred stock type')
-                success = False
-        return success
+        return self.validate_form(self.errors) and success
+
+    def validate_form(self, errors):
+        """
+        Validate fields which depend on each other, it is called by FormSchema as well
+
+        :param errors: Dictionary of errors per field the errors are added to
+        :return: True if the fields are consistent
+        """
+        if STOCK_TYPE.get(self.type.data) == STOCK_TYPE['preferred']:
+            if self.fixed_dividend.data <= 0.0:
+                if 'fixed_dividend' not in errors:
+                    errors['fixed_dividend'] = []
+                errors['fixed_dividend'].append('Fixed dividend should be defined for Preferred stock type')
+                return False
+        return True
 
     def validate_last_dividend(self, field):
         value = field.data
         if value is None:
+            if not field.raw_data:
+                # Missing dividend is reported alone like InputRequired does, 0 is a valid dividend though
+                field.errors[:] = []
             raise validators.StopValidation('This field is required.')
 
 
@@ -52,15 +93,199 @@ class TradeRecordForm(Form):
     :param type: string field, should one of the the following - 'Common', 'Preferred'
     :param last_dividend: integer field, should be greater or equal to 0
     :param fixed_dividend: float field, should be provided only when type is 'Preferred, value between 0.0 an 1.0
+    :param stock: Stock record of the symbol already looked up by the caller, it is looked up when None
     """
     symbol = StringField('Stock Symbol', [validators.Length(min=3, max=5), validators.InputRequired()])
-    price = FloatField('Traded price', [validators.NumberRange(min=0.0), validators.InputRequired()])
-    quantity = IntegerField('Share quantity', [validators.NumberRange(min=1), validators.InputRequired()])
+    price = FloatField('Traded price', [Finite(), validators.NumberRange(min=0.0), validators.InputRequired()])
+    quantity = FiniteIntegerField('Share quantity', [validators.NumberRange(min=1, max=INT64_MAX),
+                                                     validators.InputRequired()])
     indicator = SelectField('Indicator', [validators.InputRequired()], choices=TRADE_TYPE.items())
 
+    stock = None
+
     def validate_symbol(self, field):
         symbol = field.data
-        stock = Stock.get_instance().get_stock_by_symbol(symbol)
+        stock = self.stock
+        if stock is None or stock.symbol != symbol:
+            stock = Stock.get_instance().get_stock_by_symbol(symbol)
         if stock is None:
             raise ValueError('Stock symbol is not registered at the market.')
         return True
+
+
+class FieldData(object):
+    """
+    Class represents lightweight field the compiled validators are applied to, it has the attributes of WTForms
+    field the validators use
+
+    :param name: Field name
+    :param data: Processed field value
+    :param raw_data: List of the submitted values
+    :param errors: List of the field errors
+    """
+
+    __slots__ = ('name', 'data', 'raw_data', 'errors')
+
+    def __init__(self, name, data, raw_data, errors):
+        self.name = name
+        self.data = data
+        self.raw_data = raw_data
+        self.errors = errors
+
+    def gettext(self, string):
+        return string
+
+    def ngettext(self, singular, plural, n):
+        return singular if n == 1 else plural
+
+
+class FormData(object):
+    """
+    Class represents lightweight form the compiled validators are applied to, fields and the context are its
+    attributes, other attributes are looked up in the form class
+
+    :param form_class: WTForms form class
+    """
+
+    def __init__(self, form_class):
+        self._form_class = form_class
+
+    def __getattr__(self, name):
+        return getattr(self._form_class, name)
+
+
+class FormSchema(object):
+    """
+    Class represents validator compiled from the WTForms form class. It validates json payload in a single pass
+    without constructing the form and its fields and returns the same data and errors the form does: fields are
+    processed the same way WTForms does it, then the form validators, inline validate_<field> methods and
+    validate_form method are applied.
+
+    :param form_class: WTForms form class with StringField, IntegerField, FloatField and SelectField fields or
+                       their subclasses processing data the same way
+    :param fields: List of (name, process function, validators) tuples in the form fields order
+    """
+
+    def __init__(self, form_class):
+        self.form_class = form_class
+        unbound_fields = sorted(((name, getattr(form_class, name)) for name in dir(form_class)
+                                 if not name.startswith('_') and hasattr(getattr(form_class, name), '_formfield')),
+                                key=lambda item: (item[1].creation_counter, item[0]))
+        self.fields = []
+        for name, unbound_field in unbound_fields:
+            field_validators = list(unbound_field.kwargs.get('validators') or
+                                    (unbound_field.args[1] if len(unbound_field.args) > 1 else None) or [])
+            inline = getattr(form_class, 'validate_%s' % name, None)
+            if inline is not None:
+                field_validators.append(inline.__func__)
+            self.fields.append((name, self._compile_field(unbound_field), field_validators))
+        validate_form = getattr(form_class, 'validate_form', None)
+        self.validate_form = validate_form.__func__ if validate_form is not None else None
+
+    @staticmethod
+    def _compile_field(unbound_field):
+        field_class, kwargs = unbound_field.field_class, unbound_field.kwargs
+        default = kwargs.get('default')
+
+        if field_class is StringField:
+            def process(raw_data):
+                if raw_data:
+                    return raw_data[0], None
+                return ('' if default is None else default), None
+            return process
+
+        if issubclass(field_class, (IntegerField, FloatField)):
+            convert, message = ((int, 'Not a valid integer value') if issubclass(field_class, IntegerField) else
+                                (float, 'Not a valid float value'))
+            errors = (ValueError, OverflowError) if issubclass(field_class, FiniteIntegerField) else ValueError
+
+            def process(raw_data):
+                if raw_data:
+                    try:
+                        return convert(raw_data[0]), None
+                    except errors:
+                        return None, message
+                return default, None
+            return process
+
+        if field_class is SelectField:
+            coerce = kwargs.get('coerce', unicode)
+            choices = tuple(value for value, _ in kwargs['choices'])
+            try:
+                initial = coerce(default)
+            except (ValueError, TypeError):
+                initial = None
+
+            def process(raw_data):
+                data, error = initial, None
+                if raw_data:
+                    try:
+                        data = coerce(raw_data[0])
+                    except ValueError:
+                        error = 'Invalid Choice: could not coerce'
+                if data not in choices:
+                    return data, error, 'Not a valid choice'
+                return data, error
+            return process
+
+        raise TypeError('Field %s is not supported by FormSchema' % field_class.__name__)
+
+    def validate(self, payload, **context):
+        """
+        Validate json payload
+
+        :param payload: Dictionary of the submitted values, list values are treated as multiple values
+        :param context: Attributes of the form the inline validators may use, e.g. already looked up stock
+        :return: Tuple of the dictionary of fields data and dictionary of errors per field, errors are empty
+                 when the payload is valid
+        """
+        payload = payload or {}
+        form = FormData(self.form_class)
+        form.__dict__.update(context)
+        fields = []
+        for name, process, field_validators in self.fields:
+            raw_data = []
+            if name in payload:
+                value = payload[name]
+                if not isinstance(value, (tuple, list)):
+                    raw_data = [value]
+                elif value:
+                    raw_data = list(value)
+            processed = process(raw_data)
+            field = FieldData(name, processed[0], raw_data, [error for error in processed[1:] if error])
+            setattr(form, name, field)
+            fields.append((field, field_validators))
+
+        for field, field_validators in fields:
+            for validator in field_validators:
+                try:
+                    validator(form, field)
+                except validators.StopValidation as e:
+                    if e.args and e.args[0]:
+                        field.errors.append(e.args[0])
+                    break
+                except ValueError as e:
+                    field.errors.append(e.args[0])
+
+        errors = dict((field.name, field.errors) for field, _ in fields if field.errors)
+        if self.validate_form is not None:
+            self.validate_form(form, errors)
+        return dict((field.name, field.data) for field, _ in fields), errors
+
+    def validate_with_form(self, payload, **context):
+        """
+        Validate json payload with the WTForms form, it returns the same as validate method
+
+        :param payload: Dictionary of the submitted values
+        :param context: Attributes of the form the inline validators may use
+        :return: Tuple of the dictionary of fields data and dictionary of errors per field
+        """
+        form = self.form_class(MultiDict(mapping=payload))
+        for name, value in context.items():
+            setattr(form, name, value)
+        form.validate()
+        return form.data, form.errors
+
+
+STOCK_RECORD_SCHEMA = FormSchema(StockRecordForm)
+TRADE_RECORD_SCHEMA = FormSchema(TradeRecordForm)
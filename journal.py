@@ -0,0 +1,330 @@
+# coding=UTF-8
+
+import json
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+
+from clock import NANOSECONDS
+from models import StockRecord, TradeStockRecord, TRADE_SIDES
+
+
+__author__ = 'Konstantin Kolesnikov'
+
+
+# Every record is framed as payload length, payload CRC32 and the payload starting with the record kind
+FRAME = struct.Struct('<II')
+TRADE = struct.Struct('<qqdqB')
+BASE = struct.Struct('<q')
+
+STOCK_RECORD = b'S'
+# Trades were stamped in seconds before nanosecond timestamps, journals written then are still replayed
+TRADE_RECORD = b'T'
+TRADE_NS_RECORD = b'N'
+BASE_RECORD = b'B'
+
+_SIDES = dict((indicator, side) for side, indicator in enumerate(TRADE_SIDES))
+
+
+def _frame(payload):
+    return FRAME.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+
+
+def encode_stock(stock_record):
+    """
+    Encode stock record to the journal record
+
+    :param stock_record: Stock record instance
+    :return: Framed record bytes
+    """
+    return _frame(STOCK_RECORD + json.dumps({'symbol': stock_record.symbol,
+                                             'price': stock_record.price,
+                                             'type': stock_record.type,
+                                             'last_dividend': stock_record.last_dividend,
+                                             'fixed_dividend': stock_record.fixed_dividend,
+                                             'par_value': stock_record.par_value,
+                                             'timestamp': stock_record.timestamp}))
+
+
+def encode_trade(position, trade):
+    """
+    Encode trade to the journal record
+
+    :param position: Position of the trade in the trades history
+    :param trade: Trade record
+    :return: Framed record bytes
+    """
+    symbol = trade.symbol.encode('utf-8') if isinstance(trade.symbol, unicode) else trade.symbol
+    return _frame(TRADE_NS_RECORD + TRADE.pack(position, trade.timestamp_ns, trade.price, trade.quantity,
+                                            _SIDES.get(trade.indicator, 0)) + symbol)
+
+
+def encode_base(position):
+    return _frame(BASE_RECORD + BASE.pack(position))
+
+
+def read_records(path):
+    """
+    Read records of the journal file through the memory map, reading stops at the first incomplete or corrupted
+    record which is left by the interrupted write
+
+    :param path: Path to the journal file
+    :return: Tuple of the list of (kind, payload) tuples and size of the valid part of the file
+    """
+    records = []
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return records, 0
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            offset = 0
+            while offset + FRAME.size <= size:
+                length, checksum = FRAME.unpack_from(data, offset)
+                start, end = offset + FRAME.size, offset + FRAME.size + length
+                if not length or end > size:
+                    break
+                payload = data[start:end]
+                if zlib.crc32(payload) & 0xffffffff != checksum:
+                    break
+                records.append((payload[:1], payload[1:]))
+                offset = end
+        finally:
+            data.close()
+    return records, offset
+
+
+class Journal(object):
+    """
+    Class represents write-ahead journal of the stocks and trades kept in the directory. Records are appended
+    to the in-memory buffer and written with a single fsync by the background thread every sync interval
+    (group commit), so trading never waits for the disk and at most sync interval of the last trades is lost
+    on a crash. Snapshots of the market state start new journal segment, so recovery replays only the latest
+    snapshot and the journal written after it.
+
+    :param directory: Directory the journal segments and snapshots are kept in
+    :param sync_interval: Period in seconds between writes of the buffered records
+    :param snapshot_interval: Period in seconds between snapshots, snapshots are not taken when it's None
+    :param _segment: Number of the journal segment being written
+    :param _buffer: List of the records not written yet, None marks the start of the next segment
+    """
+
+    SEGMENT = re.compile(r'^journal\.(\d+)$')
+    SNAPSHOT = re.compile(r'^snapshot\.(\d+)$')
+
+    def __init__(self, directory, sync_interval=0.05, snapshot_interval=3600):
+        self.directory = directory
+        self.sync_interval = sync_interval
+        self.snapshot_interval = snapshot_interval
+        self._segment = 0
+        self._buffer = []
+        self._file = None
+        self._lock = threading.Lock()
+        self._file_lock = threading.Lock()
+        self._snapshot_lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, name, number):
+        return os.path.join(self.directory, '%s.%d' % (name, number))
+
+    def _files(self, pattern):
+        return sorted(int(match.group(1)) for match in map(pattern.match, os.listdir(self.directory)) if match)
+
+    def apply(self, stock, trade):
+        """
+        Recover the market state, attach the journal to the stocks and trades containers and start background
+        writing and snapshots
+
+        :param stock: Stock container instance
+        :param trade: Trade container instance
+        :return: Started journal writer
+        """
+        self.open(stock, trade)
+        writer = JournalWriter(self, stock, trade)
+        writer.start()
+        return writer
+
+    def open(self, stock, trade):
+        """
+        Recover the market state and attach the journal to the stocks and trades containers, records are written
+        only when the journal is synced
+
+        :param stock: Stock container instance
+        :param trade: Trade container instance
+        :return: Number of replayed records
+        """
+        count = self.recover(stock, trade)
+        self._file = open(self._path('journal', self._segment), 'ab')
+        stock.set_journal(self)
+        trade.set_journal(self)
+        return count
+
+    def close(self):
+        self.sync()
+        self._file.close()
+
+    def recover(self, stock, trade):
+        """
+        Replay the latest snapshot and the journal segments written after it, incomplete record at the end
+        of the last segment is truncated
+
+        :param stock: Stock container instance, journal should not be attached yet
+        :param trade: Trade container instance, journal should not be attached yet
+        :return: Number of replayed records
+        """
+        snapshots = self._files(self.SNAPSHOT)
+        segments = self._files(self.SEGMENT)
+        start = snapshots[-1] if snapshots else 0
+        paths = [self._path('snapshot', start)] if snapshots else []
+        paths.extend(self._path('journal', number) for number in segments if number >= start)
+        count = 0
+        for path in paths:
+            records, size = read_records(path)
+            if size < os.path.getsize(path):
+                with open(path, 'r+b') as f:
+                    f.truncate(size)
+            for kind, payload in records:
+                self._replay(stock, trade, kind, payload)
+            count += len(records)
+        self._segment = max(segments[-1] if segments else 0, start)
+        return count
+
+    def _replay(self, stock, trade, kind, payload):
+        if kind in (TRADE_NS_RECORD, TRADE_RECORD):
+            position, timestamp, price, quantity, side = TRADE.unpack_from(payload)
+            record = TradeStockRecord(timestamp_ns=timestamp * NANOSECONDS if kind == TRADE_RECORD else timestamp,
+                                      symbol=payload[TRADE.size:].decode('utf-8'),
+                                      price=price,
+                                      quantity=quantity)
+            record.indicator = TRADE_SIDES[side]
+            trade.restore(position, record)
+        elif kind == STOCK_RECORD:
+            stock.update(StockRecord.from_json(json.loads(payload)))
+        elif kind == BASE_RECORD:
+            trade.restore(BASE.unpack_from(payload)[0])
+
+    def append(self, record):
+        """
+        Append encoded record to the journal, it is written by the next sync
+
+        :param record: Framed record bytes
+        :return: Nothing
+        """
+        with self._lock:
+            self._buffer.append(record)
+
+    def append_stock(self, stock_record):
+        self.append(encode_stock(stock_record))
+
+    def append_trade(self, position, trade):
+        self.append(encode_trade(position, trade))
+
+    def sync(self):
+        """
+        Write buffered records and flush them to the disk with a single fsync
+
+        :return: Nothing
+        """
+        with self._file_lock:
+            with self._lock:
+                buffer, self._buffer = self._buffer, []
+            chunk = []
+            for record in buffer:
+                if record is not None:
+                    chunk.append(record)
+                    continue
+                self._write(chunk)
+                chunk = []
+                self._file.close()
+                self._file = open(self._path('journal', self._segment_of(self._file.name) + 1), 'ab')
+            self._write(chunk)
+
+    def _segment_of(self, path):
+        return int(self.SEGMENT.match(os.path.basename(path)).group(1))
+
+    def _write(self, chunk):
+        if chunk:
+            self._file.write(b''.join(chunk))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def snapshot(self, stock, trade):
+        """
+        Start new journal segment and write snapshot of the market state at its start, then remove older
+        segments and snapshots. Locks are held only while the segment is switched, trades are copied afterwards.
+
+        :param stock: Stock container instance
+        :param trade: Trade container instance
+        :return: Number of the new segment
+        """
+        with self._snapshot_lock:
+            with stock._lock:
+                with trade._lock:
+                    with self._lock:
+                        # Records made after this point belong to the new segment
+                        self._buffer.append(None)
+                        self._segment += 1
+                        segment = self._segment
+                    stocks = list(stock)
+                    base, count = trade._base, len(trade._trades)
+            self.sync()
+
+            path = self._path('snapshot', segment)
+            with open(path + '.tmp', 'wb') as f:
+                f.write(encode_base(base))
+                f.write(b''.join(encode_stock(st) for st in stocks))
+                chunk = []
+                for position, tr in trade.history(cursor=base):
+                    if position >= base + count:
+                        break
+                    chunk.append(encode_trade(position, tr))
+                    if len(chunk) == trade.HISTORY_CHUNK:
+                        f.write(b''.join(chunk))
+                        chunk = []
+                f.write(b''.join(chunk))
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(path + '.tmp', path)
+
+            for number in self._files(self.SEGMENT):
+                if number < segment:
+                    os.remove(self._path('journal', number))
+            for number in self._files(self.SNAPSHOT):
+                if number < segment:
+                    os.remove(self._path('snapshot', number))
+            return segment
+
+
+class JournalWriter(threading.Thread):
+    """
+    Background thread writing the journal every sync interval and taking snapshots every snapshot interval
+
+    :param journal: Journal instance
+    :param stock: Stock container instance
+    :param trade: Trade container instance
+    """
+
+    def __init__(self, journal, stock, trade):
+        super(JournalWriter, self).__init__(name='journal-writer')
+        self.daemon = True
+        self.journal = journal
+        self.stock = stock
+        self.trade = trade
+        self._stopped = threading.Event()
+
+    def run(self):
+        snapshot_at = time.time() + (self.journal.snapshot_interval or 0)
+        while not self._stopped.wait(self.journal.sync_interval):
+            self.journal.sync()
+            if self.journal.snapshot_interval is not None and time.time() >= snapshot_at:
+                self.journal.snapshot(self.stock, self.trade)
+                snapshot_at = time.time() + self.journal.snapshot_interval
+        self.journal.sync()
+
+    def stop(self):
+        self._stopped.set()
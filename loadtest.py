@@ -0,0 +1,437 @@
+# coding=UTF-8
+
+import argparse
+import errno
+import httplib
+import json
+import logging
+import os
+import random
+import resource
+import select
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from workload import percentile, symbol_name
+
+
+__author__ = 'Konstantin Kolesnikov'
+
+
+SERVERS = ('sync', 'async')
+
+
+def serve(kind, port):
+    """
+    Run the application server in this process until it is killed
+
+    :param kind: 'sync' for the threaded Flask server, 'async' for the event loop server
+    :param port: Port to listen at
+    :return: Nothing
+    """
+    from app import create_app, events
+    app = create_app()
+    # Flask server writes access log line of every request and the event loop server doesn't, the log is
+    # silenced for a fair comparison
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    if kind == 'sync':
+        app.run(port=port, threaded=True)
+    else:
+        from asyncserver import AsyncServer
+        AsyncServer(app, port=port, events=events).serve_forever()
+
+
+def start_server(kind, port, timeout=30):
+    """
+    Start the application server subprocess and wait for it to answer
+
+    :param kind: 'sync' or 'async'
+    :param port: Port to listen at
+    :param timeout: Seconds to wait
+    :return: Server process
+    """
+    process = subprocess.Popen([sys.executable, __file__, '--serve', kind, '--port', str(port)])
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            connection = httplib.HTTPConnection('127.0.0.1', port, timeout=1)
+            connection.request('GET', '/stocks')
+            connection.getresponse().read()
+            connection.close()
+            return process
+        except (socket.error, httplib.HTTPException):
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('%s server has not started in %d seconds' % (kind, timeout))
+
+
+def build_market(port, symbols, trades, seed=0):
+    """
+    Create stocks and trades through the REST API
+
+    :param port: Server port
+    :param symbols: Number of stocks
+    :param trades: Number of trades
+    :param seed: Seed of the random generator
+    :return: List of the stocks symbols
+    """
+    rnd = random.Random(seed)
+    connection = httplib.HTTPConnection('127.0.0.1', port)
+    names = [symbol_name(position) for position in range(symbols)]
+    headers = {'Content-Type': 'application/json'}
+    for name in names:
+        connection.request('POST', '/stocks', json.dumps({'symbol': name, 'price': rnd.uniform(10.0, 1000.0),
+                                                          'type': 'common', 'last_dividend': rnd.randint(0, 20),
+                                                          'par_value': 100}), headers)
+        connection.getresponse().read()
+    records = [{'symbol': rnd.choice(names), 'price': round(rnd.uniform(10.0, 1000.0), 2),
+                'quantity': rnd.randint(1, 1000), 'indicator': rnd.choice(['buy', 'sell'])} for _ in range(trades)]
+    for start in range(0, len(records), 1000):
+        connection.request('POST', '/trades/bulk', json.dumps(records[start:start + 1000]), headers)
+        connection.getresponse().read()
+    connection.close()
+    return names
+
+
+def open_streams(port, count, timeout=30):
+    """
+    Open event streams and wait until the server answers them
+
+    :param port: Server port
+    :param count: Number of the streams
+    :param timeout: Seconds to wait for all the answers
+    :return: Tuple of the list of the answered streams sockets and the number of failed ones
+    """
+    pending = {}
+    poller = select.poll()
+    failed = 0
+    for _ in range(count):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(0)
+        code = sock.connect_ex(('127.0.0.1', port))
+        if code not in (0, errno.EINPROGRESS):
+            sock.close()
+            failed += 1
+            continue
+        pending[sock.fileno()] = [sock, '', False]
+        poller.register(sock, select.POLLOUT)
+    opened = []
+    deadline = time.time() + timeout
+    while pending and time.time() < deadline:
+        for fd, flags in poller.poll(100):
+            state = pending[fd]
+            sock = state[0]
+            if flags & (select.POLLERR | select.POLLHUP) and not flags & select.POLLIN:
+                poller.unregister(fd)
+                del pending[fd]
+                sock.close()
+                failed += 1
+            elif not state[2]:
+                sock.send('GET /events HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n')
+                state[2] = True
+                poller.modify(fd, select.POLLIN)
+            else:
+                try:
+                    state[1] += sock.recv(4096)
+                except socket.error:
+                    state[1] = None
+                if state[1] is None or '\r\n\r\n' in state[1]:
+                    poller.unregister(fd)
+                    del pending[fd]
+                    if state[1] is not None and state[1][:12] in ('HTTP/1.1 200', 'HTTP/1.0 200'):
+                        opened.append(sock)
+                    else:
+                        sock.close()
+                        failed += 1
+    for sock, _, _ in pending.values():
+        sock.close()
+    return opened, failed + len(pending)
+
+
+def delivered(streams, timeout=10):
+    """
+    Count the streams which have received trade event
+
+    :param streams: List of the streams sockets
+    :param timeout: Seconds to wait for the event
+    :return: Number of the streams
+    """
+    poller = select.poll()
+    received = dict((sock.fileno(), '') for sock in streams)
+    sockets = dict((sock.fileno(), sock) for sock in streams)
+    for sock in streams:
+        poller.register(sock, select.POLLIN)
+    count = 0
+    deadline = time.time() + timeout
+    while count < len(streams) and time.time() < deadline:
+        for fd, _ in poller.poll(100):
+            try:
+                chunk = sockets[fd].recv(65536)
+            except socket.error:
+                chunk = ''
+            received[fd] += chunk
+            if 'event: trade' in received[fd]:
+                poller.unregister(fd)
+                count += 1
+            elif not chunk:
+                # Stream closed by the server
+                poller.unregister(fd)
+    return count
+
+
+def measure(port, paths, requests, concurrency):
+    """
+    Send GET requests from concurrent keep-alive connections
+
+    :param port: Server port
+    :param paths: List of the requested paths, they are requested in turn
+    :param requests: Number of requests of every connection
+    :param concurrency: Number of the connections
+    :return: Tuple of the list of the latencies of the successful requests, number of errors and elapsed seconds
+    """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def client(offset):
+        connection = httplib.HTTPConnection('127.0.0.1', port, timeout=30)
+        own = []
+        failed = 0
+        for position in range(requests):
+            started = time.time()
+            try:
+                connection.request('GET', paths[(offset + position) % len(paths)])
+                response = connection.getresponse()
+                response.read()
+                if response.status != 200:
+                    failed += 1
+                    continue
+            except (socket.error, httplib.HTTPException):
+                failed += 1
+                connection.close()
+                connection = httplib.HTTPConnection('127.0.0.1', port, timeout=30)
+                continue
+            own.append(time.time() - started)
+        connection.close()
+        with lock:
+            latencies.extend(own)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=client, args=(offset,)) for offset in range(concurrency)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors[0], time.time() - started
+
+
+def run(kinds, streams_counts, symbols=100, trades=10000, requests=200, concurrency=16, port=5100, seed=0,
+        log=None):
+    """
+    Load every server with the numbers of open event streams and measure the requests latency meanwhile
+
+    :param kinds: List of the servers, 'sync' or 'async'
+    :param streams_counts: List of the numbers of the open event streams
+    :param symbols: Number of stocks of the market
+    :param trades: Number of trades of the market
+    :param requests: Number of requests of every connection
+    :param concurrency: Number of the requesting connections
+    :param port: Port the servers listen at
+    :param seed: Seed of the market
+    :param log: File the results are written to as they are measured
+    :return: List of the results dictionaries
+    """
+    results = []
+    for kind in kinds:
+        process = start_server(kind, port)
+        try:
+            names = build_market(port, symbols, trades, seed=seed)
+            paths = ['/stocks'] + ['/stocks/%s' % name for name in names[:10]]
+            for count in streams_counts:
+                streams, failed = open_streams(port, count)
+                latencies, errors, elapsed = measure(port, paths, requests, concurrency)
+                connection = httplib.HTTPConnection('127.0.0.1', port, timeout=30)
+                connection.request('POST', '/trades', json.dumps({'symbol': names[0], 'price': 10.0, 'quantity': 1,
+                                                                  'indicator': 'buy'}),
+                                   {'Content-Type': 'application/json'})
+                connection.getresponse().read()
+                connection.close()
+                result = {
+                    'server': kind,
+                    'streams': count,
+                    'streams_opened': len(streams),
+                    'streams_failed': failed,
+                    'streams_delivered': delivered(streams),
+                    'requests': len(latencies),
+                    'errors': errors,
+                    'throughput': len(latencies) / elapsed,
+                    'p50': percentile(latencies, 0.5),
+                    'p99': percentile(latencies, 0.99)
+                }
+                for sock in streams:
+                    sock.close()
+                results.append(result)
+                if log is not None:
+                    log.write('%-5s %6d streams: %6d opened %6d delivered  %7.0f req/s  p50 %7.1f ms  p99 %7.1f ms'
+                              '  %d errors\n' % (kind, count, result['streams_opened'], result['streams_delivered'],
+                                                 result['throughput'], (result['p50'] or 0) * 1e3,
+                                                 (result['p99'] or 0) * 1e3, errors))
+                # Closed streams are noticed by the server when it writes to them
+                time.sleep(1)
+        finally:
+            process.terminate()
+            process.wait()
+    return results
+
+
+def build_journal(directory, symbols, trades, seed=0):
+    """
+    Write journal of the market the servers recover on start
+
+    :param directory: Journal directory
+    :param symbols: Number of stocks
+    :param trades: Number of trades
+    :param seed: Seed of the random generator
+    :return: Nothing
+    """
+    from journal import Journal
+    from models import Stock, StockRecord, Trade
+    rnd = random.Random(seed)
+    stock, trade = Stock.get_instance(), Trade.get_instance()
+    journal = Journal(directory)
+    journal.open(stock, trade)
+    names = [symbol_name(position) for position in range(symbols)]
+    for name in names:
+        stock.add(StockRecord(symbol=name, price=rnd.uniform(10.0, 1000.0), type='common',
+                              last_dividend=rnd.randint(0, 20), par_value=100))
+    for start in range(0, trades, 10000):
+        trade.bulk_record([{'symbol': rnd.choice(names), 'price': round(rnd.uniform(10.0, 1000.0), 2),
+                            'quantity': rnd.randint(1, 1000), 'indicator': rnd.choice(['buy', 'sell'])}
+                           for _ in range(min(10000, trades - start))])
+        journal.sync()
+    journal.close()
+
+
+def cold_start(kind, settings, port, timeout=60):
+    """
+    Start the application server subprocess and measure its start
+
+    :param kind: 'sync' or 'async'
+    :param settings: Path of the settings file of the server
+    :param port: Port to listen at
+    :param timeout: Seconds to wait
+    :return: Tuple of seconds till the first successful GET /stocks and till the market is recovered
+    """
+    started = time.time()
+    process = subprocess.Popen([sys.executable, __file__, '--serve', kind, '--port', str(port)],
+                               env=dict(os.environ, SSSM_SETTINGS=settings))
+    answered = None
+    try:
+        while time.time() < started + timeout:
+            try:
+                connection = httplib.HTTPConnection('127.0.0.1', port, timeout=timeout)
+                connection.request('GET', '/stocks')
+                response = connection.getresponse()
+                response.read()
+                connection.close()
+            except (socket.error, httplib.HTTPException):
+                time.sleep(0.005)
+                continue
+            if response.status == 200:
+                if answered is None:
+                    answered = time.time() - started
+                if response.getheader('X-Market-Recovering') is None:
+                    return answered, time.time() - started
+                # Polling slows the recovery down, the recovery end is measured with 50 ms resolution
+                time.sleep(0.05)
+                continue
+            time.sleep(0.005)
+        raise RuntimeError('%s server has not recovered in %d seconds' % (kind, timeout))
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def run_cold_start(kinds, symbols=100, trades=100000, runs=3, port=5100, log=None):
+    """
+    Measure the server start with the journal recovered before serving and in the background
+
+    :param kinds: List of the servers, 'sync' or 'async'
+    :param symbols: Number of stocks of the recovered market
+    :param trades: Number of trades of the recovered market
+    :param runs: Number of starts of every server and recovery, the fastest one is reported
+    :param port: Port the servers listen at
+    :param log: File the results are written to as they are measured
+    :return: List of the results dictionaries
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        build_journal(os.path.join(directory, 'journal'), symbols, trades)
+        results = []
+        for kind in kinds:
+            for background in (False, True):
+                settings = os.path.join(directory, 'settings%d.py' % background)
+                with open(settings, 'w') as f:
+                    f.write('JOURNAL_PATH = %r\nJOURNAL_SNAPSHOT_INTERVAL = None\nMARKET_BACKGROUND_RECOVERY = %r\n'
+                            % (os.path.join(directory, 'journal'), background))
+                measured = [cold_start(kind, settings, port) for _ in range(runs)]
+                result = {
+                    'server': kind,
+                    'background': background,
+                    'first_stocks': min(answered for answered, _ in measured),
+                    'recovered': min(recovered for _, recovered in measured)
+                }
+                results.append(result)
+                if log is not None:
+                    log.write('%-5s %-10s first GET /stocks %7.0f ms  recovered %7.0f ms\n'
+                              % (kind, 'background' if background else 'blocking', result['first_stocks'] * 1e3,
+                                 result['recovered'] * 1e3))
+        return results
+    finally:
+        shutil.rmtree(directory)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare the Flask server and the event loop server under load')
+    parser.add_argument('--servers', default=','.join(SERVERS), help='Comma separated servers: sync, async')
+    parser.add_argument('--streams', default='0,100,1000,4000', help='Comma separated numbers of event streams')
+    parser.add_argument('--symbols', type=int, default=100, help='Number of stocks of the market')
+    parser.add_argument('--trades', type=int, default=10000, help='Number of trades of the market')
+    parser.add_argument('--requests', type=int, default=200, help='Number of requests of every connection')
+    parser.add_argument('--concurrency', type=int, default=16, help='Number of the requesting connections')
+    parser.add_argument('--port', type=int, default=5100, help='Port the servers listen at')
+    parser.add_argument('--output', help='File the json results are written to')
+    parser.add_argument('--cold-start', action='store_true',
+                        help='Measure the time till the first GET /stocks of the server recovering the journal '
+                             'of the market instead')
+    parser.add_argument('--runs', type=int, default=3, help='Number of starts measured with --cold-start')
+    parser.add_argument('--serve', choices=SERVERS, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.serve:
+        serve(args.serve, args.port)
+        return 0
+    if args.cold_start:
+        results = run_cold_start(args.servers.split(','), symbols=args.symbols, trades=args.trades,
+                                 runs=args.runs, port=args.port, log=sys.stderr)
+    else:
+        # Every stream is a file descriptor of both the load test and the server, which inherits the limit
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        results = run(args.servers.split(','), [int(value) for value in args.streams.split(',')],
+                      symbols=args.symbols, trades=args.trades, requests=args.requests,
+                      concurrency=args.concurrency, port=args.port, log=sys.stderr)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,274 @@
+# coding=UTF-8
+
+import functools
+import threading
+import time
+
+from flask import request, g
+
+from models import Stock, StockAnalytics, Trade
+from orders import MatchingEngine
+
+
+__author__ = 'Konstantin Kolesnikov'
+
+
+# Upper bounds in seconds of the timing histograms buckets
+TIME_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                0.1, 0.25, 0.5, 1.0, 2.5)
+# Upper bounds of the number of trades in the VWSP period of a stock
+WINDOW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000)
+
+# Model operations timed by instrument_models, properties are timed by their getter
+MODEL_OPERATIONS = (
+    (Trade, 'buy'),
+    (Trade, 'sell'),
+    (Trade, 'bulk_record'),
+    (Trade, 'get_trades_for_symbol'),
+    (Trade, 'get_vwsp'),
+    (Trade, 'get_vwsps'),
+    (Trade, 'gbce_index'),
+    (Trade, 'history_chunk'),
+    (Trade, 'get_candles'),
+    (MatchingEngine, 'submit'),
+    (MatchingEngine, 'cancel'),
+    (Stock, 'add'),
+    (Stock, 'update'),
+    (StockAnalytics, '__init__'),
+    (StockAnalytics, 'json')
+)
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    escaped = (unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values)
+    return '{%s}' % ','.join('%s="%s"' % (name, value) for name, value in zip(names, escaped))
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+    """
+    Class represents monotonically increasing value per labels
+
+    :param name: Metric name
+    :param documentation: Metric help text
+    :param labelnames: Tuple of the label names
+    """
+
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, labels=()):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [(self.name, labels, value) for labels, value in values]
+
+
+class Gauge(Counter):
+    """
+    Class represents value which may go up and down, it is usually created by collectors
+    """
+
+    type = 'gauge'
+
+    def set(self, value, labels=()):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(object):
+    """
+    Class represents distribution of the observed values per labels
+
+    :param name: Metric name
+    :param documentation: Metric help text
+    :param labelnames: Tuple of the label names
+    :param buckets: Ascending upper bounds of the buckets, +Inf bucket is added
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=TIME_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, labels=()):
+        with self._lock:
+            counts, total = self._values.get(labels) or ([0] * len(self.buckets), 0)
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[position] += 1
+                    break
+            self._values[labels] = (counts, total + value)
+
+    def samples(self):
+        with self._lock:
+            values = sorted((labels, (list(counts), total)) for labels, (counts, total) in self._values.items())
+        samples = []
+        for labels, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append((self.name + '_bucket', labels + (_number(bound),), cumulative))
+            samples.append((self.name + '_sum', labels, total))
+            samples.append((self.name + '_count', labels, cumulative))
+        return samples
+
+    def labelnames_of(self, sample_name):
+        return self.labelnames + ('le',) if sample_name.endswith('_bucket') else self.labelnames
+
+
+class Registry(object):
+    """
+    Class represents set of metrics rendered in the Prometheus text format. Collectors are called when metrics
+    are rendered, so values which are cheap to read at that time cost nothing meanwhile.
+
+    :param _metrics: List of the registered metrics
+    :param _collectors: List of callables returning the list of metrics
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, documentation, labelnames=()):
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(), buckets=TIME_BUCKETS):
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        """
+        Register callable returning the list of metrics, it is called every time metrics are rendered
+
+        :param collector: Callable without arguments
+        :return: Nothing
+        """
+        self._collectors.append(collector)
+
+    def render(self):
+        """
+        Render all metrics in the Prometheus text exposition format
+
+        :return: Text of the metrics
+        """
+        metrics = list(self._metrics)
+        for collector in self._collectors:
+            metrics.extend(collector())
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.documentation))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                labelnames = metric.labelnames_of(name) if hasattr(metric, 'labelnames_of') else metric.labelnames
+                lines.append('%s%s %s' % (name, _labels(labelnames, labels), _number(value)))
+        return '\n'.join(lines) + '\n'
+
+
+def timed(histogram, operation, function):
+    """
+    Wrap function to observe its duration
+
+    :param histogram: Histogram with 'operation' label
+    :param operation: Operation label value
+    :param function: Function to wrap
+    :return: Wrapped function
+    """
+    labels = (operation,)
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        started = time.time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            histogram.observe(time.time() - started, labels)
+    wrapper.timed = function
+    return wrapper
+
+
+def instrument_models(registry, operations=MODEL_OPERATIONS):
+    """
+    Replace model methods with the timed ones, models which are not instrumented are not slowed down at all.
+    Methods timed already are timed again with the new histogram only.
+
+    :param registry: Registry the histogram is registered in
+    :param operations: Tuple of (class, method or property name) tuples
+    :return: Histogram of the operations duration
+    """
+    histogram = registry.histogram('sssm_operation_seconds', 'Duration of the model operations', ('operation',))
+    for cls, name in operations:
+        operation = '%s.%s' % (cls.__name__, name)
+        attribute = cls.__dict__[name]
+        if isinstance(attribute, property):
+            getter = getattr(attribute.fget, 'timed', attribute.fget)
+            setattr(cls, name, property(timed(histogram, operation, getter), attribute.fset, attribute.fdel,
+                                        attribute.__doc__))
+        else:
+            setattr(cls, name, timed(histogram, operation, getattr(attribute, 'timed', attribute)))
+    return histogram
+
+
+def instrument_app(app, registry):
+    """
+    Time every request of the Flask application per endpoint
+
+    :param app: Flask application
+    :param registry: Registry the metrics are registered in
+    :return: Nothing
+    """
+    requests = registry.counter('sssm_requests_total', 'Number of the handled requests',
+                                ('endpoint', 'method', 'status'))
+    durations = registry.histogram('sssm_request_seconds', 'Duration of the requests handling', ('endpoint',))
+
+    @app.before_request
+    def start_timer():
+        g.metrics_started = time.time()
+
+    @app.after_request
+    def observe_request(response):
+        started = getattr(g, 'metrics_started', None)
+        if started is not None:
+            endpoint = request.endpoint or 'unknown'
+            durations.observe(time.time() - started, (endpoint,))
+            requests.inc(1, (endpoint, request.method, str(response.status_code)))
+        return response
+
+
+def market_collector():
+    """
+    Collect the market state metrics when they are rendered
+
+    :return: List of metrics
+    """
+    stocks = Gauge('sssm_stocks', 'Number of the registered stocks')
+    stocks.set(len(list(Stock.get_instance())))
+    windows = Histogram('sssm_trade_window_trades', 'Number of trades of the stocks in the VWSP period',
+                        buckets=WINDOW_BUCKETS)
+    for size in Trade.get_instance().get_window_sizes().values():
+        windows.observe(size)
+    return [stocks, windows]
@@ -1,7 +1,17 @@
 # coding=UTF-8
 
+import bisect
+import heapq
+import itertools
+import math
 import operator
+import threading
 import time
+from array import array
+from collections import deque
+from fractions import Fraction
+
+from clock import NANOSECONDS, SYSTEM_CLOCK, to_nanoseconds
 
 
 __author__ = 'Konstantin Kolesnikov'
@@ -15,6 +25,35 @@ TRADE_TYPE = {
     'buy': 'Buy',
     'sell': 'Sell'
 }
+TRADE_SIDES = ('Buy', 'Sell')
+VWSP_PERIOD = 5
+# Width in seconds of the candles per resolution
+CANDLE_RESOLUTIONS = {
+    '1s': 1,
+    '1m': 60,
+    '5m': 300,
+    '1h': 3600
+}
+# Number of candles kept per stock and resolution: a day of 1s, a week of 1m, 30 days of 5m and a year of 1h candles
+CANDLE_LIMITS = {
+    '1s': 86400,
+    '1m': 10080,
+    '5m': 8640,
+    '1h': 8760
+}
+
+try:
+    INT64 = array('q').typecode
+except ValueError:
+    # Python 2 arrays don't support 'q', C long is 64 bit on the supported platforms
+    INT64 = 'l'
+# Range of the 64 bit integers trade timestamps and quantities are stored and journaled as
+INT64_MIN = -2 ** 63
+INT64_MAX = 2 ** 63 - 1
+
+# Versions of the stocks and their trades, they start from the current time in microseconds so versions taken
+# before the restart are never repeated
+_versions = itertools.count(int(time.time() * 1000000))
 
 
 class StockRecordExistsError(Exception):
@@ -32,10 +71,134 @@ class StockRecordExistsError(Exception):
     def __str__(self):
         return self.message % self.symbol
 
+    def __reduce__(self):
+        return self.__class__, (self.symbol,)
+
+
+class TradeValidationError(Exception):
+    """
+    Error indicates that trade data is incorrect
+
+    :param errors: Dictionary of error messages per field
+    """
+
+    def __init__(self, errors):
+        super(TradeValidationError, self).__init__('Trade data is incorrect')
+        self.errors = errors
+
+
+def _validate_trade(item, stocks):
+    """
+    Validate trade data the same way TradeRecordForm does
+
+    :param item: Dictionary with 'symbol', 'price', 'quantity' and 'indicator' keys
+    :param stocks: Stock market instance
+    :return: Dictionary of TradeStockRecord arguments or raise TradeValidationError
+    """
+    errors = {}
+    data = {}
+    if not isinstance(item, dict):
+        raise TradeValidationError({'__all__': ['Trade should be an object.']})
+
+    symbol = item.get('symbol')
+    if not symbol:
+        errors['symbol'] = ['This field is required.']
+    elif not isinstance(symbol, basestring) or not 3 <= len(symbol) <= 5:
+        errors['symbol'] = ['Field must be between 3 and 5 characters long.']
+    elif stocks.get_stock_by_symbol(symbol) is None:
+        errors['symbol'] = ['Stock symbol is not registered at the market.']
+    else:
+        data['symbol'] = symbol
+
+    for field, convert, minimum, maximum, message in (('price', float, 0.0, None, 'Not a valid float value'),
+                                                      ('quantity', int, 1, INT64_MAX, 'Not a valid integer value')):
+        value = item.get(field)
+        if not value:
+            errors[field] = ['This field is required.']
+            continue
+        try:
+            value = convert(value)
+        except (TypeError, ValueError, OverflowError):
+            # Infinite float can't be converted to integer
+            errors[field] = [message]
+            continue
+        if math.isnan(value) or math.isinf(value):
+            errors[field] = ['Number must be finite.']
+        elif value < minimum:
+            errors[field] = ['Number must be at least %s.' % minimum]
+        elif maximum is not None and value > maximum:
+            errors[field] = ['Number must be at most %s.' % maximum]
+        else:
+            data[field] = value
+
+    indicator = item.get('indicator')
+    if not indicator:
+        errors['indicator'] = ['This field is required.']
+    elif not isinstance(indicator, basestring) or indicator not in TRADE_TYPE:
+        errors['indicator'] = ['Not a valid choice']
+    else:
+        data['indicator'] = indicator
+
+    if errors:
+        raise TradeValidationError(errors)
+    return data
+
+
+def _validate_trades(items, stocks, clock=SYSTEM_CLOCK):
+    """
+    Validate many trades at once
+
+    :param items: Iterable of dictionaries with 'symbol', 'price', 'quantity' and 'indicator' keys
+    :param stocks: Stock market instance
+    :param clock: Clock the valid trades are stamped by
+    :return: Tuple of the list of valid TradeStockRecord and dictionary of errors per failed item position
+    """
+    records = []
+    errors = {}
+    for position, item in enumerate(items):
+        try:
+            records.append(TradeStockRecord(timestamp_ns=clock.now(), **_validate_trade(item, stocks)))
+        except TradeValidationError as e:
+            errors[position] = e.errors
+    return records, errors
+
+
+def _check_trade(trade):
+    """
+    Check that trade can be stored, sums of the VWSP periods take only finite prices and the columns and
+    the journal take only 64 bit integers
+
+    :param trade: Trade record
+    :return: Nothing or raise ValueError
+    """
+    if math.isnan(trade.price) or math.isinf(trade.price):
+        raise ValueError('Trade price %r is not a finite number' % trade.price)
+    for name in ('timestamp_ns', 'quantity'):
+        value = getattr(trade, name)
+        if not INT64_MIN <= value <= INT64_MAX:
+            raise ValueError('Trade %s %r is out of the 64 bit integer range' % (name, value))
+
+
+def _stock_input(name):
+    """
+    Property of the stock record field the derived fields depend on, setting it calculates them again
+
+    :param name: Field name, the value is kept in the slot of the name prefixed with underscore
+    :return: Property
+    """
+    attribute = '_' + name
+
+    def set_value(self, value):
+        setattr(self, attribute, value)
+        self._derive()
+
+    return property(operator.attrgetter(attribute), set_value)
+
 
 class StockRecord(object):
     """
-    Class represents stock
+    Class represents stock. Dividend yield, P/E ratio and url depend only on the stock fields, so they are
+    calculated when the record is created and every time any field they depend on is set.
 
     :param symbol: Stock symbol
     :param price: Stock symbol price
@@ -43,67 +206,99 @@ class StockRecord(object):
     :param last_dividend: Stock last dividend
     :param fixed_dividend: Stock fixed dividend, applicable only to 'Preferred' stocks
     :param par_value: Stock Par-value
+    :param version: Version of the stock data, it changes every time the stock is updated
+    :param id: Dense integer id of the symbol in SYMBOLS, assigned when the stock is registered
+    :param dividend_yield: Stock dividend yield calculated depending on the stock type
+    :param pe_ratio: Stock P/E ratio
+    :param url: Url of the stock resource
     """
 
+    __slots__ = ('id', '_symbol', '_price', '_type', '_last_dividend', '_fixed_dividend', '_par_value', 'timestamp',
+                 'version', 'dividend_yield', 'pe_ratio', 'url')
+
+    symbol = _stock_input('symbol')
+    price = _stock_input('price')
+    type = _stock_input('type')
+    last_dividend = _stock_input('last_dividend')
+    fixed_dividend = _stock_input('fixed_dividend')
+    par_value = _stock_input('par_value')
+
     def __init__(self, symbol='', price=0.0, type=None, last_dividend=0, fixed_dividend=0.0, par_value=0):
-        self.symbol = symbol
-        self.price = price
-        self.type = STOCK_TYPE.get(type, 'common')
-        self.last_dividend = last_dividend
-        self.fixed_dividend = fixed_dividend
-        self.par_value = par_value
+        self.id = None
+        self._symbol = symbol
+        self._price = price
+        self._type = STOCK_TYPE.get(type, 'common')
+        self._last_dividend = last_dividend
+        self._fixed_dividend = fixed_dividend
+        self._par_value = par_value
         self.timestamp = int(time.time())
+        self.version = next(_versions)
+        self._derive()
 
     def __repr__(self):
         return 'StockRecord <symbol: %s; price: %s; type: %s; last_dividend: %s; fixed_divicdend: %s; par_value: %s>'\
                % (self.symbol, self.price, self.type, self.last_dividend, self.fixed_dividend, self.par_value)
 
+    def __getstate__(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    def _derive(self):
+        # Optional fields left empty (None) give 0.0 like division by zero does
+        try:
+            if self._type == STOCK_TYPE['preferred']:
+                dividend_yield = float(self._last_dividend / self._price)
+            else:
+                dividend_yield = (self._fixed_dividend * self._par_value) / self._price
+        except (TypeError, ZeroDivisionError):
+            dividend_yield = 0.0
+        try:
+            pe_ratio = self._price / dividend_yield
+        except (TypeError, ZeroDivisionError):
+            pe_ratio = 0.0
+        self.dividend_yield = dividend_yield
+        self.pe_ratio = pe_ratio
+        self.url = '/stocks/%s' % self._symbol
+
     def json(self):
+        version = Trade.get_instance().get_versions([self._symbol])[0]
+        return self._json(self.vwsp, version)
+
+    def _json(self, vwsp, trades_version):
         obj = {
-            'symbol': self.symbol,
-            'price': self.price,
-            'type': self.type,
-            'last_dividend': self.last_dividend,
-            'par_value': self.par_value,
+            'symbol': self._symbol,
+            'price': self._price,
+            'type': self._type,
+            'last_dividend': self._last_dividend,
+            'par_value': self._par_value,
             'dividend_yield': self.dividend_yield,
             'pe_ratio': self.pe_ratio,
-            'vwsp': self.vwsp,
+            'vwsp': vwsp,
             'timestamp': self.timestamp,
+            # Version of the stock and its trades, it's greater for the newer state
+            'version': self.version if trades_version is None else max(self.version, trades_version),
             'url': self.url
         }
-        if self.type == STOCK_TYPE['preferred']:
-            obj['fixed_dividend'] = self.fixed_dividend
+        if self._type == STOCK_TYPE['preferred']:
+            obj['fixed_dividend'] = self._fixed_dividend
         return obj
 
-    @property
-    def url(self):
-        return '/stocks/%s' % self.symbol
-
-    @property
-    def dividend_yield(self):
-        """
-        Stock dividend yield property
-
-        :return: dividend yield calculated depending on the stock type
-        """
-        try:
-            if self.type == STOCK_TYPE['preferred']:
-                return float(self.last_dividend / self.price)
-            return (self.fixed_dividend * self.par_value) / self.price
-        except ZeroDivisionError:
-            return 0.0
-
-    @property
-    def pe_ratio(self):
+    @classmethod
+    def from_json(cls, obj):
         """
-        Stock P/E ratio property
+        Restore stock record from its json representation, derived fields are ignored
 
-        :return: P/E ratio calculated for the stock
+        :param obj: Dictionary returned by json method
+        :return: Stock record
         """
-        try:
-            return self.price / self.dividend_yield
-        except ZeroDivisionError:
-            return 0.0
+        stock_record = cls(symbol=obj['symbol'], price=obj['price'], last_dividend=obj['last_dividend'],
+                           fixed_dividend=obj.get('fixed_dividend', 0.0), par_value=obj['par_value'])
+        stock_record.type = obj['type']
+        stock_record.timestamp = obj['timestamp']
+        return stock_record
 
     @property
     def vwsp(self):
@@ -112,18 +307,17 @@ class StockRecord(object):
 
         :return: Volume Weighted Stock Price calculated for the stock
         """
-        trades = Trade.get_instance().get_trades_for_symbol(self.symbol)
-        try:
-            return sum(tr.price * tr.quantity for tr in trades) / sum(tr.quantity for tr in trades)
-        except ZeroDivisionError:
-            return 0.0
+        return Trade.get_instance().get_vwsp(self.symbol)
 
 
 class Stock(object):
     """
     Class represents Stock Market (singleton)
 
-    :param _records: Dictionary includes all stocks added to the server
+    :param _records: Dictionary includes all stocks added to the server, it is never modified but replaced
+                     with the modified copy, so readers always see consistent snapshot without locking. Symbols
+                     of the added stocks get their ids in SYMBOLS.
+    :param _journal: Journal the added and updated stocks are appended to, None when it's not kept
     """
 
     _instance = None
@@ -135,6 +329,8 @@ class Stock(object):
 
     def __init__(self):
         self._records = {}
+        self._journal = None
+        self._lock = threading.Lock()
 
     def __iter__(self):
         for _, v in self._records.iteritems():
@@ -153,36 +349,110 @@ class Stock(object):
         :param stock_record: Stock Record instance to add
         :return: Nothing or raise StockRecordExistsError in case stock is already added to the system
         """
-        if stock_record.symbol in self._records:
-            raise StockRecordExistsError(stock_record.symbol)
-        self._records[stock_record.symbol] = stock_record
+        with self._lock:
+            if stock_record.symbol in self._records:
+                raise StockRecordExistsError(stock_record.symbol)
+            stock_record.id = SYMBOLS.get_id(stock_record.symbol)
+            records = dict(self._records)
+            records[stock_record.symbol] = stock_record
+            self._records = records
+            if self._journal is not None:
+                self._journal.append_stock(stock_record)
 
     def update(self, stock_record):
         """
-        Update stock record registered in the system
+        Update stock record registered in the system, the record may be the registered one modified in place
 
         :param stock_record: Stock Record instance to update
         :return: Nothing
         """
-        self._records[stock_record.symbol] = stock_record
+        with self._lock:
+            stock_record.id = SYMBOLS.get_id(stock_record.symbol)
+            stock_record.version = next(_versions)
+            records = dict(self._records)
+            records[stock_record.symbol] = stock_record
+            self._records = records
+            if self._journal is not None:
+                self._journal.append_stock(stock_record)
+
+    def set_journal(self, journal):
+        """
+        Set journal the added and updated stocks are appended to
+
+        :param journal: Journal instance or None to stop journaling
+        :return: Nothing
+        """
+        with self._lock:
+            self._journal = journal
 
     def get_stock_by_symbol(self, symbol):
         return self._records.get(symbol)
 
+    def analytics(self):
+        """
+        Collect dividend yield, P/E ratio and VWSP of all registered stocks in one pass
+
+        :return: StockAnalytics instance
+        """
+        return StockAnalytics(list(self))
+
+
+class StockAnalytics(object):
+    """
+    Class represents market snapshot with the stocks metrics, dividend yield and P/E ratio are taken from the
+    records and VWSP of all the stocks is read at once
+
+    :param records: List of stock records
+    :param windows: VWSP periods in minutes VWSP is also returned for, they should be maintained by Trade
+    :param versions: List of versions of the stocks trades, they are read before VWSP, so they are never newer
+                     than the VWSP returned
+    :param vwsp: List of the stocks Volume Weighted Stock Price
+    :param vwsp_windows: List of lists of the stocks Volume Weighted Stock Price per window
+    """
+
+    def __init__(self, records, windows=()):
+        self.records = records
+        self.windows = tuple(windows)
+        symbols = [st.symbol for st in records]
+        self.versions = Trade.get_instance().get_versions(symbols)
+        self.vwsp = Trade.get_instance().get_vwsps(symbols)
+        self.vwsp_windows = [Trade.get_instance().get_vwsps(symbols, period) for period in self.windows]
+
+    def __len__(self):
+        return len(self.records)
+
+    def json(self):
+        """
+        Stocks json representation, the same as StockRecord.json returns, with 'vwsp_windows' dictionary of VWSP
+        per window when windows are requested
+
+        :return: List of dictionaries
+        """
+        objs = [st._json(vwsp, version) for st, vwsp, version in zip(self.records, self.vwsp, self.versions)]
+        if self.windows:
+            for position, obj in enumerate(objs):
+                obj['vwsp_windows'] = dict((str(period), vwsps[position])
+                                           for period, vwsps in zip(self.windows, self.vwsp_windows))
+        return objs
+
 
 class TradeStockRecord(object):
     """
     Class represents a trade record
 
-    :param timestamp: Transaction timestamp
+    :param timestamp: Transaction timestamp in seconds, used when timestamp_ns is not specified
     :param indicator: Indicator 'Buy' or 'Sell'
     :param symbol: Stock symbol
     :param price: Traded price
     :param quantity: Shares quantity
+    :param timestamp_ns: Transaction timestamp in nanoseconds, the current time of the system clock when neither
+                         of the timestamps is specified
     """
 
-    def __init__(self, timestamp=None, indicator=None, symbol=None, price=0.0, quantity=0):
-        self.timestamp = timestamp or int(time.time())
+    def __init__(self, timestamp=None, indicator=None, symbol=None, price=0.0, quantity=0, timestamp_ns=None):
+        if timestamp_ns is None:
+            timestamp_ns = to_nanoseconds(timestamp) if timestamp else SYSTEM_CLOCK.now()
+        self.timestamp_ns = timestamp_ns
         self.indicator = TRADE_TYPE.get(indicator, 'buy')
         self.symbol = symbol or ''
         self.price = price
@@ -192,35 +462,720 @@ class TradeStockRecord(object):
         return 'TradeStockRecord <symbol: %s; price: %s; quantity: %s; indicator: %s; timestamp: %s>'\
                % (self.symbol, self.price, self.quantity, self.indicator, self.timestamp)
 
+    @property
+    def timestamp(self):
+        return self.timestamp_ns // NANOSECONDS
+
     def json(self):
         return {
             'timestamp': self.timestamp,
+            'timestamp_ns': self.timestamp_ns,
             'indicator': self.indicator,
             'symbol': self.symbol,
             'price': self.price,
             'quantity': self.quantity
         }
 
+    @classmethod
+    def from_json(cls, obj):
+        """
+        Restore trade record from its json representation
+
+        :param obj: Dictionary returned by json method
+        :return: Trade record
+        """
+        trade = cls(timestamp=obj['timestamp'], symbol=obj['symbol'], price=obj['price'], quantity=obj['quantity'],
+                    timestamp_ns=obj.get('timestamp_ns'))
+        trade.indicator = obj['indicator']
+        return trade
+
+
+class TradeView(object):
+    """
+    Class represents lightweight read-only copy of a trade stored in TradeColumns
+
+    :param timestamp_ns: Transaction timestamp in nanoseconds
+    :param indicator: Indicator 'Buy' or 'Sell'
+    :param symbol: Stock symbol
+    :param price: Traded price
+    :param quantity: Shares quantity
+    """
+
+    __slots__ = ('timestamp_ns', 'indicator', 'symbol', 'price', 'quantity')
+
+    def __init__(self, timestamp_ns, indicator, symbol, price, quantity):
+        self.timestamp_ns = timestamp_ns
+        self.indicator = indicator
+        self.symbol = symbol
+        self.price = price
+        self.quantity = quantity
+
+    def __repr__(self):
+        return 'TradeView <symbol: %s; price: %s; quantity: %s; indicator: %s; timestamp: %s>'\
+               % (self.symbol, self.price, self.quantity, self.indicator, self.timestamp)
+
+    @property
+    def timestamp(self):
+        return self.timestamp_ns // NANOSECONDS
+
+    def json(self):
+        return {
+            'timestamp': self.timestamp,
+            'timestamp_ns': self.timestamp_ns,
+            'indicator': self.indicator,
+            'symbol': self.symbol,
+            'price': self.price,
+            'quantity': self.quantity
+        }
+
+
+class SymbolTable(object):
+    """
+    Class represents interned stock symbols with dense integer ids, ids are never reused
+
+    :param _ids: Dictionary of id per symbol
+    :param _symbols: List of symbols indexed by id
+    :param _lock: Lock guarding registration of the new symbols, registered ones are looked up without locking
+    """
+
+    def __init__(self):
+        self._ids = {}
+        self._symbols = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._symbols)
+
+    def get_id(self, symbol):
+        """
+        Return id of the symbol, symbol is registered when it's met for the first time
+
+        :param symbol: Stock symbol
+        :return: Symbol id
+        """
+        symbol_id = self._ids.get(symbol)
+        if symbol_id is None:
+            with self._lock:
+                symbol_id = self._ids.get(symbol)
+                if symbol_id is None:
+                    # Symbol is appended before its id is published, so readers of the id always find it
+                    self._symbols.append(symbol)
+                    symbol_id = self._ids[symbol] = len(self._symbols) - 1
+        return symbol_id
+
+    def find(self, symbol):
+        """
+        Return id of the registered symbol
+
+        :param symbol: Stock symbol
+        :return: Symbol id or None when the symbol is not registered
+        """
+        return self._ids.get(symbol)
+
+    def get_symbol(self, symbol_id):
+        return self._symbols[symbol_id]
+
+
+# Symbols of the process: stocks get their ids when they are registered, symbols traded without registration
+# (e.g. restored from the journal) when they are traded for the first time
+SYMBOLS = SymbolTable()
+
+
+class TradeList(object):
+    """
+    Class represents list of trade records
+
+    :param timestamps: List of the trades timestamps in nanoseconds
+    :param _trades: List of trade records
+    """
+
+    def __init__(self):
+        self.timestamps = []
+        self._trades = []
+
+    def __len__(self):
+        return len(self._trades)
+
+    def __iter__(self):
+        return iter(self._trades)
+
+    def __getitem__(self, key):
+        return self._trades[key]
+
+    def __delitem__(self, key):
+        del self.timestamps[key]
+        del self._trades[key]
+
+    def append(self, trade):
+        self.timestamps.append(trade.timestamp_ns)
+        self._trades.append(trade)
+
+    def insert(self, position, trade):
+        self.timestamps.insert(position, trade.timestamp_ns)
+        self._trades.insert(position, trade)
+
+
+class TradeColumns(object):
+    """
+    Class represents compact list of trades stored in typed columns, it is a drop-in replacement of TradeList
+    which takes several times less memory per trade. Items are returned as TradeView copies, columns may be used
+    directly for vectorized aggregation.
+
+    :param symbols: Symbol table the symbol ids refer to
+    :param timestamps: Array of the trades timestamps in nanoseconds
+    :param prices: Array of the traded prices
+    :param quantities: Array of the shares quantities
+    :param symbol_ids: Array of the stock symbol ids
+    :param sides: Array of the trade sides, position of the indicator in TRADE_SIDES
+    """
+
+    _side_ids = dict((indicator, side) for side, indicator in enumerate(TRADE_SIDES))
+
+    def __init__(self, symbols):
+        self.symbols = symbols
+        self.timestamps = array(INT64)
+        self.prices = array('d')
+        self.quantities = array(INT64)
+        self.symbol_ids = array('I')
+        self.sides = array('B')
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __iter__(self):
+        for position in range(len(self.timestamps)):
+            yield self._view(position)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self._view(position) for position in range(*key.indices(len(self.timestamps)))]
+        if key < 0:
+            key += len(self.timestamps)
+        if not 0 <= key < len(self.timestamps):
+            raise IndexError('trade index out of range')
+        return self._view(key)
+
+    def __delitem__(self, key):
+        for column in self._columns():
+            del column[key]
+
+    def _view(self, position):
+        return TradeView(timestamp_ns=self.timestamps[position],
+                         indicator=TRADE_SIDES[self.sides[position]],
+                         symbol=self.symbols.get_symbol(self.symbol_ids[position]),
+                         price=self.prices[position],
+                         quantity=self.quantities[position])
+
+    def _columns(self):
+        return self.timestamps, self.prices, self.quantities, self.symbol_ids, self.sides
+
+    def _rollback(self, length, position):
+        # Value out of a column range raises after the previous columns have grown, they are shrunk back, so
+        # the columns always keep the same length
+        for column in self._columns():
+            if len(column) > length:
+                del column[position]
+
+    def append(self, trade):
+        length = len(self.timestamps)
+        try:
+            self.timestamps.append(trade.timestamp_ns)
+            self.prices.append(trade.price)
+            self.quantities.append(trade.quantity)
+            self.symbol_ids.append(self.symbols.get_id(trade.symbol))
+            self.sides.append(self._side_ids.get(trade.indicator, 0))
+        except Exception:
+            self._rollback(length, length)
+            raise
+
+    def insert(self, position, trade):
+        length = len(self.timestamps)
+        try:
+            self.timestamps.insert(position, trade.timestamp_ns)
+            self.prices.insert(position, trade.price)
+            self.quantities.insert(position, trade.quantity)
+            self.symbol_ids.insert(position, self.symbols.get_id(trade.symbol))
+            self.sides.insert(position, self._side_ids.get(trade.indicator, 0))
+        except Exception:
+            self._rollback(length, position)
+            raise
+
+
+class ExactSum(object):
+    """
+    Class represents exact sum of floats. Every float is a fraction with a power of two denominator, so the sum is
+    kept as an integer numerator over the biggest denominator seen, which is much cheaper than summing Fractions.
+
+    :param numerator: Numerator of the sum
+    :param shift: The sum denominator is 2 ** shift
+    """
+
+    __slots__ = ('numerator', 'shift')
+
+    def __init__(self):
+        self.numerator = 0
+        self.shift = 0
+
+    def add(self, value, multiplier=1):
+        """
+        Add value multiplied by an integer
+
+        :param value: Float value
+        :param multiplier: Integer multiplier, negative one subtracts the value
+        :return: Nothing
+        """
+        numerator, denominator = float(value).as_integer_ratio()
+        shift = denominator.bit_length() - 1
+        if shift > self.shift:
+            self.numerator <<= shift - self.shift
+            self.shift = shift
+        self.numerator += (numerator * multiplier) << (self.shift - shift)
+
+    def fraction(self):
+        return Fraction(self.numerator, 1 << self.shift)
+
+    def divide(self, divisor):
+        """
+        Divide the sum by an integer
+
+        :param divisor: Integer divisor, should not be 0
+        :return: Correctly rounded float quotient
+        """
+        return operator.truediv(self.numerator, divisor << self.shift)
+
+
+class SymbolTrades(object):
+    """
+    Class represents trades of a single stock ordered by timestamp
+
+    Besides the trades it maintains the rolling sums of the trades notional and quantity for every VWSP window
+    from the same ordered trades: each window keeps the position of its first trade, so a trade is added to all
+    the windows at once and leaves each of them once, and VWSP of any window is taken from its sums in O(1).
+    Notional sums are exact, so subtracting expired trades never accumulates rounding errors.
+
+    :param trades: Empty TradeList or TradeColumns the trades are stored in
+    :param period: Default VWSP period in minutes
+    :param periods: Other VWSP periods in minutes
+    :param _timestamps: Sorted trades timestamps in nanoseconds, used for bisecting
+    :param _trades: Trades in the same order as timestamps
+    :param _windows: Periods in nanoseconds in ascending order
+    :param _heads: Positions of the first trade inside every period
+    :param _notionals: Sums of price * quantity of the trades inside every period
+    :param _quantities: Sums of quantity of the trades inside every period
+    :param version: Version of the trades, it changes every time VWSP of any period may change
+    """
+
+    def __init__(self, trades=None, period=VWSP_PERIOD, periods=()):
+        self.periods = tuple(sorted(set(periods) | set([period])))
+        self.window = period * 60 * NANOSECONDS
+        self._trades = trades if trades is not None else TradeList()
+        self._timestamps = self._trades.timestamps
+        self._positions = dict((p, position) for position, p in enumerate(self.periods))
+        self._default = self._positions[period]
+        self._windows = [p * 60 * NANOSECONDS for p in self.periods]
+        self._heads = [0] * len(self.periods)
+        self._notionals = [ExactSum() for _ in self.periods]
+        self._quantities = [0] * len(self.periods)
+        self.version = next(_versions)
+
+    def __iter__(self):
+        return iter(self._trades)
+
+    def __len__(self):
+        return len(self._trades)
+
+    def _window(self, period):
+        if period is None:
+            return self._default
+        try:
+            return self._positions[period]
+        except KeyError:
+            raise ValueError('VWSP period %s is not maintained' % period)
+
+    def add(self, trade):
+        """
+        Add trade keeping the timestamp order, trades with equal timestamps keep the order they were added
+
+        :param trade: Trade record to add
+        :return: Nothing
+        """
+        if not self._timestamps or trade.timestamp_ns >= self._timestamps[-1]:
+            position = len(self._timestamps)
+            self._trades.append(trade)
+        else:
+            position = bisect.bisect_right(self._timestamps, trade.timestamp_ns)
+            self._trades.insert(position, trade)
+        added = False
+        for window, head in enumerate(self._heads):
+            if position < head:
+                # Trade is older than already expired ones, it never gets into the period
+                self._heads[window] = head + 1
+                continue
+            self._notionals[window].add(trade.price, trade.quantity)
+            self._quantities[window] += trade.quantity
+            added = True
+        if added:
+            self.version = next(_versions)
+
+    def _expire(self, now):
+        timestamps = self._timestamps
+        expired = False
+        for window, head in enumerate(self._heads):
+            cutoff = now - self._windows[window]
+            if head >= len(timestamps) or timestamps[head] > cutoff:
+                continue
+            notional = self._notionals[window]
+            while head < len(timestamps) and timestamps[head] <= cutoff:
+                trade = self._trades[head]
+                notional.add(trade.price, -trade.quantity)
+                self._quantities[window] -= trade.quantity
+                head += 1
+            self._heads[window] = head
+            expired = True
+        if expired:
+            self.version = next(_versions)
+
+    def version_at(self, now):
+        """
+        Version of the trades inside the VWSP periods ending at specified time
+
+        :param now: Timestamp in nanoseconds the periods end at, should not decrease between the calls
+        :return: Version of the trades
+        """
+        self._expire(now)
+        return self.version
+
+    def window_size(self, now, period=None):
+        """
+        Number of trades inside the VWSP period ending at specified time
+
+        :param now: Timestamp in nanoseconds the period ends at, should not decrease between the calls
+        :param period: VWSP period in minutes, the default one when it's None
+        :return: Number of trades
+        """
+        window = self._window(period)
+        self._expire(now)
+        return len(self._timestamps) - self._heads[window]
+
+    def since(self, timestamp):
+        """
+        Return trades made strictly after specified timestamp
+
+        :param timestamp: Lower bound (exclusive) of the trades timestamp in nanoseconds
+        :return: List of trades
+        """
+        return self._trades[bisect.bisect_right(self._timestamps, timestamp):]
+
+    def trim(self, timestamp, now):
+        """
+        Drop trades made at or before specified timestamp, trades inside any VWSP period are kept
+
+        :param timestamp: Upper bound (inclusive) of the dropped trades timestamp in nanoseconds
+        :param now: Current timestamp in nanoseconds
+        :return: Nothing
+        """
+        self._expire(now)
+        count = min(bisect.bisect_right(self._timestamps, timestamp), min(self._heads))
+        del self._trades[:count]
+        self._heads = [head - count for head in self._heads]
+
+    def vwsp(self, now, period=None):
+        """
+        Volume Weighted Stock Price for the VWSP period ending at specified time
+
+        :param now: Timestamp in nanoseconds the period ends at, should not decrease between the calls
+        :param period: VWSP period in minutes, the default one when it's None
+        :return: Volume Weighted Stock Price or 0.0 if there were no trades in the period
+        """
+        window = self._window(period)
+        self._expire(now)
+        if not self._quantities[window]:
+            return 0.0
+        return self._notionals[window].divide(self._quantities[window])
+
+    def vwsps(self, now):
+        """
+        Volume Weighted Stock Prices for all VWSP periods ending at specified time
+
+        :param now: Timestamp in nanoseconds the periods end at, should not decrease between the calls
+        :return: List of Volume Weighted Stock Prices in the order of periods
+        """
+        self._expire(now)
+        return [notional.divide(quantity) if quantity else 0.0
+                for notional, quantity in zip(self._notionals, self._quantities)]
+
+    def expires_at(self):
+        """
+        Time when the oldest trade of any VWSP period expires
+
+        :return: Timestamp in nanoseconds or None if there are no trades in the VWSP periods
+        """
+        expiries = [self._timestamps[head] + window for head, window in zip(self._heads, self._windows)
+                    if head < len(self._timestamps)]
+        return min(expiries) if expiries else None
+
+
+class CandleSeries(object):
+    """
+    Class represents OHLCV candles of a single stock of the same width ordered by their start, candles are kept
+    in typed columns and updated in place as trades arrive. Trades may arrive out of timestamp order, open and
+    close prices are those of the earliest and the latest trade of the candle.
+
+    :param width: Width of the candles in seconds
+    :param limit: Number of the latest candles kept, older candles are dropped
+    :param starts: Timestamps in seconds the candles start at
+    :param _first: Timestamp in nanoseconds of the trade the open price is taken from
+    :param _last: Timestamp in nanoseconds of the trade the close price is taken from
+    :param _notional: Sum of price * quantity of the candle trades
+    """
+
+    def __init__(self, width, limit):
+        self.width = width
+        self.limit = limit
+        self.starts = array(INT64)
+        self._first = array(INT64)
+        self._last = array(INT64)
+        self._open = array('d')
+        self._high = array('d')
+        self._low = array('d')
+        self._close = array('d')
+        self._volume = array(INT64)
+        self._notional = array('d')
+
+    def __len__(self):
+        return len(self.starts)
+
+    def _columns(self):
+        return (self.starts, self._first, self._last, self._open, self._high, self._low, self._close, self._volume,
+                self._notional)
+
+    def _insert(self, position, start, trade):
+        values = (start, trade.timestamp_ns, trade.timestamp_ns, trade.price, trade.price, trade.price, trade.price,
+                  trade.quantity, trade.price * trade.quantity)
+        for column, value in zip(self._columns(), values):
+            column.insert(position, value)
+
+    def add(self, trade):
+        """
+        Add trade to the candle it falls in
+
+        :param trade: Trade record
+        :return: Nothing
+        """
+        timestamp = trade.timestamp_ns // NANOSECONDS
+        start = timestamp - timestamp % self.width
+        starts = self.starts
+        if not starts or start > starts[-1]:
+            self._insert(len(starts), start, trade)
+            # Dropping candles shifts the columns, so they are dropped in batches
+            if len(starts) >= self.limit + self.limit // 8 + 1:
+                count = len(starts) - self.limit
+                for column in self._columns():
+                    del column[:count]
+            return
+        position = len(starts) - 1 if start == starts[-1] else bisect.bisect_left(starts, start)
+        if starts[position] != start:
+            if position == 0 and len(starts) >= self.limit:
+                # Trade is older than the kept candles
+                return
+            self._insert(position, start, trade)
+            return
+        if trade.timestamp_ns < self._first[position]:
+            self._first[position] = trade.timestamp_ns
+            self._open[position] = trade.price
+        if trade.timestamp_ns >= self._last[position]:
+            self._last[position] = trade.timestamp_ns
+            self._close[position] = trade.price
+        if trade.price > self._high[position]:
+            self._high[position] = trade.price
+        if trade.price < self._low[position]:
+            self._low[position] = trade.price
+        self._volume[position] += trade.quantity
+        self._notional[position] += trade.price * trade.quantity
+
+    def select(self, since=None, until=None, limit=None):
+        """
+        Return candles overlapping specified time range, the range is looked up by bisecting candles starts
+
+        :param since: Lower bound (inclusive) of the time range, candle containing it is returned too
+        :param until: Upper bound (exclusive) of the time range
+        :param limit: Maximum number of the latest candles to return
+        :return: List of dictionaries with 'timestamp' (candle start), 'open', 'high', 'low', 'close', 'volume'
+                 and 'vwap' keys
+        """
+        low = 0 if since is None else bisect.bisect_right(self.starts, since - self.width)
+        high = len(self.starts) if until is None else bisect.bisect_left(self.starts, until)
+        if limit is not None:
+            low = max(low, high - limit)
+        return [{'timestamp': self.starts[position],
+                 'open': self._open[position],
+                 'high': self._high[position],
+                 'low': self._low[position],
+                 'close': self._close[position],
+                 'volume': self._volume[position],
+                 'vwap': self._notional[position] / self._volume[position] if self._volume[position] else 0.0}
+                for position in range(low, high)]
+
+
+class Candles(object):
+    """
+    Class represents OHLCV candles of a single stock for every resolution
+
+    :param _series: Dictionary of candle series per resolution
+    """
+
+    def __init__(self):
+        self._series = dict((resolution, CandleSeries(width, CANDLE_LIMITS[resolution]))
+                            for resolution, width in CANDLE_RESOLUTIONS.items())
+
+    def add(self, trade):
+        for series in self._series.values():
+            series.add(trade)
+
+    def select(self, resolution, since=None, until=None, limit=None):
+        return self._series[resolution].select(since, until, limit)
+
+
+class GBCEIndex(object):
+    """
+    Class represents GBCE All Share Index maintained incrementally
+
+    The index is the geometric mean of VWSP of the stocks calculated in log space, so it never overflows. Stocks with
+    zero VWSP (not traded during the VWSP period) don't participate in the index, index of the market without such
+    stocks is 0.0.
+
+    :param _logs: Array of VWSP logarithms per stock symbol id
+    :param _members: Flags of the stock symbol ids participating in the index
+    :param _count: Number of the stocks participating in the index
+    :param _log_sum: Exact sum of the logarithms
+    """
+
+    def __init__(self):
+        self._logs = array('d')
+        self._members = bytearray()
+        self._count = 0
+        self._log_sum = ExactSum()
+
+    def __len__(self):
+        return self._count
+
+    def update(self, symbol_id, vwsp):
+        """
+        Replace stock contribution to the index
+
+        :param symbol_id: Stock symbol id
+        :param vwsp: Current stock Volume Weighted Stock Price
+        :return: Nothing
+        """
+        if symbol_id >= len(self._members):
+            grow = symbol_id + 1 - len(self._members)
+            self._logs.extend([0.0] * grow)
+            self._members.extend(bytearray(grow))
+        if self._members[symbol_id]:
+            self._log_sum.add(self._logs[symbol_id], -1)
+            self._members[symbol_id] = 0
+            self._count -= 1
+        if vwsp > 0:
+            log = math.log(vwsp)
+            self._logs[symbol_id] = log
+            self._members[symbol_id] = 1
+            self._count += 1
+            self._log_sum.add(log)
+
+    @property
+    def value(self):
+        return self.geometric_mean(self._log_sum.fraction(), self._count)
+
+    def state(self):
+        """
+        Index state which may be combined with states of the other markets
+
+        :return: Tuple of the exact sum of VWSP logarithms and number of the stocks participating in the index
+        """
+        return self._log_sum.fraction(), self._count
+
+    @staticmethod
+    def geometric_mean(log_sum, count):
+        if not count:
+            return 0.0
+        return math.exp(float(log_sum / count))
+
 
 class Trade(object):
     """
-    Class represents container of all trades
+    Class represents container of all trades, it is safe for concurrent use. Trades of each stock are guarded
+    by one of the striped locks, so reading one stock never blocks trading another one. Locks are always acquired
+    in the order: index lock, stripe lock, trades log lock.
 
-    :param _trades: List of all successful trades
+    :param compact_storage: Store trades in compact TradeColumns instead of the list of records
+    :param windows: VWSP periods in minutes VWSP and GBCE index are maintained for, including VWSP_PERIOD
+    :param clock: Clock the trades are stamped by and the VWSP periods end at, SYSTEM_CLOCK by default. VWSP periods
+                  of EventClock end at the latest recorded trade, so recorded trades may be replayed at any speed.
+    :param _trades: Successful trades kept in memory in the order they were made
+    :param _symbols: List of trades ordered by timestamp per stock symbol id (see SYMBOLS), None for the symbols
+                     which were never traded
+    :param _candles: List of OHLCV candles per stock symbol id, they are kept after the trades are compacted
+    :param _positions: List of positions in the trades history per stock symbol id, kept for trades in memory
+    :param _base: Position in the trades history of the first trade kept in memory
+    :param _ordered: Whether trades kept in memory are ordered by timestamp, so time range lookups may bisect
+    :param _inversions: Queue of the ascending positions of the trades in memory made earlier than the previous
+                        trade, trades are ordered when it's empty
+    :param _archive: Archive older trades are moved to by compaction, None when they are dropped
+    :param _archived: Number of trades in the archive, they take the first positions in the trades history
+    :param _journal: Journal the made trades are appended to in the order of their positions, None when it's not kept
+    :param _indexes: Dictionary of GBCE All Share Index per VWSP period, refreshed only for the stocks which VWSP
+                     has changed
+    :param _dirty: Set of stock symbol ids which contribution to the indexes is outdated
+    :param _expiries: Heap of (timestamp in nanoseconds, symbol id) when the oldest trade in any stock VWSP period
+                      expires
+    :param _scheduled: List of expiry timestamp scheduled per stock symbol id
+    :param _expired: Set of stock symbol ids which trades have left VWSP periods since pop_expired was called
+    :param _listeners: List of callbacks called with the list of trades each time trades are made
+    :param _stripes: List of locks guarding trades of the stocks which symbol ids modulo number of locks equal
+                     to the lock position
+    :param _lock: Lock guarding the trades log, symbols positions and archive state
+    :param _index_lock: Lock guarding the GBCE index and its dirty symbols
     """
 
     _instance = None
+    _listeners = []
+
+    HISTORY_CHUNK = 1000
+    STRIPES = 64
 
     def __new__(cls, *args, **kwargs):
         if hasattr(cls, '_instance') and getattr(cls, '_instance') is None:
             cls._instance = super(Trade, cls).__new__(cls, *args, **kwargs)
         return cls._instance
 
-    def __init__(self):
-        self._trades = []
+    def __init__(self, compact_storage=False, windows=(VWSP_PERIOD,), clock=None):
+        self.compact_storage = compact_storage
+        self.windows = tuple(sorted(set(windows) | set([VWSP_PERIOD])))
+        self.clock = clock or SYSTEM_CLOCK
+        self._trades = self._new_trades()
+        self._symbols = []
+        self._candles = []
+        self._positions = []
+        self._base = 0
+        self._ordered = True
+        self._inversions = deque()
+        self._indexes = dict((period, GBCEIndex()) for period in self.windows)
+        self._dirty = set()
+        self._expiries = []
+        self._scheduled = []
+        self._expired = set()
+        self._archive = None
+        self._archived = 0
+        self._journal = None
+        self._stripes = [threading.Lock() for _ in range(self.STRIPES)]
+        self._lock = threading.Lock()
+        self._index_lock = threading.Lock()
+        self._compaction_lock = threading.Lock()
 
     def __iter__(self):
-        for tr in self._trades:
+        with self._lock:
+            trades = list(self._trades)
+        for tr in trades:
             yield tr
 
     @classmethod
@@ -229,14 +1184,149 @@ class Trade(object):
             cls._instance = Trade()
         return cls._instance
 
+    def _stripe(self, symbol_id):
+        return self._stripes[symbol_id % len(self._stripes)]
+
+    def _new_trades(self):
+        if self.compact_storage:
+            return TradeColumns(SYMBOLS)
+        return TradeList()
+
+    def _lookup(self, items, symbol):
+        """
+        Find item of the stock symbol
+
+        :param items: One of the lists indexed by the symbol id
+        :param symbol: Stock symbol
+        :return: Tuple of the symbol id and the item, item is None when the symbol was never traded
+        """
+        symbol_id = SYMBOLS.find(symbol)
+        if symbol_id is None or symbol_id >= len(items):
+            return symbol_id, None
+        return symbol_id, items[symbol_id]
+
+    def _grow(self):
+        # Should be called with the trades log lock acquired, lists are extended before the new ids are used
+        grow = len(SYMBOLS) - len(self._symbols)
+        for items in (self._scheduled, self._positions, self._candles, self._symbols):
+            items.extend([None] * grow)
+
     def _trade(self, symbol, price, quantity, indicator):
         trade = TradeStockRecord(symbol=symbol,
                                  price=price,
                                  quantity=quantity,
-                                 indicator=indicator)
-        self._trades.append(trade)
+                                 indicator=indicator,
+                                 timestamp_ns=self.clock.now())
+        trade = self._record(trade)
+        self._notify([trade])
         return trade
 
+    @classmethod
+    def add_listener(cls, callback):
+        """
+        Register callback to be called with the list of trades each time trades are made, it is kept when
+        trades container is recreated
+
+        :param callback: Callable accepting list of trade records
+        :return: Nothing
+        """
+        cls._listeners.append(callback)
+
+    @classmethod
+    def remove_listener(cls, callback):
+        cls._listeners.remove(callback)
+
+    def _notify(self, trades):
+        for callback in self._listeners:
+            callback(trades)
+
+    def _record(self, trade):
+        return self._record_all([trade])[0]
+
+    def _record_all(self, trades):
+        """
+        Record trades under a single acquisition of the locks: stripe locks of their stocks are taken in the
+        stripes order, then the trades log lock once, so the batch takes consecutive positions and other writers
+        don't interleave with it. The whole batch is checked first, so a bad trade leaves nothing recorded.
+
+        :param trades: List of trade records
+        :return: List of recorded trades, views of the stored ones with compact storage or raise ValueError
+        """
+        for trade in trades:
+            _check_trade(trade)
+        ids = []
+        for trade in trades:
+            self.clock.observe(trade.timestamp_ns)
+            symbol_id = SYMBOLS.get_id(trade.symbol)
+            # Records share the interned symbol instead of keeping their own copies
+            trade.symbol = SYMBOLS.get_symbol(symbol_id)
+            ids.append(symbol_id)
+        # Stripe locks are held while the positions are taken, so positions of every stock are always ascending
+        stripes = [self._stripes[stripe] for stripe in sorted(set(symbol_id % len(self._stripes)
+                                                                  for symbol_id in ids))]
+        for stripe in stripes:
+            stripe.acquire()
+        try:
+            recorded = []
+            with self._lock:
+                if ids and max(ids) >= len(self._positions):
+                    self._grow()
+                timestamps = self._trades.timestamps
+                for trade, symbol_id in zip(trades, ids):
+                    inverted = timestamps and trade.timestamp_ns < timestamps[-1]
+                    self._trades.append(trade)
+                    position = self._base + len(self._trades) - 1
+                    if inverted:
+                        self._inversions.append(position)
+                        self._ordered = False
+                    positions = self._positions[symbol_id]
+                    if positions is None:
+                        positions = self._positions[symbol_id] = array(INT64)
+                    positions.append(position)
+                    if self._journal is not None:
+                        self._journal.append_trade(position, trade)
+                    recorded.append(self._trades[-1] if self.compact_storage else trade)
+            for trade, symbol_id in zip(recorded, ids):
+                trades = self._symbols[symbol_id]
+                if trades is None:
+                    # Candles are set first, readers look the symbol up by its trades
+                    self._candles[symbol_id] = Candles()
+                    trades = self._symbols[symbol_id] = SymbolTrades(self._new_trades(), periods=self.windows)
+                trades.add(trade)
+                self._candles[symbol_id].add(trade)
+        finally:
+            for stripe in reversed(stripes):
+                stripe.release()
+        with self._index_lock:
+            self._dirty.update(ids)
+        return recorded
+
+    def bulk_record(self, items):
+        """
+        Validate and record many trades at once, the batch is recorded under a single acquisition of the locks and
+        derived metrics are recalculated once for the whole batch when they are read
+
+        :param items: Iterable of dictionaries with 'symbol', 'price', 'quantity' and 'indicator' keys
+        :return: Tuple of the list of successful trade records and dictionary of errors per failed item position
+        """
+        records, errors = _validate_trades(items, Stock.get_instance(), self.clock)
+        trades = self._record_all(records)
+        if trades:
+            self._notify(trades)
+        return trades, errors
+
+    def record(self, trades):
+        """
+        Record trades made elsewhere keeping their timestamps, e.g. replayed ones
+
+        :param trades: Iterable of trade records
+        :return: List of recorded trades
+        """
+        recorded = self._record_all(list(trades))
+        if recorded:
+            self._notify(recorded)
+        return recorded
+
     def buy(self, symbol, price, quantity):
         """
         Perform 'Buy' transaction
@@ -259,7 +1349,7 @@ class Trade(object):
         """
         return self._trade(symbol, price, quantity, indicator='sell')
 
-    def get_trades_for_symbol(self, symbol, time_range=5):
+    def get_trades_for_symbol(self, symbol, time_range=VWSP_PERIOD):
         """
         Return list of trades for specified Stock Symbol for the last period (5 minutes by default)
 
@@ -267,19 +1357,349 @@ class Trade(object):
         :param time_range: Period for the trades
         :return: List of trades
         """
-        return [trade for trade in self
-                if trade.symbol == symbol and (trade.timestamp > (int(time.time())-time_range*60))]
+        symbol_id, trades = self._lookup(self._symbols, symbol)
+        if trades is None:
+            return []
+        with self._stripe(symbol_id):
+            return trades.since(self.clock.now() - time_range*60*NANOSECONDS)
+
+    def _check_window(self, period):
+        if period not in self._indexes:
+            raise ValueError('VWSP period %s is not maintained, maintained periods are: %s'
+                             % (period, ', '.join(str(window) for window in self.windows)))
+
+    def get_vwsp(self, symbol, period=VWSP_PERIOD):
+        """
+        Return Volume Weighted Stock Price for specified Stock Symbol for the last VWSP period
+
+        :param symbol: Stock symbol
+        :param period: One of the maintained VWSP periods in minutes
+        :return: Volume Weighted Stock Price or 0.0 if the stock wasn't traded
+        """
+        self._check_window(period)
+        symbol_id, trades = self._lookup(self._symbols, symbol)
+        if trades is None:
+            return 0.0
+        with self._stripe(symbol_id):
+            return trades.vwsp(self.clock.now(), period)
+
+    def get_vwsps(self, symbols, period=VWSP_PERIOD):
+        """
+        Return Volume Weighted Stock Price for each of specified Stock Symbols for the last VWSP period
+
+        :param symbols: List of stock symbols
+        :param period: One of the maintained VWSP periods in minutes
+        :return: List of Volume Weighted Stock Prices
+        """
+        self._check_window(period)
+        now = self.clock.now()
+        vwsps = []
+        for symbol in symbols:
+            symbol_id, trades = self._lookup(self._symbols, symbol)
+            if trades is None:
+                vwsps.append(0.0)
+                continue
+            with self._stripe(symbol_id):
+                vwsps.append(trades.vwsp(now, period))
+        return vwsps
+
+    def get_versions(self, symbols):
+        """
+        Return versions of the trades of specified Stock Symbols, version changes every time VWSP of the stock
+        may change including expiry of its trades
+
+        :param symbols: List of stock symbols
+        :return: List of versions, None for the stocks which were never traded
+        """
+        now = self.clock.now()
+        versions = []
+        for symbol in symbols:
+            symbol_id, trades = self._lookup(self._symbols, symbol)
+            if trades is None:
+                versions.append(None)
+                continue
+            with self._stripe(symbol_id):
+                versions.append(trades.version_at(now))
+        return versions
+
+    def get_candles(self, symbol, resolution, since=None, until=None, limit=None):
+        """
+        Return OHLCV candles of the Stock Symbol, time taken depends on the number of candles returned but not
+        on the number of trades
+
+        :param symbol: Stock symbol
+        :param resolution: One of CANDLE_RESOLUTIONS
+        :param since: Lower bound (inclusive) of the time range, candle containing it is returned too
+        :param until: Upper bound (exclusive) of the time range
+        :param limit: Maximum number of the latest candles to return
+        :return: List of candles ordered by time, see CandleSeries.select
+        """
+        if resolution not in CANDLE_RESOLUTIONS:
+            raise ValueError('Unknown candle resolution \'%s\'' % resolution)
+        symbol_id, candles = self._lookup(self._candles, symbol)
+        if candles is None:
+            return []
+        with self._stripe(symbol_id):
+            return candles.select(resolution, since, until, limit)
+
+    def get_window_sizes(self):
+        """
+        Return number of trades inside the VWSP period of every traded stock
+
+        :return: Dictionary of number of trades per stock symbol
+        """
+        now = self.clock.now()
+        sizes = {}
+        for symbol_id, trades in enumerate(list(self._symbols)):
+            if trades is None:
+                continue
+            with self._stripe(symbol_id):
+                sizes[SYMBOLS.get_symbol(symbol_id)] = trades.window_size(now)
+        return sizes
+
+    def set_archive(self, archive):
+        """
+        Set archive the compacted trades are moved to, it should be set before trading starts as archived trades
+        take the first positions in the trades history
+
+        :param archive: Archive instance or None to drop compacted trades
+        :return: Nothing
+        """
+        with self._lock:
+            self._archive = archive
+            self._archived = len(archive) if archive is not None else 0
+            self._base = max(self._base, self._archived)
+
+    def set_journal(self, journal):
+        """
+        Set journal the made trades are appended to
+
+        :param journal: Journal instance or None to stop journaling
+        :return: Nothing
+        """
+        with self._lock:
+            self._journal = journal
+
+    def restore(self, position, trade=None):
+        """
+        Restore trade replayed from the journal at its position in the trades history, trades which were
+        archived or restored already are skipped
+
+        :param position: Position of the trade in the trades history
+        :param trade: Trade record or None to only move the start of the trades kept in memory to the position
+        :return: Restored trade or None when it was skipped
+        """
+        with self._lock:
+            if position < self._base + len(self._trades):
+                return None
+            if not len(self._trades):
+                self._base = position
+            elif position != self._base + len(self._trades):
+                raise ValueError('Trade position %d doesn\'t follow the trades history' % position)
+        if trade is None:
+            return None
+        return self._record(trade)
+
+    def compact(self, timestamp):
+        """
+        Move trades made at or before specified timestamp out of memory to the archive (or drop them).
+        Trades are written to the archive without holding the lock, so trading is not blocked meanwhile.
+
+        :param timestamp: Upper bound (inclusive) of the compacted trades timestamp in seconds, should be at least
+                          VWSP period in the past
+        :return: Number of trades moved out of memory
+        """
+        timestamp = to_nanoseconds(timestamp)
+        with self._compaction_lock:
+            with self._lock:
+                count = 0
+                timestamps = self._trades.timestamps
+                while count < len(timestamps) and timestamps[count] <= timestamp:
+                    count += 1
+                expired = self._trades[:count]
+            if not expired:
+                return 0
+            if self._archive is not None:
+                self._archive.append(expired)
+            with self._lock:
+                del self._trades[:count]
+                self._base += count
+                for positions in self._positions:
+                    if positions is not None:
+                        del positions[:bisect.bisect_left(positions, self._base)]
+                if self._archive is not None:
+                    self._archived += count
+                # Inversion of the first trade kept doesn't count, its previous trade is compacted
+                while self._inversions and self._inversions[0] <= self._base:
+                    self._inversions.popleft()
+                self._ordered = not self._inversions
+            now = self.clock.now()
+            for symbol_id, trades in enumerate(list(self._symbols)):
+                if trades is None:
+                    continue
+                with self._stripe(symbol_id):
+                    trades.trim(timestamp, now)
+            return count
+
+    def history(self, cursor=0, limit=None, symbol=None, since=None, until=None):
+        """
+        Return trades in the order they were made including archived ones. Trades kept in memory are looked up
+        by the symbol and time range indexes and copied in chunks, so the lock is never held for long.
+
+        :param cursor: Position in the trades history to start from
+        :param limit: Maximum number of trades to return, all of them when None
+        :param symbol: Return only trades of the stock symbol
+        :param since: Return only trades made at or after this timestamp
+        :param until: Return only trades made before this timestamp
+        :return: Iterator of (position, trade) tuples
+        """
+        position = cursor
+        while position is not None and (limit is None or limit > 0):
+            trades, position = self.history_chunk(position, symbol, since, until)
+            for item in trades[:limit]:
+                yield item
+            if limit is not None:
+                limit -= len(trades)
+
+    def history_chunk(self, position, symbol=None, since=None, until=None):
+        """
+        Return next chunk of the trades history, it is limited by HISTORY_CHUNK trades scanned
+
+        :param position: Position in the trades history to start from
+        :param symbol: Return only trades of the stock symbol
+        :param since: Return only trades made at or after this timestamp
+        :param until: Return only trades made before this timestamp
+        :return: Tuple of the list of (position, trade) tuples and position of the next chunk, None for the last one
+        """
+        if since is not None:
+            since = to_nanoseconds(since)
+        if until is not None:
+            until = to_nanoseconds(until)
+
+        def matches(trade):
+            return ((symbol is None or trade.symbol == symbol) and
+                    (since is None or trade.timestamp_ns >= since) and
+                    (until is None or trade.timestamp_ns < until))
+
+        with self._lock:
+            archived, base = self._archived, self._base
+            if position >= archived:
+                return self._memory_chunk(max(position, base), symbol, since, until, matches)
+        # Archive is not indexed, it is read without holding the lock
+        stop = min(position + self.HISTORY_CHUNK, archived)
+        trades = [(position + i, trade) for i, trade in enumerate(self._archive.read(position, stop))
+                  if matches(trade)]
+        return trades, stop
+
+    def _memory_chunk(self, position, symbol, since, until, matches):
+        timestamps = self._trades.timestamps
+        if symbol is not None:
+            positions = self._lookup(self._positions, symbol)[1] or ()
+            start = bisect.bisect_left(positions, position)
+            end = min(start + self.HISTORY_CHUNK, len(positions))
+            trades = [(p, self._trades[p - self._base]) for p in positions[start:end]]
+            return [item for item in trades if matches(item[1])], positions[end] if end < len(positions) else None
+        start = position - self._base
+        stop = len(timestamps)
+        if self._ordered:
+            if since is not None:
+                start = max(start, bisect.bisect_left(timestamps, since))
+            if until is not None:
+                stop = bisect.bisect_left(timestamps, until)
+        end = min(start + self.HISTORY_CHUNK, stop)
+        trades = [(self._base + start + i, trade) for i, trade in enumerate(self._trades[start:end])
+                  if matches(trade)]
+        return trades, end + self._base if end < stop else None
+
+    def _refresh_index(self, now):
+        # Should be called with the index lock acquired
+        while self._expiries and self._expiries[0][0] <= now:
+            expires_at, symbol_id = heapq.heappop(self._expiries)
+            if self._scheduled[symbol_id] == expires_at:
+                self._scheduled[symbol_id] = None
+                self._dirty.add(symbol_id)
+                self._expired.add(symbol_id)
+        stocks = Stock.get_instance()
+        for symbol_id in self._dirty:
+            trades = self._symbols[symbol_id]
+            if trades is None or stocks.get_stock_by_symbol(SYMBOLS.get_symbol(symbol_id)) is None:
+                for index in self._indexes.values():
+                    index.update(symbol_id, 0.0)
+                continue
+            with self._stripe(symbol_id):
+                vwsps = trades.vwsps(now)
+                expires_at = trades.expires_at()
+            for period, vwsp in zip(trades.periods, vwsps):
+                self._indexes[period].update(symbol_id, vwsp)
+            self._schedule_expiry(symbol_id, expires_at)
+        self._dirty.clear()
+
+    def _schedule_expiry(self, symbol_id, expires_at):
+        if expires_at is not None and self._scheduled[symbol_id] != expires_at:
+            self._scheduled[symbol_id] = expires_at
+            heapq.heappush(self._expiries, (expires_at, symbol_id))
+
+    def pop_expired(self):
+        """
+        Refresh the indexes and return the stocks which trades have left VWSP periods since the last call, their
+        VWSP has changed without new trades
+
+        :return: Tuple of the list of stock symbols and timestamp in nanoseconds when the next trade leaves a VWSP
+                 period, None when there are no trades in the periods
+        """
+        now = self.clock.now()
+        with self._index_lock:
+            self._refresh_index(now)
+            expired, self._expired = self._expired, set()
+            expires_at = self._expiries[0][0] if self._expiries else None
+        return [SYMBOLS.get_symbol(symbol_id) for symbol_id in sorted(expired)], expires_at
+
+    def rebuild_index(self):
+        """
+        Recalculate GBCE All Shares indexes from scratch for all traded stocks, stocks which were never traded
+        don't participate in the indexes
+
+        :return: Nothing
+        """
+        with self._index_lock:
+            self._indexes = dict((period, GBCEIndex()) for period in self.windows)
+            self._expiries = []
+            # Scheduled list is emptied in place, trades of the new symbols may extend it meanwhile
+            for symbol_id in range(len(self._scheduled)):
+                self._scheduled[symbol_id] = None
+            self._dirty.update(symbol_id for symbol_id, trades in enumerate(self._symbols) if trades is not None)
+            self._refresh_index(self.clock.now())
 
     @property
     def gbce_index(self):
         """
-        Calculates GBCE All shares index
+        Calculates GBCE All shares index, only stocks traded since the last calculation or which trades
+        have expired are recalculated
 
         :return: GBCE All shares index
         """
-        stocks_vwsp = [Stock.get_instance().get_stock_by_symbol(tr.symbol).vwsp for tr in Trade.get_instance()]
-        try:
-            return (reduce(operator.mul, stocks_vwsp, 1)) ** (1.0/len(stocks_vwsp))
-        except ZeroDivisionError:
-            return 0.0
+        return self.get_gbce_index()
+
+    def get_gbce_index(self, period=VWSP_PERIOD):
+        """
+        Calculates GBCE All shares index of the stocks VWSP for the period
 
+        :param period: One of the maintained VWSP periods in minutes
+        :return: GBCE All shares index
+        """
+        self._check_window(period)
+        with self._index_lock:
+            self._refresh_index(self.clock.now())
+            return self._indexes[period].value
+
+    def get_index_state(self, period=VWSP_PERIOD):
+        """
+        Return GBCE All shares index state, which may be combined with the states of other markets
+
+        :param period: One of the maintained VWSP periods in minutes
+        :return: Tuple of the exact sum of VWSP logarithms and number of the stocks participating in the index
+        """
+        self._check_window(period)
+        with self._index_lock:
+            self._refresh_index(self.clock.now())
+            return self._indexes[period].state()
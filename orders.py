@@ -0,0 +1,351 @@
+# coding=UTF-8
+
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+
+from models import Trade, TradeStockRecord
+
+
+__author__ = 'Konstantin Kolesnikov'
+
+
+ORDER_SIDES = ('buy', 'sell')
+
+
+class Order(object):
+    """
+    Class represents limit order
+
+    :param id: Order id, unique per matching engine
+    :param symbol: Stock symbol
+    :param side: 'buy' or 'sell'
+    :param price: Limit price
+    :param quantity: Shares quantity left to fill, 0 when the order is filled
+    :param filled: Shares quantity filled
+    :param timestamp: Time the order was placed
+    :param cancelled: Whether the order was cancelled
+    """
+
+    __slots__ = ('id', 'symbol', 'side', 'price', 'quantity', 'filled', 'timestamp', 'cancelled')
+
+    def __init__(self, id, symbol, side, price, quantity, timestamp=None):
+        self.id = id
+        self.symbol = symbol
+        self.side = side
+        self.price = price
+        self.quantity = quantity
+        self.filled = 0
+        self.timestamp = timestamp or int(time.time())
+        self.cancelled = False
+
+    def __repr__(self):
+        return 'Order <id: %s; symbol: %s; side: %s; price: %s; quantity: %s; filled: %s>'\
+               % (self.id, self.symbol, self.side, self.price, self.quantity, self.filled)
+
+    def __getstate__(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    @property
+    def status(self):
+        if self.cancelled:
+            return 'cancelled'
+        return 'open' if self.quantity else 'filled'
+
+    def json(self):
+        return {
+            'id': self.id,
+            'symbol': self.symbol,
+            'side': self.side,
+            'price': self.price,
+            'quantity': self.quantity,
+            'filled': self.filled,
+            'timestamp': self.timestamp,
+            'status': self.status
+        }
+
+
+class PriceLevel(object):
+    """
+    Class represents orders of one side of the book at the same price in the time priority
+
+    :param price: Limit price of the orders
+    :param orders: Queue of the orders, cancelled orders are removed lazily
+    :param quantity: Shares quantity left to fill of the level orders
+    :param cancelled: Number of cancelled orders still in the queue
+    """
+
+    __slots__ = ('price', 'orders', 'quantity', 'cancelled')
+
+    def __init__(self, price):
+        self.price = price
+        self.orders = deque()
+        self.quantity = 0
+        self.cancelled = 0
+
+    def __len__(self):
+        return len(self.orders) - self.cancelled
+
+
+class OrderBook(object):
+    """
+    Class represents limit order book of a single stock with the price-time priority. Price levels of each side
+    are kept in a dictionary by price and their prices in a heap, so the best price is found in O(1), new level is
+    added in O(log n) and an order is added to an existing level or cancelled in O(1).
+
+    :param symbol: Stock symbol
+    :param _levels: Dictionary of price levels per price for each side
+    :param _prices: Heap of the prices of each side, buy prices are negated, prices of removed levels are
+                    dropped lazily
+    :param _orders: Dictionary of the open orders per id
+    """
+
+    def __init__(self, symbol):
+        self.symbol = symbol
+        self._levels = {'buy': {}, 'sell': {}}
+        self._prices = {'buy': [], 'sell': []}
+        self._orders = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._orders)
+
+    def get_order(self, order_id):
+        return self._orders.get(order_id)
+
+    def best(self, side):
+        """
+        Return the best price of the side
+
+        :param side: 'buy' or 'sell'
+        :return: The highest buy or the lowest sell price, None when the side is empty
+        """
+        prices, levels = self._prices[side], self._levels[side]
+        while prices:
+            price = -prices[0] if side == 'buy' else prices[0]
+            if price in levels:
+                return price
+            heapq.heappop(prices)
+        return None
+
+    def add(self, order, timestamp_ns=None):
+        """
+        Match the order with the opposite side of the book and keep its unfilled quantity in the book
+
+        :param order: Order to add
+        :param timestamp_ns: Timestamp in nanoseconds the fills are stamped with, the system clock time when None
+        :return: List of fills, trade records made at the prices of the matched orders
+        """
+        fills = self._match(order, timestamp_ns)
+        if order.quantity:
+            levels = self._levels[order.side]
+            level = levels.get(order.price)
+            if level is None:
+                level = levels[order.price] = PriceLevel(order.price)
+                prices = self._prices[order.side]
+                if len(prices) > 2 * len(levels) + 16:
+                    # Drop prices of the removed levels which are not at the top of the heap
+                    prices[:] = [-price if order.side == 'buy' else price for price in levels]
+                    heapq.heapify(prices)
+                else:
+                    heapq.heappush(prices, -order.price if order.side == 'buy' else order.price)
+            level.orders.append(order)
+            level.quantity += order.quantity
+            self._orders[order.id] = order
+        return fills
+
+    def _match(self, order, timestamp_ns):
+        opposite = 'sell' if order.side == 'buy' else 'buy'
+        levels = self._levels[opposite]
+        fills = []
+        while order.quantity:
+            price = self.best(opposite)
+            if price is None or (price > order.price if order.side == 'buy' else price < order.price):
+                break
+            level = levels[price]
+            while order.quantity and level.orders:
+                resting = level.orders[0]
+                if resting.cancelled:
+                    level.orders.popleft()
+                    level.cancelled -= 1
+                    continue
+                quantity = min(order.quantity, resting.quantity)
+                resting.quantity -= quantity
+                resting.filled += quantity
+                order.quantity -= quantity
+                order.filled += quantity
+                level.quantity -= quantity
+                fills.append(TradeStockRecord(symbol=self.symbol, price=price, quantity=quantity,
+                                              indicator=order.side, timestamp_ns=timestamp_ns))
+                if not resting.quantity:
+                    level.orders.popleft()
+                    del self._orders[resting.id]
+            if not level.quantity:
+                del levels[price]
+        return fills
+
+    def cancel(self, order_id):
+        """
+        Cancel open order, it is removed from its price level lazily
+
+        :param order_id: Order id
+        :return: Cancelled order or None when there is no such open order
+        """
+        order = self._orders.pop(order_id, None)
+        if order is None:
+            return None
+        order.cancelled = True
+        levels = self._levels[order.side]
+        level = levels[order.price]
+        level.quantity -= order.quantity
+        level.cancelled += 1
+        if not level.quantity:
+            del levels[order.price]
+        elif level.cancelled > len(level.orders) // 2:
+            level.orders = deque(o for o in level.orders if not o.cancelled)
+            level.cancelled = 0
+        return order
+
+    def _top(self, side, count):
+        # Walk the prices heap from the root in the price order, so only the visited nodes' children are compared
+        # and the best levels are found without sorting the whole side
+        prices, levels = self._prices[side], self._levels[side]
+        candidates = [(prices[0], 0)] if prices else []
+        found = []
+        while candidates and len(found) < count:
+            key, position = heapq.heappop(candidates)
+            price = -key if side == 'buy' else key
+            # Price of a removed level may still be in the heap, also several times when the level was re-added
+            if price in levels and (not found or found[-1] != price):
+                found.append(price)
+            for child in (2 * position + 1, 2 * position + 2):
+                if child < len(prices):
+                    heapq.heappush(candidates, (prices[child], child))
+        return found
+
+    def depth(self, count=10):
+        """
+        Return the best price levels of both sides
+
+        :param count: Maximum number of levels of each side
+        :return: Dictionary with 'bids' and 'asks' lists of dictionaries with 'price', 'quantity' and 'orders' keys
+        """
+        depth = {}
+        for side, name in (('buy', 'bids'), ('sell', 'asks')):
+            levels = self._levels[side]
+            depth[name] = [{'price': price, 'quantity': levels[price].quantity, 'orders': len(levels[price])}
+                           for price in self._top(side, count)]
+        return depth
+
+
+class MatchingEngine(object):
+    """
+    Class represents order books of all stocks (singleton). Fills are recorded as trades, so they update VWSP,
+    GBCE index, candles and the journal the same way as the other trades, orders themselves are kept only
+    in memory.
+
+    :param _books: Dictionary of order books per stock symbol
+    :param _ids: Generator of the order ids
+    """
+
+    _instance = None
+
+    def __new__(cls, *args, **kwargs):
+        if hasattr(cls, '_instance') and getattr(cls, '_instance') is None:
+            cls._instance = super(MatchingEngine, cls).__new__(cls, *args, **kwargs)
+        return cls._instance
+
+    def __init__(self):
+        self._books = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def get_instance(cls):
+        if cls._instance is None:
+            cls._instance = MatchingEngine()
+        return cls._instance
+
+    def _book(self, symbol):
+        book = self._books.get(symbol)
+        if book is None:
+            with self._lock:
+                book = self._books.setdefault(symbol, OrderBook(symbol))
+        return book
+
+    def match(self, symbol, side, price, quantity):
+        """
+        Place limit order and record its fills without notifying the trades listeners
+
+        :param symbol: Stock symbol, the stock should be registered
+        :param side: 'buy' or 'sell'
+        :param price: Limit price
+        :param quantity: Shares quantity
+        :return: Tuple of the order and the list of recorded trades
+        """
+        book = self._book(symbol)
+        trade = Trade.get_instance()
+        with book.lock:
+            with self._lock:
+                order_id = next(self._ids)
+            order = Order(order_id, symbol, side, price, quantity)
+            # Fills are recorded under the book lock, so trades of the stock are recorded in the matching order
+            trades = [trade._record(fill) for fill in book.add(order, trade.clock.now())]
+        return order, trades
+
+    def submit(self, symbol, side, price, quantity):
+        """
+        Place limit order, it is matched with the opposite side of the stock book at the prices of the resting
+        orders and its unfilled quantity is kept in the book
+
+        :param symbol: Stock symbol, the stock should be registered
+        :param side: 'buy' or 'sell'
+        :param price: Limit price
+        :param quantity: Shares quantity
+        :return: Tuple of the order and the list of recorded trades
+        """
+        order, trades = self.match(symbol, side, price, quantity)
+        if trades:
+            Trade.get_instance()._notify(trades)
+        return order, trades
+
+    def cancel(self, symbol, order_id):
+        """
+        Cancel open order
+
+        :param symbol: Stock symbol
+        :param order_id: Order id
+        :return: Cancelled order or None when there is no such open order
+        """
+        book = self._books.get(symbol)
+        if book is None:
+            return None
+        with book.lock:
+            return book.cancel(order_id)
+
+    def get_order(self, symbol, order_id):
+        book = self._books.get(symbol)
+        if book is None:
+            return None
+        with book.lock:
+            return book.get_order(order_id)
+
+    def get_depth(self, symbol, count=10):
+        """
+        Return the best price levels of the stock book
+
+        :param symbol: Stock symbol
+        :param count: Maximum number of levels of each side
+        :return: Dictionary with 'bids' and 'asks' lists, see OrderBook.depth
+        """
+        book = self._books.get(symbol)
+        if book is None:
+            return {'bids': [], 'asks': []}
+        with book.lock:
+            return book.depth(count)
@@ -0,0 +1,453 @@
+# coding=UTF-8
+
+import argparse
+import bisect
+import httplib
+import json
+import random
+import sys
+import threading
+import time
+import urlparse
+from Queue import Queue, Full, Empty
+
+from workload import percentile, symbol_name
+
+
+__author__ = 'Konstantin Kolesnikov'
+
+
+TARGETS = ('models', 'app', 'http')
+PERCENTILES = (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0))
+
+
+class SetupError(Exception):
+    """
+    Error indicates that the target refused to register a stock for other reason than it is registered already
+
+    :param symbol: Stock symbol
+    :param status: Status code of the response
+    :param body: Response body
+    """
+
+    def __init__(self, symbol, status, body):
+        super(SetupError, self).__init__('Stock %s is not registered: %s %s' % (symbol, status, body))
+        self.symbol = symbol
+        self.status = status
+        self.body = body
+
+
+def _trade(item):
+    return {
+        'symbol': item['symbol'],
+        'price': float(item['price']),
+        'quantity': int(item['quantity']),
+        'indicator': item.get('indicator', 'buy').lower(),
+        # Float seconds keep the recorded nanoseconds within a microsecond
+        'timestamp': item['timestamp_ns'] / 1e9 if item.get('timestamp_ns') else float(item.get('timestamp') or 0)
+    }
+
+
+def load_trades(path):
+    """
+    Load recorded trades ordered by timestamp. The file may contain json list of trades in TradeStockRecord.json()
+    shape, GET /trades response or one trade per line (GET /trades?format=ndjson response)
+
+    :param path: File path
+    :return: List of trade dictionaries with 'symbol', 'price', 'quantity', 'indicator' and 'timestamp' keys
+    """
+    with open(path) as f:
+        data = f.read()
+    try:
+        items = json.loads(data)
+    except ValueError:
+        items = [json.loads(line) for line in data.splitlines() if line.strip()]
+    if isinstance(items, dict):
+        items = items['trades']
+    trades = [_trade(item) for item in items]
+    # Sort is stable, so trades of the same timestamp keep their order
+    trades.sort(key=lambda trade: trade['timestamp'])
+    return trades
+
+
+def load_stocks(path):
+    """
+    Load stocks from json list of stocks in StockRecord.json() shape or GET /stocks response, the displayed
+    stock types are mapped back to the types the forms accept
+
+    :param path: File path
+    :return: List of stock dictionaries
+    """
+    from models import STOCK_TYPE
+    types = dict((name, key) for key, name in STOCK_TYPE.items())
+    with open(path) as f:
+        items = json.load(f)
+    stocks = items['stocks'] if isinstance(items, dict) else items
+    return [dict(stock, type=types.get(stock.get('type'), stock.get('type'))) for stock in stocks]
+
+
+def synthetic_trades(symbols, count, rate=1000.0, exponent=1.1, seed=0, start=0.0):
+    """
+    Generate trades of Poisson arrivals at the rate, stocks are picked by Zipf law, so a few stocks make most of
+    the trades like at the market open, and prices of every stock follow geometric random walk
+
+    :param symbols: List of the stocks symbols, the first ones are the most traded
+    :param count: Number of trades
+    :param rate: Mean number of trades per second
+    :param exponent: Zipf exponent, 0 picks stocks uniformly
+    :param seed: Seed of the random generator, the same seed gives the same trades
+    :param start: Timestamp of the first trade
+    :return: List of trade dictionaries ordered by timestamp
+    """
+    rnd = random.Random(seed)
+    cumulative = []
+    total = 0.0
+    for rank in range(1, len(symbols) + 1):
+        total += rank ** -exponent
+        cumulative.append(total)
+    prices = dict((symbol, rnd.uniform(10.0, 1000.0)) for symbol in symbols)
+    trades = []
+    timestamp = start
+    for _ in range(count):
+        symbol = symbols[min(bisect.bisect(cumulative, rnd.random() * total), len(symbols) - 1)]
+        prices[symbol] = max(0.01, prices[symbol] * rnd.lognormvariate(0.0, 0.001))
+        trades.append({'symbol': symbol, 'price': round(prices[symbol], 2), 'quantity': int(10 ** rnd.uniform(0, 3)),
+                       'indicator': rnd.choice(('buy', 'sell')), 'timestamp': timestamp})
+        timestamp += rnd.expovariate(rate)
+    return trades
+
+
+def missing_stocks(trades, stocks=()):
+    """
+    Return stocks to register for the traded symbols which are not among the given stocks
+
+    :param trades: List of trade dictionaries
+    :param stocks: List of the known stock dictionaries
+    :return: List of common stock dictionaries priced at the first trade price
+    """
+    known = set(stock['symbol'] for stock in stocks)
+    missing = []
+    for trade in trades:
+        if trade['symbol'] not in known:
+            known.add(trade['symbol'])
+            missing.append({'symbol': trade['symbol'], 'price': trade['price'], 'type': 'common',
+                            'last_dividend': 0, 'par_value': 100})
+    return missing
+
+
+class ModelsTarget(object):
+    """
+    Class represents the models of this process, trades are recorded without the request validation and
+    serialization
+
+    :param event_time: Record trades with their original timestamps into trades container of the EventClock, so
+                       VWSP periods slide with the replayed trades however fast they are replayed
+    """
+
+    def __init__(self, event_time=False):
+        self.event_time = event_time
+
+    def setup(self, stocks):
+        from models import Stock, StockRecord, StockRecordExistsError, Trade
+        if self.event_time:
+            from clock import EventClock
+            Trade._instance = None
+            Trade(clock=EventClock())
+        for stock in stocks:
+            try:
+                Stock.get_instance().add(StockRecord(symbol=stock['symbol'], price=stock['price'],
+                                                     type=stock['type'], last_dividend=stock.get('last_dividend'),
+                                                     fixed_dividend=stock.get('fixed_dividend'),
+                                                     par_value=stock['par_value']))
+            except StockRecordExistsError:
+                pass
+
+    def submit(self, trades):
+        """
+        Record trades stamped with the current time, or with their own timestamps in the event time
+
+        :param trades: List of trade dictionaries
+        :return: Number of the failed trades
+        """
+        from models import Trade
+        if self.event_time:
+            from clock import to_nanoseconds
+            from models import TradeStockRecord
+            Trade.get_instance().record([TradeStockRecord(timestamp_ns=to_nanoseconds(trade['timestamp']),
+                                                          symbol=trade['symbol'], price=trade['price'],
+                                                          quantity=trade['quantity'], indicator=trade['indicator'])
+                                         for trade in trades])
+            return 0
+        if len(trades) == 1:
+            trade = trades[0]
+            getattr(Trade.get_instance(), trade['indicator'])(trade['symbol'], trade['price'], trade['quantity'])
+            return 0
+        return len(Trade.get_instance().bulk_record(trades)[1])
+
+    def read(self, symbol):
+        """
+        Read the state a client is served
+
+        :param symbol: Stock symbol
+        :return: Tuple of VWSP of the stock and GBCE index
+        """
+        from models import Trade
+        return Trade.get_instance().get_vwsp(symbol), Trade.get_instance().gbce_index
+
+
+class HTTPTarget(object):
+    """
+    Class represents the REST API, either served at the url or called through the Flask test client of this
+    process without network. Every thread uses its own connection.
+
+    :param url: Url of the server, None calls the application of this process
+    """
+
+    def __init__(self, url=None):
+        self.url = urlparse.urlparse(url) if url else None
+        self._local = threading.local()
+
+    def request(self, method, path, data=None, headers=None):
+        """
+        Send request
+
+        :return: Tuple of the status code, dictionary of the response headers and the body
+        """
+        headers = dict(headers or {})
+        body = json.dumps(data) if data is not None else None
+        if body is not None:
+            headers['Content-Type'] = 'application/json'
+        if self.url is None:
+            client = getattr(self._local, 'client', None)
+            if client is None:
+                from app import app
+                client = self._local.client = app.test_client()
+            response = client.open(path, method=method, data=body, headers=headers)
+            return response.status_code, response.headers, response.data
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = httplib.HTTPConnection(self.url.hostname, self.url.port or 80,
+                                                                         timeout=30)
+        try:
+            connection.request(method, self.url.path.rstrip('/') + path, body, headers)
+            response = connection.getresponse()
+            return response.status, dict(response.getheaders()), response.read()
+        except Exception:
+            connection.close()
+            self._local.connection = None
+            raise
+
+    def setup(self, stocks):
+        from models import StockRecordExistsError
+        for stock in stocks:
+            status, _, body = self.request('POST', '/stocks', stock)
+            if status == 201:
+                continue
+            # Stocks registered already are answered with 400 and kept as they are, other errors stop the replay
+            errors = json.loads(body).get('errors') if status == 400 else None
+            if errors != {'symbol': [str(StockRecordExistsError(stock['symbol']))]}:
+                raise SetupError(stock['symbol'], status, body)
+
+    def submit(self, trades):
+        if len(trades) == 1:
+            status, _, _ = self.request('POST', '/trades', trades[0])
+            return 0 if status == 200 else 1
+        status, _, body = self.request('POST', '/trades/bulk', trades)
+        return len(json.loads(body).get('errors') or {}) if status in (200, 400) else len(trades)
+
+    def _get(self, path):
+        # Conditional requests make the unchanged state cost the server nothing but the version check
+        cache = self._local.__dict__.setdefault('cache', {})
+        etag, data = cache.get(path, (None, None))
+        status, headers, body = self.request('GET', path, headers={'If-None-Match': etag} if etag else None)
+        if status == 304:
+            return data
+        data = json.loads(body)
+        cache[path] = (headers.get('ETag') or headers.get('etag'), data)
+        return data
+
+    def read(self, symbol):
+        return self._get('/stocks/%s' % symbol)['stock']['vwsp'], self._get('/stocks')['gbce_index']
+
+
+class Observer(threading.Thread):
+    """
+    Class represents client reading the state of the probed trades' stocks until the trade is reflected in it
+
+    :param target: Target the state is read from
+    :param timeout: Seconds after which the probe is counted as not observed
+    :param vwsp_staleness: List of seconds from the probe acceptance to the change of the stock VWSP
+    :param index_staleness: List of seconds from the probe acceptance to the change of GBCE index
+    :param unobserved: Number of the probes which haven't changed the state before the timeout
+    """
+
+    def __init__(self, target, timeout=1.0):
+        super(Observer, self).__init__()
+        self.daemon = True
+        self.target = target
+        self.timeout = timeout
+        self.probes = Queue(1)
+        self.vwsp_staleness = []
+        self.index_staleness = []
+        self.unobserved = 0
+        self._stopped = threading.Event()
+
+    def probe(self, symbol, before, accepted):
+        """
+        Watch the state after the trade, probes are dropped while the previous one is watched
+
+        :param symbol: Stock symbol of the trade
+        :param before: Tuple of VWSP and index read before the trade was submitted
+        :param accepted: Time the trade was accepted
+        :return: Nothing
+        """
+        try:
+            self.probes.put_nowait((symbol, before, accepted))
+        except Full:
+            pass
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                symbol, (vwsp, index), accepted = self.probes.get(timeout=0.1)
+            except Empty:
+                continue
+            vwsp_seen = index_seen = None
+            while vwsp_seen is None or index_seen is None:
+                current_vwsp, current_index = self.target.read(symbol)
+                now = time.time()
+                if vwsp_seen is None and current_vwsp != vwsp:
+                    vwsp_seen = now
+                    self.vwsp_staleness.append(now - accepted)
+                if index_seen is None and current_index != index:
+                    index_seen = now
+                    self.index_staleness.append(now - accepted)
+                if now - accepted > self.timeout:
+                    self.unobserved += 1
+                    break
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+def _percentiles(values):
+    return dict((name, percentile(values, fraction)) for name, fraction in PERCENTILES)
+
+
+def replay(target, trades, speed=1.0, batch=1, probe_interval=0.1, log=None):
+    """
+    Submit trades to the target keeping the original intervals between them divided by the speed. Trades are
+    stamped with the time they are submitted, so the VWSP period covers them like live trades, unless the target
+    records them in the event time.
+
+    :param target: ModelsTarget or HTTPTarget
+    :param trades: List of trade dictionaries ordered by timestamp
+    :param speed: Multiple of the original speed, 0 submits trades as fast as possible
+    :param batch: Number of trades submitted at once, a batch is submitted when its last trade is due
+    :param probe_interval: Seconds between the trades whose acceptance is watched by the observer
+    :param log: File the progress is written to every second
+    :return: Dictionary of the results: 'trades', 'errors', 'seconds', 'throughput' (trades per second) and
+             percentiles of 'latency' (seconds per submit), 'lag' (seconds behind the schedule), 'vwsp_staleness'
+             and 'index_staleness' (seconds from acceptance to the change of the state read by a client)
+    """
+    observer = Observer(target)
+    observer.start()
+    latencies, lags = [], []
+    errors = 0
+    first = trades[0]['timestamp'] if trades else 0.0
+    started = time.time()
+    next_probe = next_log = started
+    try:
+        for position in range(0, len(trades), batch):
+            chunk = trades[position:position + batch]
+            now = time.time()
+            if speed:
+                due = started + (chunk[-1]['timestamp'] - first) / speed
+                if due > now:
+                    time.sleep(due - now)
+                    now = time.time()
+                lags.append(now - due)
+            before = None
+            if now >= next_probe:
+                next_probe = now + probe_interval
+                before = target.read(chunk[-1]['symbol'])
+            submitted = time.time()
+            errors += target.submit(chunk)
+            accepted = time.time()
+            latencies.append(accepted - submitted)
+            if before is not None:
+                observer.probe(chunk[-1]['symbol'], before, accepted)
+            if log is not None and accepted >= next_log:
+                next_log = accepted + 1.0
+                log.write('%8d trades  %8.0f trades/s\n' % (position + len(chunk),
+                                                           (position + len(chunk)) / max(accepted - started, 1e-9)))
+        elapsed = time.time() - started
+        # Let the last probe finish
+        time.sleep(min(observer.timeout, 0.1))
+    finally:
+        observer.stop()
+    return {
+        'trades': len(trades),
+        'errors': errors,
+        'seconds': elapsed,
+        'throughput': len(trades) / elapsed if elapsed else None,
+        'latency': _percentiles(latencies),
+        'lag': _percentiles(lags),
+        'vwsp_staleness': _percentiles(observer.vwsp_staleness),
+        'index_staleness': _percentiles(observer.index_staleness),
+        'unobserved': observer.unobserved
+    }
+
+
+def _milliseconds(stats):
+    return '  '.join('%s %7.2f ms' % (name, stats[name] * 1e3) for name, _ in PERCENTILES
+                     if stats[name] is not None)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay recorded or synthetic trades to measure ingest capacity')
+    parser.add_argument('trades', nargs='?', help='File of the recorded trades, synthetic trades when omitted')
+    parser.add_argument('--stocks', help='File of the stocks to register, traded symbols are registered anyway')
+    parser.add_argument('--synthetic', type=int, default=100000, help='Number of synthetic trades')
+    parser.add_argument('--symbols', type=int, default=100, help='Number of stocks of the synthetic trades')
+    parser.add_argument('--rate', type=float, default=1000.0, help='Synthetic trades per second')
+    parser.add_argument('--zipf', type=float, default=1.1, help='Zipf exponent of the synthetic stocks popularity')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic trades')
+    parser.add_argument('--speed', type=float, default=1.0, help='Multiple of the original speed, 0 is unpaced')
+    parser.add_argument('--batch', type=int, default=1, help='Trades submitted at once')
+    parser.add_argument('--target', choices=TARGETS, default='models',
+                        help='models and app run in this process, http sends requests to --url')
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help='Server url of the http target')
+    parser.add_argument('--event-time', action='store_true',
+                        help='Keep the trades timestamps, VWSP periods of the models target slide with the trades')
+    parser.add_argument('--output', help='File the json results are written to')
+    args = parser.parse_args(argv)
+    if args.event_time and args.target != 'models':
+        parser.error('--event-time is supported by the models target only')
+
+    if args.trades:
+        trades = load_trades(args.trades)
+    else:
+        trades = synthetic_trades([symbol_name(position) for position in range(args.symbols)], args.synthetic,
+                                  rate=args.rate, exponent=args.zipf, seed=args.seed)
+    stocks = load_stocks(args.stocks) if args.stocks else []
+    if args.target == 'models':
+        target = ModelsTarget(event_time=args.event_time)
+    else:
+        target = HTTPTarget(args.url if args.target == 'http' else None)
+    target.setup(stocks + missing_stocks(trades, stocks))
+
+    results = replay(target, trades, speed=args.speed, batch=args.batch, log=sys.stderr)
+    sys.stderr.write('%d trades in %.1f s: %.0f trades/s, %d errors\n'
+                     % (results['trades'], results['seconds'], results['throughput'] or 0, results['errors']))
+    for name in ('latency', 'lag', 'vwsp_staleness', 'index_staleness'):
+        sys.stderr.write('%-16s %s\n' % (name, _milliseconds(results[name])))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,128 @@
+# coding=UTF-8
+
+import json
+import os
+import threading
+
+from clock import NANOSECONDS
+from models import TradeStockRecord, VWSP_PERIOD
+
+
+__author__ = 'Konstantin Kolesnikov'
+
+
+class RetentionPolicy(object):
+    """
+    Class represents retention policy of the trades log
+
+    :param hot_period: Period in minutes trades are kept in memory, can't be shorter than VWSP period
+    :param archive_path: Path to the file older trades are archived to, they are dropped when it's not defined
+    :param interval: Period in seconds between compactions
+    """
+
+    def __init__(self, hot_period=VWSP_PERIOD, archive_path=None, interval=60):
+        self.hot_period = max(hot_period, VWSP_PERIOD)
+        self.archive_path = archive_path
+        self.interval = interval
+
+    def apply(self, trade):
+        """
+        Attach archive to the trades container and start background compaction
+
+        :param trade: Trade container instance
+        :return: Started compactor
+        """
+        trade.set_archive(TradeArchive(self.archive_path) if self.archive_path else None)
+        compactor = TradeCompactor(trade, self)
+        compactor.start()
+        return compactor
+
+
+class TradeArchive(object):
+    """
+    Class represents append only file of archived trades, one json object per line
+
+    :param path: Path to the archive file
+    :param _offsets: File offsets of every CHECKPOINT-th trade, used to seek when paging
+    :param _count: Number of trades written to the archive
+    """
+
+    CHECKPOINT = 1024
+
+    def __init__(self, path):
+        self.path = path
+        self._offsets = []
+        self._count = 0
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                offset = 0
+                for line in f:
+                    if self._count % self.CHECKPOINT == 0:
+                        self._offsets.append(offset)
+                    offset += len(line)
+                    self._count += 1
+
+    def __len__(self):
+        return self._count
+
+    def append(self, trades):
+        """
+        Append trades to the end of the archive
+
+        :param trades: List of trade records
+        :return: Nothing
+        """
+        with self._lock:
+            with open(self.path, 'ab') as f:
+                offset = f.tell()
+                for trade in trades:
+                    line = json.dumps(trade.json()) + '\n'
+                    if self._count % self.CHECKPOINT == 0:
+                        self._offsets.append(offset)
+                    f.write(line)
+                    offset += len(line)
+                    self._count += 1
+
+    def read(self, start, stop):
+        """
+        Read archived trades
+
+        :param start: Position of the first trade to read
+        :param stop: Position of the trade to stop reading at (exclusive)
+        :return: Iterator of trade records
+        """
+        if start >= stop:
+            return
+        with open(self.path, 'rb') as f:
+            f.seek(self._offsets[start // self.CHECKPOINT])
+            position = start - start % self.CHECKPOINT
+            for line in f:
+                if position >= stop:
+                    break
+                if position >= start:
+                    yield TradeStockRecord.from_json(json.loads(line))
+                position += 1
+
+
+class TradeCompactor(threading.Thread):
+    """
+    Background thread moving trades older than hot period out of memory
+
+    :param trade: Trade container instance
+    :param policy: Retention policy
+    """
+
+    def __init__(self, trade, policy):
+        super(TradeCompactor, self).__init__(name='trade-compactor')
+        self.daemon = True
+        self.trade = trade
+        self.policy = policy
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.policy.interval):
+            self.trade.compact(self.trade.clock.now() // NANOSECONDS - self.policy.hot_period*60)
+
+    def stop(self):
+        self._stopped.set()
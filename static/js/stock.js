@@ -98,6 +98,7 @@ $(function() {
 
         initialize: function() {
             _.bindAll(this, 'render');
+            this.listenTo(this.model, 'change', this.render);
         },
 
         render: function() {
@@ -178,7 +179,8 @@ $(function() {
             var tpl = Handlebars.compile($('#deals_tpl').html()),
                 $placeholder = $('#id_deals_modal');
 
-            this.tradeCollection.fetch();
+            if (!this.live)
+                this.tradeCollection.fetch();
             $placeholder.empty();
             $placeholder.append(tpl({
                 trades: this.tradeCollection.toJSON()
@@ -187,19 +189,74 @@ $(function() {
 
         initialize: function() {
             _.bindAll(this, 'render', 'handleStockModal', 'getCurrentStockValues', 'getRequiredFieldsState',
-                      'updateAddStockButtonState', 'updateAddTradeButtonState', 'updatePriceField', 'submit', 'trade');
+                      'updateAddStockButtonState', 'updateAddTradeButtonState', 'updatePriceField', 'submit', 'trade',
+                      'addStock', 'addTrade');
 
             this.collection = new Stock();
             this.collection.bind('add', this.appendItem);
 
             this.tradeCollection = new Trade();
 
+            // Events are listened to before stocks and trades are fetched, so changes made meanwhile aren't missed
+            this.listen();
             this.render();
         },
 
+        // Apply market events pushed by the server instead of refetching stocks and trades after every action
+        listen: function() {
+            this.live = !_.isUndefined(window.EventSource);
+            if (!this.live)
+                return;
+
+            // Events received before stocks and trades are fetched wait for them
+            this.pending = [];
+            var source = new EventSource('/events');
+            _.each(['trade', 'stock', 'index'], function(event) {
+                source.addEventListener(event, $.proxy(function(e) {
+                    this.applyEvent(event, JSON.parse(e.data));
+                }, this));
+            }, this);
+        },
+
+        applyEvent: function(event, data) {
+            if (this.pending) {
+                this.pending.push([event, data]);
+                return;
+            }
+            if (event === 'trade')
+                this.addTrade(data);
+            else if (event === 'stock')
+                this.addStock(data);
+            else
+                $('#id_gbce').html(parseFloat(data.gbce_index).toFixed(2));
+        },
+
+        applyPending: function() {
+            var pending = this.pending;
+            this.pending = null;
+            _.each(pending, function(item) {
+                // Fetched trades include the trades made before, trades timestamps are unique
+                if (item[0] !== 'trade' || _.isUndefined(this.tradeCollection.findWhere({
+                        timestamp_ns: item[1].timestamp_ns, symbol: item[1].symbol})))
+                    this.applyEvent(item[0], item[1]);
+            }, this);
+        },
+
+        addStock: function(attributes) {
+            var stock = this.collection.getBySymbol(attributes.symbol);
+            if (_.isUndefined(stock))
+                this.collection.add(attributes);
+            // Stock state older than the shown one is dropped
+            else if (!(stock.get('version') > attributes.version))
+                stock.set(attributes);
+        },
+
+        addTrade: function(attributes) {
+            this.tradeCollection.add(attributes);
+        },
+
         render: function() {
-            this.collection.fetch();
-            this.tradeCollection.fetch();
+            $.when(this.collection.fetch(), this.tradeCollection.fetch()).always($.proxy(this.applyPending, this));
 
             this.$el.html(Handlebars.compile($('#stocks_tpl').html())());
             this.$el.find('#id_stocks_list').html(Handlebars.compile($('#stock-table_tpl').html())());
@@ -331,11 +388,12 @@ $(function() {
             console.log('continue');
             var params = this.getCurrentStockValues();
 
-            this.collection.create(params, {
-                wait: true,
-                success: function(model, response) {
+            new StockRecord(params).save(null, {
+                url: this.collection.url,
+                success: $.proxy(function(model, response) {
                     $('#id_stock-record_modal').modal('hide');
-                },
+                    this.addStock(model.attributes);
+                }, this),
                 error: function(model, response) {
                     console.log(model, response);
                     var errors = response.responseJSON.errors;
@@ -364,15 +422,19 @@ $(function() {
             console.log('continue');
             var params = this.getCurrentTradeValues();
 
-            this.tradeCollection.create(params, {
-                wait: true,
+            new TradeRecord(params).save(null, {
+                url: this.tradeCollection.url,
                 success: $.proxy(function(model, response) {
                     $('#id_trade_modal').modal('hide');
+                    $('#id_gbce').html(parseFloat(response.gbce_index).toFixed(2));
+                    // Trade and updated stock are pushed by the server when live updates are available
+                    if (this.live)
+                        return;
+                    this.addTrade(model.attributes);
                     var stock = this.collection.getBySymbol(params.symbol);
                     stock.fetch({
                         url: stock.get('url')
                     });
-                    $('#id_gbce').html(parseFloat(response.gbce_index).toFixed(2))
                 }, this),
                 error: function(model, response) {
                     console.log(model, response);
@@ -0,0 +1,328 @@
+# coding=UTF-8
+
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from app import app, create_app, events, ExpiryPublisher, market_ready, setup_market
+from clock import ManualClock, NANOSECONDS
+from journal import Journal
+from models import Stock, StockRecord, Trade, TradeStockRecord, VWSP_PERIOD
+
+
+__author__ = 'Konstantin Kolesnikov'
+
+
+class TestTradesEndpoints(unittest.TestCase):
+
+    def setUp(self):
+        Stock._instance = None
+        Trade._instance = None
+        Stock.get_instance().add(StockRecord(symbol='SYM', price=10.0, type='common', par_value=1))
+        Stock.get_instance().add(StockRecord(symbol='OTH', price=10.0, type='common', par_value=1))
+        self.client = app.test_client()
+
+    def tearDown(self):
+        Stock._instance = None
+        Trade._instance = None
+
+    def post(self, url, data):
+        response = self.client.post(url, data=json.dumps(data), content_type='application/json')
+        return response.status_code, json.loads(response.data)
+
+    def test__trades_pagination(self):
+        for i in range(5):
+            Trade.get_instance().buy('SYM' if i % 2 else 'OTH', 10.0 + i, 1)
+
+        response = json.loads(self.client.get('/trades?limit=2').data)
+        self.assertListEqual([tr['price'] for tr in response['trades']], [10.0, 11.0])
+        self.assertEqual(response['next_cursor'], 2)
+
+        response = json.loads(self.client.get('/trades?limit=2&cursor=%s' % response['next_cursor']).data)
+        self.assertListEqual([tr['price'] for tr in response['trades']], [12.0, 13.0])
+        response = json.loads(self.client.get('/trades?limit=2&cursor=%s' % response['next_cursor']).data)
+        self.assertListEqual([tr['price'] for tr in response['trades']], [14.0])
+        self.assertIsNone(response['next_cursor'])
+
+        response = json.loads(self.client.get('/trades?symbol=SYM').data)
+        self.assertListEqual([tr['price'] for tr in response['trades']], [11.0, 13.0])
+
+    def test__trades_stream(self):
+        for i in range(3):
+            Trade.get_instance().sell('SYM', 10.0 + i, 1)
+
+        response = self.client.get('/trades?limit=2', headers={'Accept': 'application/x-ndjson'})
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        self.assertListEqual([json.loads(line)['price'] for line in response.data.splitlines()], [10.0, 11.0])
+
+        response = self.client.get('/trades?format=ndjson')
+        self.assertEqual(len(response.data.splitlines()), 3)
+
+    def test__bulk_trades(self):
+        status, response = self.post('/trades/bulk', [{'symbol': 'SYM', 'price': 10.0, 'quantity': 1, 'indicator': 'buy'},
+                                                      {'symbol': 'NON', 'price': 10.0, 'quantity': 1, 'indicator': 'buy'}])
+        self.assertEqual(status, 200)
+        self.assertEqual(response['status'], 'error')
+        self.assertEqual(len(response['trades']), 1)
+        self.assertListEqual(response['errors'].keys(), ['1'])
+
+        status, response = self.post('/trades/bulk', {'trades': [{}]})
+        self.assertEqual(status, 400)
+
+    def test__non_finite_numbers_are_refused(self):
+        for fast_validation in (True, False):
+            app.config['FAST_VALIDATION'] = fast_validation
+            try:
+                for url in ('/trades', '/orders'):
+                    for value in ('NaN', 'Infinity', '-Infinity'):
+                        body = '{"symbol": "SYM", "indicator": "buy", "price": %s, "quantity": %s}' % (value, value)
+                        response = self.client.post(url, data=body, content_type='application/json')
+                        self.assertEqual(response.status_code, 400, (url, value, fast_validation))
+            finally:
+                app.config['FAST_VALIDATION'] = True
+        self.assertListEqual(list(Trade.get_instance()), [])
+        self.assertEqual(json.loads(self.client.get('/stocks').data)['gbce_index'], 0.0)
+
+    def test__trade_events(self):
+        self.post('/trades', {'symbol': 'SYM', 'price': 10.0, 'quantity': 1, 'indicator': 'buy'})
+        queue = events.subscribe()
+        try:
+            self.post('/trades/bulk', [{'symbol': 'SYM', 'price': 20.0, 'quantity': 1, 'indicator': 'sell'},
+                                       {'symbol': 'OTH', 'price': 40.0, 'quantity': 1, 'indicator': 'buy'}])
+            messages = []
+            while not queue.empty():
+                event, data = queue.get_nowait().splitlines()[:2]
+                messages.append((event[len('event: '):], json.loads(data[len('data: '):])))
+        finally:
+            events.unsubscribe(queue)
+
+        self.assertListEqual([event for event, _ in messages], ['trade', 'trade', 'stock', 'stock', 'index'])
+        self.assertEqual(messages[0][1]['price'], 20.0)
+        self.assertEqual(messages[2][1]['vwsp'], 15.0)
+        self.assertAlmostEqual(messages[4][1]['gbce_index'], (15.0 * 40.0) ** 0.5, delta=1e-9)
+
+    def test__expiry_events(self):
+        trade = Trade(clock=ManualClock(start=1000 * NANOSECONDS))
+        trade.buy('SYM', 10.0, 1)
+        version = json.loads(self.client.get('/stocks/SYM').data)['stock']['version']
+        self.assertEqual(trade.pop_expired(), ([], (1000 + VWSP_PERIOD * 60) * NANOSECONDS))
+        queue = events.subscribe()
+        publisher = ExpiryPublisher(trade, interval=0.01)
+        publisher.start()
+        try:
+            trade.clock.advance(seconds=VWSP_PERIOD * 60)
+            event, data = queue.get(timeout=5).splitlines()[:2]
+            self.assertEqual(event, 'event: stock')
+            stock = json.loads(data[len('data: '):])
+            self.assertEqual((stock['symbol'], stock['vwsp']), ('SYM', 0.0))
+            self.assertGreater(stock['version'], version, 'Expiry should make newer stock state')
+            self.assertEqual(queue.get(timeout=5).splitlines()[0], 'event: index')
+        finally:
+            publisher.stop()
+            publisher.join()
+            events.unsubscribe(queue)
+
+    def test__candles(self):
+        for timestamp, price in [(3600, 10.0), (3659, 12.0), (3660, 11.0), (7200, 20.0)]:
+            Trade.get_instance()._record(TradeStockRecord(timestamp=timestamp, symbol='SYM', price=price,
+                                                          quantity=1, indicator='buy'))
+
+        response = json.loads(self.client.get('/stocks/SYM/candles?since=3600&until=7200').data)
+        self.assertEqual(response['resolution'], '1m')
+        self.assertListEqual([(c['timestamp'], c['open'], c['close'], c['volume']) for c in response['candles']],
+                             [(3600, 10.0, 12.0, 2), (3660, 11.0, 11.0, 1)])
+
+        response = json.loads(self.client.get('/stocks/SYM/candles?resolution=1h&limit=1').data)
+        self.assertListEqual([(c['timestamp'], c['high'], c['low']) for c in response['candles']],
+                             [(7200, 20.0, 20.0)])
+
+        self.assertEqual(self.client.get('/stocks/SYM/candles?resolution=2m').status_code, 400)
+        self.assertEqual(self.client.get('/stocks/NON/candles').status_code, 404)
+
+
+
+class TestStocksEndpoints(unittest.TestCase):
+
+    def setUp(self):
+        Stock._instance = None
+        Trade._instance = None
+        Stock.get_instance().add(StockRecord(symbol='SYM', price=10.0, type='common', par_value=1))
+        Stock.get_instance().add(StockRecord(symbol='OTH', price=10.0, type='preferred', last_dividend=2,
+                                             fixed_dividend=0.1, par_value=1))
+        self.client = app.test_client()
+
+    def tearDown(self):
+        Stock._instance = None
+        Trade._instance = None
+
+    def test__stocks_are_cached(self):
+        response = self.client.get('/stocks')
+        data = json.loads(response.data)
+        self.assertDictEqual(dict((st['symbol'], st) for st in data['stocks']),
+                             dict((st.symbol, st.json()) for st in Stock.get_instance()))
+        etag = response.headers['ETag']
+
+        response = self.client.get('/stocks', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, '')
+
+        Trade.get_instance().buy('SYM', 20.0, 1)
+        response = self.client.get('/stocks', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertEqual([st['vwsp'] for st in data['stocks'] if st['symbol'] == 'SYM'], [20.0])
+        self.assertAlmostEqual(data['gbce_index'], 20.0, delta=1e-9)
+
+        stock = Stock.get_instance().get_stock_by_symbol('OTH')
+        response = self.client.put('/stocks/OTH', content_type='application/json',
+                                   data=json.dumps({'symbol': 'OTH', 'price': 20.0, 'type': 'preferred',
+                                                    'last_dividend': 2, 'fixed_dividend': 0.1, 'par_value': 1}))
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(self.client.get('/stocks').data)
+        self.assertEqual([st['price'] for st in data['stocks'] if st['symbol'] == 'OTH'], [20.0])
+        self.assertEqual([st['dividend_yield'] for st in data['stocks'] if st['symbol'] == 'OTH'],
+                         [stock.dividend_yield])
+
+    def test__stock_is_cached(self):
+        response = self.client.get('/stocks/SYM')
+        self.assertDictEqual(json.loads(response.data)['stock'],
+                             Stock.get_instance().get_stock_by_symbol('SYM').json())
+        response = self.client.get('/stocks/SYM', headers={'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+        Stock._instance = None
+        Stock.get_instance().add(StockRecord(symbol='SYM', price=30.0, type='common', par_value=1))
+        self.assertEqual(json.loads(self.client.get('/stocks/SYM').data)['stock']['price'], 30.0,
+                         'Replaced stock should not be served from the cache')
+
+    def test__stocks_windows(self):
+        Trade(windows=(1, 60))
+        now = int(time.time())
+        for seconds_ago, price in [(1800, 40.0), (30, 10.0)]:
+            Trade.get_instance()._record(TradeStockRecord(timestamp=now - seconds_ago, symbol='SYM', price=price,
+                                                          quantity=1, indicator='buy'))
+        Trade.get_instance()._record(TradeStockRecord(timestamp=now - 120, symbol='OTH', price=2.5, quantity=1,
+                                                      indicator='buy'))
+
+        data = json.loads(self.client.get('/stocks?windows=60,1').data)
+        stocks = dict((st['symbol'], st) for st in data['stocks'])
+        self.assertDictEqual(stocks['SYM']['vwsp_windows'], {'1': 10.0, '60': 25.0})
+        self.assertDictEqual(stocks['OTH']['vwsp_windows'], {'1': 0.0, '60': 2.5})
+        self.assertEqual(stocks['SYM']['vwsp'], 10.0)
+        self.assertAlmostEqual(data['gbce_index_windows']['1'], 10.0, delta=1e-9)
+        self.assertAlmostEqual(data['gbce_index_windows']['60'], 25.0 ** 0.5 * 2.5 ** 0.5, delta=1e-9)
+        self.assertNotIn('vwsp_windows', json.loads(self.client.get('/stocks').data)['stocks'][0])
+
+        data = json.loads(self.client.get('/stocks/SYM?windows=60').data)
+        self.assertDictEqual(data['stock']['vwsp_windows'], {'60': 25.0})
+        self.assertEqual(self.client.get('/stocks?windows=15').status_code, 400)
+        self.assertEqual(self.client.get('/stocks/SYM?windows=x').status_code, 400)
+
+
+
+class TestMarketRecovery(unittest.TestCase):
+
+    def setUp(self):
+        Stock._instance = None
+        Trade._instance = None
+        self.directory = tempfile.mkdtemp()
+        self.config = dict(app.config)
+        self.client = app.test_client()
+
+    def tearDown(self):
+        market_ready.set()
+        for name in ('journal_writer', 'expiry_publisher'):
+            thread = app.extensions.pop(name, None)
+            if thread is not None:
+                thread.stop()
+                thread.join()
+        app.config.update(self.config)
+        shutil.rmtree(self.directory)
+        Stock._instance = None
+        Trade._instance = None
+
+    def test__changes_are_refused_while_recovering(self):
+        Stock.get_instance().add(StockRecord(symbol='SYM', price=10.0, type='common', par_value=1))
+        market_ready.clear()
+        response = self.client.get('/stocks')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers.get('X-Market-Recovering'), 'true')
+        response = self.client.post('/trades', data=json.dumps({'symbol': 'SYM', 'price': 10.0, 'quantity': 1,
+                                                                'indicator': 'buy'}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers.get('Retry-After'), '1')
+        self.assertListEqual(list(Trade.get_instance()), [])
+
+        market_ready.set()
+        response = self.client.post('/trades', data=json.dumps({'symbol': 'SYM', 'price': 10.0, 'quantity': 1,
+                                                                'indicator': 'buy'}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(response.headers.get('X-Market-Recovering'))
+
+    def test__background_recovery(self):
+        journal = Journal(self.directory)
+        journal.open(Stock.get_instance(), Trade.get_instance())
+        Stock.get_instance().add(StockRecord(symbol='SYM', price=10.0, type='common', par_value=1))
+        Trade.get_instance().buy('SYM', 10.0, 2)
+        journal.close()
+        Stock._instance = None
+        Trade._instance = None
+
+        app.config.update(JOURNAL_PATH=self.directory, JOURNAL_SNAPSHOT_INTERVAL=None)
+        thread = setup_market(background=True)
+        thread.join()
+        self.assertTrue(market_ready.is_set())
+        self.assertEqual(Stock.get_instance().get_stock_by_symbol('SYM').price, 10.0)
+        self.assertListEqual([tr.quantity for tr in Trade.get_instance()], [2])
+
+        app.extensions.pop('journal_writer').stop()
+        Stock._instance = None
+        Trade._instance = None
+        self.assertIs(create_app(background=False), app)
+        self.assertTrue(market_ready.is_set())
+        self.assertListEqual([tr.quantity for tr in Trade.get_instance()], [2])
+
+    def test__create_app_keeps_market(self):
+        Stock.get_instance().add(StockRecord(symbol='SYM', price=10.0, type='common', par_value=1))
+        Trade.get_instance().buy('SYM', 10.0, 1)
+        # Trade instance with recorded trades isn't reinitialized by the first setup either
+        client = create_app(background=False).test_client()
+        trade = Trade.get_instance()
+        self.assertEqual(client.post('/trades', data=json.dumps({'symbol': 'SYM', 'price': 11.0, 'quantity': 2,
+                                                                 'indicator': 'buy'}),
+                                     content_type='application/json').status_code, 200)
+        self.assertIs(create_app(), app)
+        self.assertIs(Trade.get_instance(), trade)
+        self.assertListEqual([tr.quantity for tr in trade], [1, 2])
+        self.assertEqual(trade.get_vwsp('SYM'), 32.0 / 3)
+
+    def test__lazy_imports(self):
+        code = ('import sys; import app; '
+                'sys.stdout.write(",".join(name for name in ("forms", "wtforms", "orders", "metrics", "journal", '
+                '"retention", "backends") if name in sys.modules))')
+        environ = dict(os.environ)
+        environ.pop('SSSM_SETTINGS', None)
+        output = subprocess.check_output([sys.executable, '-c', code], env=environ,
+                                         cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        self.assertEqual(output, '')
+
+    def test__replay_imports(self):
+        # The models target measures the models only, so the replay doesn't load the application
+        code = ('import sys; import replay; '
+                'sys.stdout.write(",".join(name for name in ("app", "flask", "metrics", "orders", "benchmarks", '
+                '"loadtest") if name in sys.modules))')
+        output = subprocess.check_output([sys.executable, '-c', code],
+                                         cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        self.assertEqual(output, '')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,181 @@
+# coding=UTF-8
+
+
+import httplib
+import json
+import socket
+import threading
+import time
+import unittest
+
+from app import app, events
+from asyncserver import AsyncServer
+from loadtest import delivered, measure, open_streams
+from models import Stock, StockRecord, Trade
+
+
+__author__ = 'Konstantin Kolesnikov'
+
+
+class TestAsyncServer(unittest.TestCase):
+
+    def setUp(self):
+        Stock._instance = None
+        Trade._instance = None
+        Stock.get_instance().add(StockRecord(symbol='SYM', price=10.0, type='common', par_value=1))
+        self.server = AsyncServer(app, port=0, workers=1, events=events)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        Stock._instance = None
+        Trade._instance = None
+
+    def connect(self):
+        sock = socket.create_connection(('127.0.0.1', self.server.port))
+        sock.settimeout(5)
+        return sock
+
+    def receive(self, sock, marker):
+        data = ''
+        while marker not in data:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    def test__same_responses(self):
+        connection = httplib.HTTPConnection('127.0.0.1', self.server.port, timeout=5)
+        connection.request('POST', '/trades', json.dumps({'symbol': 'SYM', 'price': 12.0, 'quantity': 2,
+                                                          'indicator': 'buy'}), {'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        self.assertEqual(response.status, 200)
+        self.assertEqual(json.loads(response.read())['trade']['price'], 12.0)
+
+        # Requests of the keep-alive connection return the same json as the Flask application
+        for url in ('/stocks', '/stocks/SYM', '/trades'):
+            connection.request('GET', url)
+            response = connection.getresponse()
+            self.assertEqual(response.getheader('Connection'), 'keep-alive')
+            self.assertDictEqual(json.loads(response.read()), json.loads(app.test_client().get(url).data))
+        connection.request('GET', '/stocks/NON')
+        response = connection.getresponse()
+        self.assertEqual(response.status, 404)
+        response.read()
+        connection.close()
+
+    def test__pipelined_requests(self):
+        sock = self.connect()
+        sock.sendall('GET /stocks/NON HTTP/1.1\r\nHost: x\r\n\r\nGET /stocks/SYM HTTP/1.1\r\nHost: x\r\n'
+                     'Connection: close\r\n\r\n')
+        data = self.receive(sock, '"symbol": "SYM"')
+        self.assertTrue(data.startswith('HTTP/1.1 404'))
+        self.assertIn('HTTP/1.1 200', data)
+        self.assertIn('Connection: close', data)
+        sock.close()
+
+        sock = self.connect()
+        sock.sendall('NONSENSE\r\n\r\n')
+        self.assertTrue(self.receive(sock, '\n\n').startswith('HTTP/1.1 400'))
+        sock.close()
+
+    def serve(self, application):
+        server = AsyncServer(application, port=0, workers=1)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def test__streamed_response(self):
+        produced = []
+        finish = threading.Event()
+
+        def application(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            produced.append('first')
+            yield 'first\n'
+            finish.wait(5)
+            produced.append('last')
+            yield 'last\n'
+
+        sock = socket.create_connection(('127.0.0.1', self.serve(application).port))
+        sock.settimeout(5)
+        sock.sendall('GET / HTTP/1.1\r\nHost: x\r\n\r\n')
+        data = self.receive(sock, 'first\n')
+        self.assertIn('Transfer-Encoding: chunked', data)
+        self.assertNotIn('Content-Length', data)
+        self.assertListEqual(produced, ['first'], 'First bytes should arrive before the response is complete')
+        finish.set()
+        self.assertTrue(self.receive(sock, '0\r\n\r\n').endswith('5\r\nlast\n\r\n0\r\n\r\n'))
+        sock.close()
+
+    def test__streamed_response_window(self):
+        produced = []
+
+        def application(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            for position in range(1000):
+                produced.append(position)
+                yield 'x' * 65536
+
+        sock = socket.create_connection(('127.0.0.1', self.serve(application).port))
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 65536)
+        sock.sendall('GET / HTTP/1.1\r\nHost: x\r\n\r\n')
+        time.sleep(0.5)
+        # Client doesn't read, so the worker stops after the window and the socket buffers are filled
+        self.assertLess(len(produced), 200)
+        sock.close()
+
+    def test__ndjson_export(self):
+        for i in range(2500):
+            Trade.get_instance().buy('SYM', 10.0 + i % 7, 1)
+        connection = httplib.HTTPConnection('127.0.0.1', self.server.port, timeout=5)
+        for _ in range(2):
+            # Keep-alive connection is reused after the chunked response
+            connection.request('GET', '/trades?format=ndjson')
+            response = connection.getresponse()
+            self.assertEqual(response.getheader('Transfer-Encoding'), 'chunked')
+            self.assertEqual(response.read(), app.test_client().get('/trades?format=ndjson').data)
+        connection.close()
+
+    def test__event_streams(self):
+        # Streams are served by the event loop, so the only worker still runs the requests
+        streams = [self.connect() for _ in range(20)]
+        for sock in streams:
+            sock.sendall('GET /events HTTP/1.1\r\nHost: x\r\n\r\n')
+            self.assertIn('Content-Type: text/event-stream', self.receive(sock, '\r\n\r\n'))
+        self.assertEqual(len(events), 1)
+
+        connection = httplib.HTTPConnection('127.0.0.1', self.server.port, timeout=5)
+        connection.request('POST', '/trades', json.dumps({'symbol': 'SYM', 'price': 12.0, 'quantity': 2,
+                                                          'indicator': 'buy'}), {'Content-Type': 'application/json'})
+        self.assertEqual(connection.getresponse().status, 200)
+        connection.close()
+        for sock in streams:
+            data = self.receive(sock, 'event: index')
+            self.assertIn('event: trade\ndata: {"indicator": "Buy", "price": 12.0', data)
+            sock.close()
+
+        # Server unsubscribes when the last stream is closed
+        deadline = time.time() + 5
+        while len(events) and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(events), 0)
+
+    def test__load_test(self):
+        streams, failed = open_streams(self.server.port, 30)
+        self.assertEqual((len(streams), failed), (30, 0))
+        latencies, errors, _ = measure(self.server.port, ['/stocks', '/stocks/SYM'], 5, 4)
+        self.assertEqual((len(latencies), errors), (20, 0))
+        Trade.get_instance().buy('SYM', 10.0, 1)
+        self.assertEqual(delivered(streams, timeout=5), 30)
+        for sock in streams:
+            sock.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
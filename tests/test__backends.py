@@ -0,0 +1,122 @@
+# coding=UTF-8
+
+
+import math
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from multiprocessing import Process
+
+import backends
+from models import Stock, StockRecord, StockRecordExistsError, Trade
+from orders import MatchingEngine
+
+
+__author__ = 'Konstantin Kolesnikov'
+
+
+class TestShardedMarket(unittest.TestCase):
+
+    SHARDS = 3
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addresses = [os.path.join(self.directory, 'shard-%d.sock' % i) for i in range(self.SHARDS)]
+        self.processes = [Process(target=backends.serve, args=(address, 'test'), kwargs={'windows': (1, 60)})
+                          for address in self.addresses]
+        for process in self.processes:
+            process.daemon = True
+            process.start()
+        deadline = time.time() + 10
+        while not all(os.path.exists(address) for address in self.addresses) and time.time() < deadline:
+            time.sleep(0.01)
+        backends.connect(self.addresses, 'test')
+        self.symbols = ['S%02d' % i for i in range(12)]
+        for symbol in self.symbols:
+            Stock.get_instance().add(StockRecord(symbol=symbol, price=1.0, type='common', par_value=1))
+
+    def tearDown(self):
+        Stock._instance = None
+        Trade._instance = None
+        MatchingEngine._instance = None
+        for process in self.processes:
+            process.terminate()
+            process.join()
+        shutil.rmtree(self.directory)
+
+    @staticmethod
+    def dump(history):
+        # Trades are copied from the shards, so they are compared by value
+        return [(position, tr.json()) for position, tr in history]
+
+    def test__stocks_are_sharded(self):
+        self.assertListEqual(sorted(st.symbol for st in Stock.get_instance()), self.symbols)
+        self.assertEqual(Stock.get_instance().get_stock_by_symbol('S05').symbol, 'S05')
+        self.assertIsNone(Stock.get_instance().get_stock_by_symbol('NON'))
+        with self.assertRaises(StockRecordExistsError) as context:
+            Stock.get_instance().add(StockRecord(symbol='S05'))
+        self.assertEqual(str(context.exception), 'Stock symbol \'S05\' is already registered')
+
+    def test__index_agrees_with_single_market(self):
+        for i, symbol in enumerate(self.symbols):
+            Trade.get_instance().buy(symbol, 1.0 + i, 1)
+            Trade.get_instance().sell(symbol, 2.0 + i, 3)
+        trades, errors = Trade.get_instance().bulk_record([{'symbol': 'S01', 'price': 5.0, 'quantity': 2,
+                                                            'indicator': 'buy'},
+                                                           {'symbol': 'NON', 'price': 5.0, 'quantity': 2,
+                                                            'indicator': 'buy'}])
+        self.assertEqual(len(trades), 1)
+        self.assertListEqual(errors.keys(), [1])
+
+        vwsps = [((1.0 + i) + (2.0 + i) * 3) / 4 for i in range(len(self.symbols))]
+        vwsps[1] = (2.0 + 9.0 + 10.0) / 6
+        self.assertListEqual(Trade.get_instance().get_vwsps(self.symbols), vwsps)
+        self.assertEqual(Stock.get_instance().get_stock_by_symbol('S01').vwsp, vwsps[1])
+
+        expected = math.exp(math.fsum(math.log(v) for v in vwsps) / len(vwsps))
+        self.assertAlmostEqual(Trade.get_instance().gbce_index, expected, delta=expected * 1e-12)
+
+        self.assertTupleEqual(Trade.get_instance().windows, (1, 5, 60))
+        self.assertListEqual(Trade.get_instance().get_vwsps(self.symbols, 60), vwsps)
+        self.assertAlmostEqual(Trade.get_instance().get_gbce_index(1), expected, delta=expected * 1e-12)
+
+    def test__orders_are_matched_by_shards(self):
+        engine = MatchingEngine.get_instance()
+        resting, _ = engine.submit('S03', 'sell', 10.0, 5)
+        order, trades = engine.submit('S03', 'buy', 11.0, 2)
+        self.assertEqual(order.status, 'filled')
+        self.assertListEqual([(tr.price, tr.quantity) for tr in trades], [(10.0, 2)])
+        self.assertEqual(Trade.get_instance().get_vwsp('S03'), 10.0)
+        self.assertListEqual(engine.get_depth('S03')['asks'], [{'price': 10.0, 'quantity': 3, 'orders': 1}])
+        self.assertEqual(engine.cancel('S03', resting.id).status, 'cancelled')
+        self.assertIsNone(engine.get_order('S03', resting.id))
+
+    def test__history(self):
+        Trade.HISTORY_CHUNK, chunk = 2, Trade.HISTORY_CHUNK
+        try:
+            for i in range(30):
+                Trade.get_instance().buy(self.symbols[i % len(self.symbols)], 1.0 + i, 1)
+            history = list(Trade.get_instance().history())
+            self.assertEqual(len(history), 30)
+            self.assertListEqual(sorted(tr.price for _, tr in history), [1.0 + i for i in range(30)])
+
+            pages = []
+            cursor = 0
+            while cursor is not None:
+                page = list(Trade.get_instance().history(cursor=cursor, limit=4))
+                pages.extend(page[:3])
+                cursor = page[3][0] if len(page) > 3 else None
+            self.assertListEqual(self.dump(pages), self.dump(history))
+
+            symbol_history = list(Trade.get_instance().history(symbol='S03'))
+            self.assertListEqual([tr.price for _, tr in symbol_history], [4.0, 16.0, 28.0])
+            self.assertListEqual(self.dump(Trade.get_instance().history(cursor=symbol_history[1][0], symbol='S03')),
+                                 self.dump(symbol_history[1:]))
+        finally:
+            Trade.HISTORY_CHUNK = chunk
+
+
+if __name__ == '__main__':
+    unittest.main()
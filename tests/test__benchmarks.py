@@ -0,0 +1,48 @@
+# coding=UTF-8
+
+
+import copy
+import unittest
+
+import benchmarks
+from models import Stock, Trade
+
+
+__author__ = 'Konstantin Kolesnikov'
+
+
+class TestBenchmarks(unittest.TestCase):
+
+    def tearDown(self):
+        Stock._instance = None
+        Trade._instance = None
+
+    def test__synthetic_market(self):
+        names = benchmarks.build_market(30, 500, seed=1)
+        self.assertEqual(len(set(names)), 30)
+        self.assertTrue(all(len(name) == 4 for name in names))
+        self.assertEqual(len(list(Trade.get_instance())), 500)
+        self.assertListEqual(names, benchmarks.build_market(30, 500, seed=1))
+
+    def test__run_and_compare(self):
+        results = benchmarks.run([10, 20], [100, 200], min_time=0.001, repeat=1,
+                                 only=['trade.buy', 'GET /stocks'])
+        self.assertEqual(len(results['results']), 8)
+        self.assertSetEqual(set((s['name'], s['dimension']) for s in results['scaling']),
+                            set([('trade.buy', 'trades'), ('trade.buy', 'symbols'),
+                                 ('GET /stocks', 'trades'), ('GET /stocks', 'symbols')]))
+        self.assertListEqual(benchmarks.compare(results, results), [])
+
+        baseline = copy.deepcopy(results)
+        for result in baseline['results']:
+            result['seconds'] /= 10
+        self.assertEqual(len(benchmarks.compare(results, baseline, threshold=2.0)), 8)
+
+        baseline = copy.deepcopy(results)
+        for curve in baseline['scaling']:
+            curve['exponent'] -= 1
+        self.assertEqual(len(benchmarks.compare(results, baseline, tolerance=0.5)), 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+# coding=UTF-8
+
+
+import time
+import unittest
+
+from clock import EventClock, ManualClock, NANOSECONDS, SystemClock, to_nanoseconds
+from models import Stock, StockRecord, Trade, TradeStockRecord, VWSP_PERIOD
+
+
+__author__ = 'Konstantin Kolesnikov'
+
+
+PERIOD = VWSP_PERIOD * 60 * NANOSECONDS
+
+
+class TestClock(unittest.TestCase):
+
+    def test__system_clock(self):
+        clock = SystemClock()
+        timestamps = [clock.now() for _ in range(10000)]
+        self.assertTrue(all(a < b for a, b in zip(timestamps, timestamps[1:])),
+                        'Timestamps should strictly increase')
+        self.assertAlmostEqual(timestamps[-1] / float(NANOSECONDS), time.time(), delta=1.0)
+
+    def test__manual_clock(self):
+        clock = ManualClock(start=5)
+        self.assertEqual(clock.now(), 5)
+        self.assertEqual(clock.advance(seconds=1, nanoseconds=2), NANOSECONDS + 7)
+        clock.observe(10 * NANOSECONDS)
+        self.assertEqual(clock.now(), NANOSECONDS + 7, 'Manual clock is not moved by the trades')
+        clock.set(3)
+        self.assertEqual(clock.now(), 3)
+        self.assertEqual(to_nanoseconds(1.5), 1500000000)
+
+    def test__event_clock(self):
+        clock = EventClock()
+        clock.observe(20)
+        clock.observe(10)
+        self.assertEqual(clock.now(), 20, 'Late trades don\'t move the time back')
+
+
+class TestTradeClock(unittest.TestCase):
+
+    def setUp(self):
+        Stock._instance = None
+        Trade._instance = None
+        for symbol in ('SYM', 'OTH'):
+            Stock.get_instance().add(StockRecord(symbol=symbol, price=1.0, type='common', par_value=1))
+
+    def tearDown(self):
+        Stock._instance = None
+        Trade._instance = None
+
+    def test__window_edges(self):
+        clock = ManualClock(start=1000 * NANOSECONDS)
+        trade = Trade(clock=clock)
+        first = trade.buy('SYM', 2.0, 1)
+        clock.advance(nanoseconds=1)
+        second = trade.sell('OTH', 8.0, 1)
+        self.assertEqual(second.timestamp_ns - first.timestamp_ns, 1)
+        self.assertAlmostEqual(trade.gbce_index, 4.0, delta=1e-12)
+
+        clock.set(first.timestamp_ns + PERIOD - 1)
+        self.assertEqual(trade.get_trades_for_symbol('SYM'), [first])
+        self.assertAlmostEqual(trade.gbce_index, 4.0, delta=1e-12)
+        clock.advance(nanoseconds=1)
+        self.assertEqual(trade.get_vwsp('SYM'), 0.0, 'Trade made exactly a period ago is expired')
+        self.assertEqual(trade.get_trades_for_symbol('SYM'), [])
+        self.assertAlmostEqual(trade.gbce_index, 8.0, delta=1e-12,
+                               msg='Index should follow the clock without new trades')
+        clock.advance(nanoseconds=1)
+        self.assertEqual(trade.get_vwsp('OTH'), 0.0)
+        self.assertEqual(trade.gbce_index, 0.0)
+
+    def test__bulk_record_is_stamped_by_clock(self):
+        trade = Trade(clock=ManualClock(start=1000 * NANOSECONDS))
+        trades, errors = trade.bulk_record([{'symbol': 'SYM', 'price': 10.0, 'quantity': 2, 'indicator': 'buy'},
+                                            {'symbol': 'OTH', 'price': 10.0, 'quantity': 2, 'indicator': 'buy'}])
+        self.assertDictEqual(errors, {})
+        self.assertListEqual([tr.timestamp for tr in trades], [1000, 1000])
+
+    def test__event_time(self):
+        trade = Trade(clock=EventClock())
+        start = 1000 * NANOSECONDS
+        recorded = []
+        for position, price in enumerate([2.0, 4.0, 8.0, 16.0]):
+            # Trades are a minute and a half apart
+            recorded.extend(trade.record([TradeStockRecord(timestamp_ns=start + position * PERIOD * 3 // 10,
+                                                           symbol='SYM', price=price, quantity=1)]))
+        self.assertEqual(trade.clock.now(), recorded[-1].timestamp_ns)
+        self.assertEqual(trade.get_vwsp('SYM'), 7.5)
+        self.assertEqual(trade.get_candles('SYM', '1m')[0]['timestamp'], 1000 - 1000 % 60)
+
+        # Late trade is recorded but the time doesn't go back
+        trade.record([TradeStockRecord(timestamp_ns=start, symbol='OTH', price=3.0, quantity=1)])
+        self.assertEqual(trade.clock.now(), recorded[-1].timestamp_ns)
+        self.assertEqual(trade.get_vwsp('OTH'), 3.0)
+        trade.record([TradeStockRecord(timestamp_ns=start + PERIOD, symbol='SYM', price=1.0, quantity=2)])
+        self.assertEqual(trade.get_vwsp('OTH'), 0.0)
+        self.assertEqual(trade.get_vwsp('SYM'), 6.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
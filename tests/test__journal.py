@@ -0,0 +1,154 @@
+# coding=UTF-8
+
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from clock import NANOSECONDS
+from journal import Journal, TRADE, TRADE_RECORD, _frame, read_records
+from models import Stock, StockRecord, Trade, TradeStockRecord
+from retention import TradeArchive
+
+
+__author__ = 'Konstantin Kolesnikov'
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        Stock._instance = None
+        Trade._instance = None
+        self.now = int(time.time())
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'journal')
+        self.journal = Journal(self.path)
+        self.journal.open(Stock.get_instance(), Trade.get_instance())
+
+    def tearDown(self):
+        Stock._instance = None
+        Trade._instance = None
+        shutil.rmtree(self.directory)
+
+    def restart(self, archive_path=None):
+        self.journal.close()
+        Stock._instance = None
+        Trade._instance = None
+        if archive_path is not None:
+            Trade.get_instance().set_archive(TradeArchive(archive_path))
+        self.journal = Journal(self.path)
+        self.journal.open(Stock.get_instance(), Trade.get_instance())
+
+    def record(self, seconds_ago, symbol='SYM', price=10.0):
+        return Trade.get_instance()._record(TradeStockRecord(timestamp=self.now - seconds_ago,
+                                                             symbol=symbol,
+                                                             price=price,
+                                                             quantity=2,
+                                                             indicator='sell'))
+
+    @staticmethod
+    def dump(history):
+        return [(position, tr.json()) for position, tr in history]
+
+    @staticmethod
+    def stocks():
+        # Versions are counted by every process
+        return sorted(dict(st.json(), version=None) for st in Stock.get_instance())
+
+    def test__recovery(self):
+        Stock.get_instance().add(StockRecord(symbol='SYM', price=1.5, type='preferred', last_dividend=8,
+                                             fixed_dividend=0.02, par_value=100))
+        Stock.get_instance().add(StockRecord(symbol=u'ÜBER', price=2.0, type='common', par_value=10))
+        self.record(10)
+        Trade.get_instance().buy(u'ÜBER', 3.0, 7)
+        stock = Stock.get_instance().get_stock_by_symbol('SYM')
+        stock.price = 3.0
+        Stock.get_instance().update(stock)
+        stocks = self.stocks()
+        history = self.dump(Trade.get_instance().history())
+        index = Trade.get_instance().gbce_index
+
+        self.restart()
+        self.assertListEqual(self.stocks(), stocks)
+        self.assertListEqual(self.dump(Trade.get_instance().history()), history)
+        self.assertEqual(Trade.get_instance().gbce_index, index)
+
+        self.record(5)
+        self.assertEqual(list(Trade.get_instance().history())[-1][0], 2)
+
+    def test__seconds_trade_records(self):
+        # Trade records written before the nanosecond timestamps are replayed
+        self.record(10)
+        self.journal.append(_frame(TRADE_RECORD + TRADE.pack(1, self.now - 5, 12.0, 3, 0) + 'SYM'))
+        self.journal.sync()
+
+        self.restart()
+        trades = list(Trade.get_instance())
+        self.assertListEqual([tr.timestamp_ns for tr in trades], [(self.now - 10) * NANOSECONDS,
+                                                                 (self.now - 5) * NANOSECONDS])
+        self.assertEqual((trades[1].price, trades[1].quantity, trades[1].indicator), (12.0, 3, 'Buy'))
+
+    def test__incomplete_record_is_truncated(self):
+        self.record(10)
+        self.record(5)
+        self.journal.sync()
+        path = self.journal._path('journal', 0)
+        size = os.path.getsize(path)
+        with open(path, 'ab') as f:
+            f.write('\x20\x00\x00\x00\x01\x02')
+
+        self.restart()
+        self.assertEqual(os.path.getsize(path), size)
+        self.assertEqual(len(list(Trade.get_instance())), 2)
+        self.assertEqual(len(read_records(path)[0]), 2)
+
+    def test__snapshot(self):
+        Stock.get_instance().add(StockRecord(symbol='SYM', price=1.0, type='common', par_value=1))
+        for i in range(5):
+            self.record(100 - i, price=float(i + 1))
+        Trade.get_instance().compact(self.now - 98)
+        self.assertEqual(self.journal.snapshot(Stock.get_instance(), Trade.get_instance()), 1)
+        self.record(1, price=6.0)
+        history = self.dump(Trade.get_instance().history())
+
+        self.assertListEqual(sorted(os.listdir(self.path)), ['journal.1', 'snapshot.1'])
+        self.restart()
+        self.assertListEqual(self.dump(Trade.get_instance().history()), history)
+        self.assertEqual([position for position, _ in history], [3, 4, 5])
+        self.assertEqual(Stock.get_instance().get_stock_by_symbol('SYM').price, 1.0)
+
+    def test__archived_trades_are_skipped(self):
+        archive_path = os.path.join(self.directory, 'trades.log')
+        Trade.get_instance().set_archive(TradeArchive(archive_path))
+        for i in range(4):
+            self.record(1000 - i, price=float(i + 1))
+        self.record(10, price=5.0)
+        Trade.get_instance().compact(self.now - 600)
+        history = self.dump(Trade.get_instance().history())
+
+        self.restart(archive_path)
+        self.assertListEqual(self.dump(Trade.get_instance().history()), history)
+        self.assertEqual(len(list(Trade.get_instance())), 1)
+
+    def test__writer(self):
+        self.journal.close()
+        Stock._instance = None
+        Trade._instance = None
+        journal = Journal(os.path.join(self.directory, 'writer'), sync_interval=0.01)
+        writer = journal.apply(Stock.get_instance(), Trade.get_instance())
+        path = journal._path('journal', 0)
+        try:
+            self.record(1)
+            deadline = time.time() + 5
+            while not read_records(path)[0] and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(len(read_records(path)[0]), 1)
+        finally:
+            writer.stop()
+            writer.join()
+
+
+if __name__ == '__main__':
+    unittest.main()
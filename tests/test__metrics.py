@@ -0,0 +1,123 @@
+# coding=UTF-8
+
+
+import json
+import time
+import unittest
+
+from app import create_app
+from metrics import Registry, instrument_models
+from models import Stock, StockRecord, Trade, TradeStockRecord, VWSP_PERIOD
+
+
+__author__ = 'Konstantin Kolesnikov'
+
+
+class Market(object):
+
+    def __init__(self):
+        self._price = 1.0
+
+    def trade(self, price):
+        self._price = price
+        return price
+
+    @property
+    def price(self):
+        return self._price
+
+
+class TestRegistry(unittest.TestCase):
+
+    def test__counter(self):
+        registry = Registry()
+        counter = registry.counter('sssm_things_total', 'Number of things', ('kind',))
+        counter.inc(labels=('a"b\\',))
+        counter.inc(2, ('a"b\\',))
+        self.assertEqual(registry.render(), '# HELP sssm_things_total Number of things\n'
+                                            '# TYPE sssm_things_total counter\n'
+                                            'sssm_things_total{kind="a\\"b\\\\"} 3\n')
+
+    def test__histogram(self):
+        registry = Registry()
+        histogram = registry.histogram('sssm_seconds', 'Duration', buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 5.0):
+            histogram.observe(value)
+        lines = registry.render().splitlines()
+        self.assertListEqual(lines[2:], ['sssm_seconds_bucket{le="0.1"} 2',
+                                         'sssm_seconds_bucket{le="1.0"} 3',
+                                         'sssm_seconds_bucket{le="+Inf"} 4',
+                                         'sssm_seconds_sum 5.65',
+                                         'sssm_seconds_count 4'])
+
+    def test__instrument_models(self):
+        registry = Registry()
+        histogram = instrument_models(registry, ((Market, 'trade'), (Market, 'price')))
+        market = Market()
+        self.assertEqual(market.trade(2.0), 2.0)
+        self.assertEqual(market.price, 2.0)
+        self.assertEqual(market.price, 2.0)
+        counts = dict((labels, count) for name, labels, count in histogram.samples() if name.endswith('_count'))
+        self.assertDictEqual(counts, {('Market.trade',): 1, ('Market.price',): 2})
+
+        # Instrumenting again replaces the timing instead of stacking it
+        histogram = instrument_models(Registry(), ((Market, 'trade'),))
+        market.trade(3.0)
+        counts = dict((labels, count) for name, labels, count in histogram.samples() if name.endswith('_count'))
+        self.assertDictEqual(counts, {('Market.trade',): 1})
+
+
+class TestMetricsEndpoint(unittest.TestCase):
+
+    def setUp(self):
+        Stock._instance = None
+        Trade._instance = None
+        Stock.get_instance().add(StockRecord(symbol='SYM', price=10.0, type='common', par_value=1))
+        Stock.get_instance().add(StockRecord(symbol='OTH', price=10.0, type='common', par_value=1))
+        self.client = create_app(background=False).test_client()
+
+    def tearDown(self):
+        Stock._instance = None
+        Trade._instance = None
+
+    def metrics(self):
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers['Content-Type'].startswith('text/plain; version=0.0.4'))
+        samples = {}
+        for line in response.data.splitlines():
+            if not line.startswith('#'):
+                name, value = line.rsplit(' ', 1)
+                samples[name] = float(value)
+        return samples
+
+    def test__metrics(self):
+        before = self.metrics()
+        now = int(time.time())
+        Trade.get_instance()._record(TradeStockRecord(timestamp=now - VWSP_PERIOD * 60 - 1, symbol='OTH', price=5.0,
+                                                      quantity=1, indicator='buy'))
+        for _ in range(3):
+            self.client.post('/trades', data=json.dumps({'symbol': 'SYM', 'price': 10.0, 'quantity': 1,
+                                                         'indicator': 'buy'}), content_type='application/json')
+        self.client.get('/stocks')
+        self.client.get('/stocks')
+        samples = self.metrics()
+
+        def delta(name):
+            return samples.get(name, 0) - before.get(name, 0)
+
+        self.assertEqual(delta('sssm_requests_total{endpoint="trade_shares",method="POST",status="200"}'), 3)
+        self.assertEqual(delta('sssm_request_seconds_count{endpoint="get_stocks"}'), 2)
+        self.assertEqual(delta('sssm_operation_seconds_count{operation="Trade.buy"}'), 3)
+        self.assertEqual(delta('sssm_stock_cache_lookups_total{result="miss"}'), 2)
+        self.assertEqual(delta('sssm_stock_cache_lookups_total{result="hit"}'), 2)
+        self.assertEqual(samples['sssm_stocks'], 2)
+        # Trade of OTH has left the VWSP period already
+        self.assertEqual(samples['sssm_trade_window_trades_bucket{le="0"}'], 1)
+        self.assertEqual(samples['sssm_trade_window_trades_bucket{le="10"}'], 2)
+        self.assertEqual(samples['sssm_trade_window_trades_sum'], 3)
+        self.assertDictEqual(Trade.get_instance().get_window_sizes(), {'SYM': 3, 'OTH': 0})
+
+
+if __name__ == '__main__':
+    unittest.main()
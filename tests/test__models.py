@@ -0,0 +1,629 @@
+# coding=UTF-8
+
+
+import math
+import pickle
+import random
+import threading
+import time
+import unittest
+from fractions import Fraction
+
+from clock import NANOSECONDS
+from models import (CandleSeries, GBCEIndex, Stock, StockRecord, SYMBOLS, SymbolTable, SymbolTrades, Trade,
+                    TradeColumns, TradeStockRecord, VWSP_PERIOD)
+
+
+__author__ = 'Konstantin Kolesnikov'
+
+
+class TestTrade(unittest.TestCase):
+
+    def setUp(self):
+        Stock._instance = None
+        Trade._instance = None
+        self.trade = Trade.get_instance()
+        self.now = int(time.time())
+
+    def tearDown(self):
+        Stock._instance = None
+        Trade._instance = None
+
+    def add_stock(self, symbol):
+        Stock.get_instance().add(StockRecord(symbol=symbol, price=1.0, type='common', par_value=1))
+
+    def record(self, symbol, seconds_ago, price=10.0, quantity=1, indicator='buy'):
+        return self.trade._record(TradeStockRecord(timestamp=self.now - seconds_ago,
+                                                   symbol=symbol,
+                                                   price=price,
+                                                   quantity=quantity,
+                                                   indicator=indicator))
+
+    def test__trades_for_unknown_symbol(self):
+        self.assertListEqual(self.trade.get_trades_for_symbol('SYM'), [])
+
+    def test__trades_for_symbol_in_window(self):
+        old = self.record('SYM', 600)
+        recent = self.record('SYM', 60)
+        other = self.record('OTH', 60)
+
+        self.assertListEqual(self.trade.get_trades_for_symbol('SYM'), [recent])
+        self.assertListEqual(self.trade.get_trades_for_symbol('SYM', time_range=15), [old, recent])
+        self.assertListEqual(self.trade.get_trades_for_symbol('OTH'), [other])
+
+    def test__trades_for_symbol_ordered_by_timestamp(self):
+        late = self.record('SYM', 10)
+        early = self.record('SYM', 100)
+        middle = self.record('SYM', 50)
+
+        self.assertListEqual(self.trade.get_trades_for_symbol('SYM'), [early, middle, late])
+        self.assertListEqual(list(self.trade), [late, early, middle],
+                             'Iteration should keep the order trades were made')
+
+    def test__buy_and_sell(self):
+        bought = self.trade.buy('SYM', 10.0, 5)
+        sold = self.trade.sell('SYM', 11.0, 2)
+
+        self.assertEqual(bought.indicator, 'Buy')
+        self.assertEqual(sold.indicator, 'Sell')
+        self.assertListEqual(self.trade.get_trades_for_symbol('SYM'), [bought, sold])
+
+    def test__history_filters(self):
+        Trade.HISTORY_CHUNK, chunk = 2, Trade.HISTORY_CHUNK
+        try:
+            trades = [self.record('SYM' if i % 3 else 'OTH', 100 - i, price=float(i)) for i in range(10)]
+            history = list(self.trade.history())
+            self.assertListEqual([position for position, _ in history], range(10))
+
+            def check(expected, **kwargs):
+                history = list(self.trade.history(**kwargs))
+                self.assertListEqual([tr.json() for _, tr in history], [tr.json() for tr in expected])
+                self.assertListEqual([trades[position].json() for position, _ in history],
+                                     [tr.json() for tr in expected])
+
+            check([tr for tr in trades if tr.symbol == 'SYM'], symbol='SYM')
+            check([tr for tr in trades[5:] if tr.symbol == 'OTH'], symbol='OTH', cursor=5)
+            check(trades[3:7], since=self.now - 97, until=self.now - 93)
+            check([trades[4], trades[5]], symbol='SYM', since=self.now - 97, limit=2)
+            check([], symbol='NON')
+
+            self.record('SYM', 1000)
+            check(trades[3:7], since=self.now - 97, until=self.now - 93)
+        finally:
+            Trade.HISTORY_CHUNK = chunk
+
+    def test__vwsp(self):
+        self.record('SYM', 600, price=100.0, quantity=100)
+        self.record('SYM', 60, price=10.0, quantity=1)
+        self.record('SYM', 30, price=20.0, quantity=3)
+
+        self.assertEqual(self.trade.get_vwsp('SYM'), 17.5)
+        self.assertEqual(self.trade.get_vwsp('OTH'), 0.0)
+
+    def test__gbce_index(self):
+        self.add_stock('SYM')
+        self.add_stock('OTH')
+        self.add_stock('NON')
+        self.assertEqual(self.trade.gbce_index, 0.0)
+
+        self.record('SYM', 10, price=2.0, quantity=1)
+        self.record('SYM', 10, price=2.0, quantity=5)
+        self.record('OTH', 10, price=8.0, quantity=1)
+
+        self.assertAlmostEqual(self.trade.gbce_index, 4.0, delta=1e-12,
+                               msg='Each stock counts once, stocks without trades are ignored')
+
+    def test__gbce_index_follows_expired_trades(self):
+        self.add_stock('SYM')
+        self.add_stock('OTH')
+        self.record('SYM', 250, price=2.0)
+        self.record('OTH', 10, price=8.0)
+        self.assertAlmostEqual(self.trade.gbce_index, 4.0, delta=1e-12)
+
+        self.trade._refresh_index((self.now + 50) * NANOSECONDS)
+        self.assertAlmostEqual(self.trade._indexes[VWSP_PERIOD].value, 8.0, delta=1e-12)
+        self.trade._refresh_index((self.now + 290) * NANOSECONDS)
+        self.assertEqual(self.trade._indexes[VWSP_PERIOD].value, 0.0)
+
+    def test__gbce_index_many_stocks(self):
+        rnd = random.Random(20161009)
+        vwsps = []
+        for i in range(1000):
+            symbol = 'S%04d' % i
+            self.add_stock(symbol)
+            vwsps.append(rnd.choice([1e-5, 1e5]) * rnd.uniform(1.0, 2.0))
+            self.record(symbol, 10, price=vwsps[-1])
+
+        expected = math.exp(math.fsum(math.log(v) for v in vwsps) / len(vwsps))
+        index = self.trade.gbce_index
+        self.assertAlmostEqual(index, expected, delta=expected * 1e-12)
+
+        self.trade.rebuild_index()
+        self.assertEqual(self.trade.gbce_index, index)
+
+    def test__analytics(self):
+        rnd = random.Random(20161009)
+        for i in range(200):
+            stock = StockRecord(symbol='S%03d' % i,
+                                price=rnd.choice([0.0, round(rnd.uniform(0.01, 500.0), 2)]),
+                                type=rnd.choice(['common', 'preferred']),
+                                last_dividend=rnd.choice([0, rnd.randint(1, 30)]),
+                                fixed_dividend=rnd.choice([0.0, rnd.uniform(0.0, 1.0)]),
+                                par_value=rnd.randint(0, 200))
+            Stock.get_instance().add(stock)
+            for _ in range(rnd.randint(0, 3)):
+                self.record(stock.symbol, rnd.randint(0, 600), price=rnd.uniform(1.0, 100.0),
+                            quantity=rnd.randint(1, 100))
+
+        analytics = Stock.get_instance().analytics()
+        self.assertEqual(len(analytics), 200)
+        for stock, obj in zip(analytics.records, analytics.json()):
+            self.assertDictEqual(obj, stock.json())
+
+    def test__analytics_rebuild_index(self):
+        self.add_stock('SYM')
+        self.add_stock('OTH')
+        self.record('SYM', 10, price=2.0)
+        self.record('OTH', 250, price=8.0)
+        self.record('NON', 10, price=100.0)
+
+        self.trade.rebuild_index()
+        self.assertEqual(len(self.trade._indexes[VWSP_PERIOD]), 2, 'Only registered stocks participate in the index')
+        self.assertAlmostEqual(self.trade.gbce_index, 4.0, delta=1e-12)
+        self.trade._refresh_index((self.now + 60) * NANOSECONDS)
+        self.assertAlmostEqual(self.trade._indexes[VWSP_PERIOD].value, 2.0, delta=1e-12)
+
+    def test__bulk_record(self):
+        self.add_stock('SYM')
+        trades, errors = self.trade.bulk_record([
+            {'symbol': 'SYM', 'price': 10.0, 'quantity': 2, 'indicator': 'buy'},
+            {'symbol': 'NON', 'price': 10.0, 'quantity': 2, 'indicator': 'buy'},
+            {'symbol': 'SYM', 'price': -1.0, 'quantity': 0, 'indicator': 'hold'},
+            {'symbol': 'SYM', 'price': '20', 'quantity': '1', 'indicator': 'sell'},
+            {},
+            'SYM'
+        ])
+
+        self.assertListEqual([(tr.price, tr.quantity, tr.indicator) for tr in trades],
+                             [(10.0, 2, 'Buy'), (20.0, 1, 'Sell')])
+        self.assertEqual(self.trade.get_vwsp('SYM'), 40.0 / 3)
+        error = ['This field is required.']
+        self.assertDictEqual(errors, {
+            1: {'symbol': ['Stock symbol is not registered at the market.']},
+            2: {'price': ['Number must be at least 0.0.'], 'quantity': error, 'indicator': ['Not a valid choice']},
+            4: {'symbol': error, 'price': error, 'quantity': error, 'indicator': error},
+            5: {'__all__': ['Trade should be an object.']}
+        })
+
+    def test__bulk_record_refuses_invalid_numbers(self):
+        self.add_stock('SYM')
+        trades, errors = self.trade.bulk_record([
+            {'symbol': 'SYM', 'price': float('nan'), 'quantity': float('inf'), 'indicator': ['buy']},
+            {'symbol': 'SYM', 'price': float('inf'), 'quantity': 2 ** 63, 'indicator': {'buy': 1}},
+            {'symbol': 'SYM', 'price': 'nan', 'quantity': 'inf', 'indicator': 'buy'},
+            {'symbol': 'SYM', 'price': 10.0, 'quantity': 2, 'indicator': 'buy'}
+        ])
+
+        self.assertEqual(len(trades), 1)
+        finite = ['Number must be finite.']
+        self.assertDictEqual(errors, {
+            0: {'price': finite, 'quantity': ['Not a valid integer value'], 'indicator': ['Not a valid choice']},
+            1: {'price': finite, 'quantity': ['Number must be at most %s.' % (2 ** 63 - 1)],
+                'indicator': ['Not a valid choice']},
+            2: {'price': finite, 'quantity': ['Not a valid integer value']}
+        })
+        self.assertEqual(self.trade.get_vwsp('SYM'), 10.0)
+
+    def test__invalid_trades_are_refused(self):
+        self.add_stock('SYM')
+        self.record('SYM', 10)
+        for price, quantity in ((float('nan'), 1), (float('inf'), 1), (10.0, 2 ** 63)):
+            batch = [TradeStockRecord(timestamp=self.now, symbol='SYM', price=20.0, quantity=1, indicator='buy'),
+                     TradeStockRecord(timestamp=self.now, symbol='SYM', price=price, quantity=quantity,
+                                      indicator='buy')]
+            self.assertRaises(ValueError, self.trade.record, batch)
+            self.assertRaises(ValueError, self.trade.buy, 'SYM', price, quantity)
+
+        self.assertEqual(len(list(self.trade)), 1)
+        self.assertEqual(len(list(self.trade.history())), 1)
+        self.assertEqual(self.trade.get_vwsp('SYM'), 10.0)
+        self.assertAlmostEqual(self.trade.gbce_index, 10.0)
+
+
+    def test__symbol_ids(self):
+        self.add_stock('SYM')
+        self.add_stock('OTH')
+        stock = Stock.get_instance().get_stock_by_symbol('SYM')
+        other = Stock.get_instance().get_stock_by_symbol('OTH')
+        self.assertNotEqual(stock.id, other.id)
+        self.assertEqual(SYMBOLS.get_symbol(other.id), 'OTH')
+        Stock.get_instance().update(stock)
+        self.assertEqual(stock.id, SYMBOLS.find('SYM'))
+
+        # Trades share the interned symbol, trades of unregistered symbols get ids too
+        traded = self.record(''.join(['S', 'Y', 'M']), 10)
+        self.assertIs(traded.symbol, SYMBOLS.get_symbol(stock.id))
+        self.record('NON', 10)
+        self.assertIsNotNone(SYMBOLS.find('NON'))
+        self.assertEqual(self.trade.get_window_sizes(), {'SYM': 1, 'NON': 1})
+
+
+class TestCompactTrade(TestTrade):
+
+    def setUp(self):
+        super(TestCompactTrade, self).setUp()
+        self.trade = Trade(compact_storage=True)
+
+    def assertTradesEqual(self, trades, expected):
+        self.assertListEqual([tr.json() for tr in trades], [tr.json() for tr in expected])
+
+    def test__trades_for_symbol_in_window(self):
+        old = self.record('SYM', 600)
+        recent = self.record('SYM', 60, indicator='sell')
+
+        self.assertTradesEqual(self.trade.get_trades_for_symbol('SYM'), [recent])
+        self.assertTradesEqual(self.trade.get_trades_for_symbol('SYM', time_range=15), [old, recent])
+
+    def test__trades_for_symbol_ordered_by_timestamp(self):
+        late = self.record('SYM', 10)
+        early = self.record('SYM', 100)
+
+        self.assertTradesEqual(self.trade.get_trades_for_symbol('SYM'), [early, late])
+        self.assertTradesEqual(self.trade, [late, early])
+
+    def test__buy_and_sell(self):
+        bought = self.trade.buy('SYM', 10.0, 5)
+        sold = self.trade.sell('OTH', 11.0, 2)
+
+        self.assertDictEqual(bought.json(), {'timestamp': bought.timestamp, 'timestamp_ns': bought.timestamp_ns,
+                                             'indicator': 'Buy', 'symbol': 'SYM', 'price': 10.0, 'quantity': 5})
+        self.assertEqual(sold.indicator, 'Sell')
+        self.assertEqual(sold.symbol, 'OTH')
+
+    def test__compaction(self):
+        self.record('SYM', 1000)
+        recent = self.record('SYM', 10, price=20.0)
+
+        self.trade.compact(self.now - 600)
+        self.assertTradesEqual(self.trade, [recent])
+        self.assertEqual(self.trade.get_vwsp('SYM'), 20.0)
+
+    def test__candles_survive_compaction(self):
+        self.record('SYM', 1000, price=10.0)
+        self.record('SYM', 10, price=20.0)
+        candles = self.trade.get_candles('SYM', '1s')
+
+        self.trade.compact(self.now - 600)
+        self.assertListEqual(self.trade.get_candles('SYM', '1s'), candles)
+        self.assertListEqual([c['close'] for c in candles], [10.0, 20.0])
+        self.assertListEqual(self.trade.get_candles('OTH', '1h'), [])
+        self.assertRaises(ValueError, self.trade.get_candles, 'SYM', '2m')
+
+
+class TestStockRecord(unittest.TestCase):
+
+    def test__derived_fields(self):
+        stock = StockRecord(symbol='SYM', price=10.0, type='common', fixed_dividend=0.02, par_value=100)
+        self.assertEqual((stock.dividend_yield, stock.pe_ratio, stock.url), (0.2, 50.0, '/stocks/SYM'))
+        self.assertFalse(hasattr(stock, '__dict__'))
+
+        # Setting any field the derived ones depend on calculates them again
+        stock.price = 20.0
+        self.assertEqual((stock.dividend_yield, stock.pe_ratio), (0.1, 200.0))
+        stock.type = 'Preferred'
+        stock.last_dividend = 5
+        self.assertEqual((stock.dividend_yield, stock.pe_ratio), (0.25, 80.0))
+        stock.price = 0.0
+        self.assertEqual((stock.dividend_yield, stock.pe_ratio), (0.0, 0.0))
+        stock.symbol = 'OTH'
+        self.assertEqual(stock.json()['url'], '/stocks/OTH')
+        self.assertEqual(StockRecord(symbol='NON', price=1.0, fixed_dividend=None).dividend_yield, 0.0)
+
+        restored = pickle.loads(pickle.dumps(stock, pickle.HIGHEST_PROTOCOL))
+        self.assertDictEqual(restored.json(), stock.json())
+        self.assertEqual(restored.version, stock.version)
+
+
+class TestSymbolTable(unittest.TestCase):
+
+    def test__dense_ids(self):
+        table = SymbolTable()
+        self.assertListEqual([table.get_id(symbol) for symbol in ('SYM', 'OTH', 'SYM', 'NON')], [0, 1, 0, 2])
+        self.assertEqual(len(table), 3)
+        self.assertEqual(table.find('OTH'), 1)
+        self.assertIsNone(table.find('NEW'))
+        self.assertEqual(table.get_symbol(2), 'NON')
+
+
+class TestTradeColumns(unittest.TestCase):
+
+    def test__columns(self):
+        trades = TradeColumns(SymbolTable())
+        trades.append(TradeStockRecord(timestamp=2, symbol='SYM', price=1.5, quantity=3, indicator='sell'))
+        trades.insert(0, TradeStockRecord(timestamp=1, symbol='OTH', price=2.5, quantity=4, indicator='buy'))
+        trades.append(TradeStockRecord(timestamp=3, symbol='SYM', price=3.5, quantity=5, indicator='buy'))
+
+        self.assertEqual(len(trades), 3)
+        self.assertListEqual(list(trades.timestamps), [1 * NANOSECONDS, 2 * NANOSECONDS, 3 * NANOSECONDS])
+        self.assertEqual(sum(p * q for p, q in zip(trades.prices, trades.quantities)), 32.0)
+        self.assertEqual(trades[-1].price, 3.5)
+        self.assertListEqual([tr.symbol for tr in trades[1:]], ['SYM', 'SYM'])
+        self.assertListEqual([tr.indicator for tr in trades], ['Buy', 'Sell', 'Buy'])
+        self.assertRaises(IndexError, trades.__getitem__, 3)
+
+        del trades[:2]
+        self.assertListEqual([tr.json() for tr in trades],
+                             [{'timestamp': 3, 'timestamp_ns': 3 * NANOSECONDS, 'indicator': 'Buy', 'symbol': 'SYM',
+                               'price': 3.5, 'quantity': 5}])
+
+    def test__columns_keep_length(self):
+        trades = TradeColumns(SymbolTable())
+        trades.append(TradeStockRecord(timestamp=1, symbol='SYM', price=1.5, quantity=3, indicator='sell'))
+        for quantity in (2 ** 63, -2 ** 63 - 1):
+            trade = TradeStockRecord(timestamp=2, symbol='SYM', price=2.5, quantity=quantity, indicator='buy')
+            self.assertRaises(OverflowError, trades.append, trade)
+            self.assertRaises(OverflowError, trades.insert, 0, trade)
+
+        self.assertListEqual([len(column) for column in (trades.timestamps, trades.prices, trades.quantities,
+                                                         trades.symbol_ids, trades.sides)], [1] * 5)
+        self.assertEqual(trades[0].quantity, 3)
+
+
+class TestConcurrency(unittest.TestCase):
+
+    THREADS = 8
+    TRADES = 2000
+
+    def setUp(self):
+        Stock._instance = None
+        Trade._instance = None
+        self.symbols = ['S%03d' % i for i in range(20)]
+        for symbol in self.symbols:
+            Stock.get_instance().add(StockRecord(symbol=symbol, price=1.0, type='common', par_value=1))
+
+    def tearDown(self):
+        Stock._instance = None
+        Trade._instance = None
+
+    def test__bulk_record_is_not_interleaved(self):
+        trade = Trade.get_instance()
+        stopped = threading.Event()
+
+        def single():
+            while not stopped.is_set():
+                trade.buy(self.symbols[0], 1.0, 1)
+
+        thread = threading.Thread(target=single)
+        thread.start()
+        try:
+            items = [{'symbol': symbol, 'price': 2.0, 'quantity': 1, 'indicator': 'sell'} for symbol in self.symbols]
+            batches = [trade.bulk_record(items * 10)[0] for _ in range(20)]
+        finally:
+            stopped.set()
+            thread.join()
+        positions = dict((id(tr), position) for position, tr in trade.history())
+        for batch in batches:
+            batch_positions = [positions[id(tr)] for tr in batch]
+            self.assertListEqual(batch_positions, range(batch_positions[0], batch_positions[0] + len(batch)),
+                                 'Batch should take consecutive positions')
+
+    def test__parallel_trading(self):
+        trade = Trade.get_instance()
+        errors = []
+        stopped = threading.Event()
+
+        def trader(seed):
+            rnd = random.Random(seed)
+            try:
+                for i in range(self.TRADES):
+                    action = trade.buy if rnd.random() < 0.5 else trade.sell
+                    action(rnd.choice(self.symbols), round(rnd.uniform(1.0, 100.0), 2), rnd.randint(1, 100))
+                    if i % 100 == 0:
+                        # New symbols get their ids while the others are traded
+                        Stock.get_instance().add(StockRecord(symbol='N%d%04d' % (seed, i), price=1.0))
+                        trade.buy('N%d%04d' % (seed, i), 1.0, 1)
+            except Exception as e:
+                errors.append(e)
+
+        def reader(seed):
+            rnd = random.Random(seed)
+            try:
+                while not stopped.is_set():
+                    symbol = rnd.choice(self.symbols)
+                    trade.get_vwsp(symbol)
+                    trade.get_trades_for_symbol(symbol)
+                    trade.gbce_index
+                    len(list(Stock.get_instance()))
+                    for _ in trade.history(symbol=symbol, limit=10):
+                        pass
+            except Exception as e:
+                errors.append(e)
+
+        traders = [threading.Thread(target=trader, args=(i,)) for i in range(self.THREADS)]
+        readers = [threading.Thread(target=reader, args=(i,)) for i in range(2)]
+        for thread in traders + readers:
+            thread.start()
+        for thread in traders:
+            thread.join()
+        stopped.set()
+        for thread in readers:
+            thread.join()
+
+        self.assertListEqual(errors, [])
+        self.assertEqual(len(list(trade.history())), self.THREADS * (self.TRADES + self.TRADES // 100))
+        self.assertEqual(len(list(Stock.get_instance())), len(self.symbols) + self.THREADS * self.TRADES // 100)
+        for symbol in self.symbols:
+            trades = trade.get_trades_for_symbol(symbol)
+            self.assertEqual(trade.get_vwsp(symbol), TestSymbolTrades.exact_vwsp(trades))
+            positions = [position for position, _ in trade.history(symbol=symbol)]
+            self.assertEqual(len(positions), len(trades))
+            self.assertListEqual(positions, sorted(positions))
+
+        index = trade.gbce_index
+        symbols = [stock.symbol for stock in Stock.get_instance()]
+        expected = math.exp(math.fsum(math.log(trade.get_vwsp(symbol)) for symbol in symbols) / len(symbols))
+        self.assertAlmostEqual(index, expected, delta=expected * 1e-12)
+        trade.rebuild_index()
+        self.assertEqual(trade.gbce_index, index)
+
+
+class TestGBCEIndex(unittest.TestCase):
+
+    def test__update(self):
+        index = GBCEIndex()
+        index.update(1, 2.0)
+        index.update(3, 0.0)
+        self.assertEqual(len(index), 1)
+        self.assertAlmostEqual(index.value, 2.0, delta=1e-12)
+
+        index.update(3, 8.0)
+        self.assertAlmostEqual(index.value, 4.0, delta=1e-12)
+
+        index.update(1, 0.0)
+        self.assertAlmostEqual(index.value, 8.0, delta=1e-12)
+        index.update(1, 0.0)
+        self.assertEqual(len(index), 1)
+
+
+class TestSymbolTrades(unittest.TestCase):
+
+    @staticmethod
+    def naive_vwsp(trades):
+        try:
+            return sum(tr.price * tr.quantity for tr in trades) / sum(tr.quantity for tr in trades)
+        except ZeroDivisionError:
+            return 0.0
+
+    @staticmethod
+    def exact_vwsp(trades):
+        quantity = sum(tr.quantity for tr in trades)
+        if not quantity:
+            return 0.0
+        return float(sum(Fraction(tr.price) * tr.quantity for tr in trades) / quantity)
+
+    def test__empty_vwsp(self):
+        self.assertEqual(SymbolTrades().vwsp(int(time.time()) * NANOSECONDS), 0.0)
+
+    def test__vwsp_window_slides(self):
+        store = SymbolTrades(period=1)
+        store.add(TradeStockRecord(timestamp=100, symbol='SYM', price=10.0, quantity=1))
+        store.add(TradeStockRecord(timestamp=130, symbol='SYM', price=20.0, quantity=1))
+
+        self.assertEqual(store.vwsp(150 * NANOSECONDS), 15.0)
+        self.assertEqual(store.vwsp(160 * NANOSECONDS), 20.0, 'Trade made exactly a period ago is expired')
+        self.assertEqual(store.vwsp(190 * NANOSECONDS), 0.0)
+
+        store.add(TradeStockRecord(timestamp=120, symbol='SYM', price=30.0, quantity=1))
+        self.assertEqual(store.vwsp(190 * NANOSECONDS), 0.0, 'Expired trade should not get into the period')
+        store.add(TradeStockRecord(timestamp=200, symbol='SYM', price=40.0, quantity=1))
+        self.assertEqual(store.vwsp(200 * NANOSECONDS), 40.0)
+
+    def test__version_changes_with_vwsp(self):
+        store = SymbolTrades(period=1)
+        store.add(TradeStockRecord(timestamp=100, symbol='SYM', price=10.0, quantity=1))
+        version = store.version_at(110 * NANOSECONDS)
+        self.assertEqual(store.version_at(150 * NANOSECONDS), version)
+
+        store.add(TradeStockRecord(timestamp=130, symbol='SYM', price=20.0, quantity=1))
+        self.assertNotEqual(store.version_at(150 * NANOSECONDS), version)
+        version = store.version_at(150 * NANOSECONDS)
+        self.assertNotEqual(store.version_at(160 * NANOSECONDS), version, 'Version should change when trade expires')
+        version = store.version_at(160 * NANOSECONDS)
+        store.add(TradeStockRecord(timestamp=90, symbol='SYM', price=30.0, quantity=1))
+        self.assertEqual(store.version_at(160 * NANOSECONDS), version, 'Expired trade doesn\'t change VWSP')
+
+    def test__vwsp_matches_naive_computation(self):
+        rnd = random.Random(20161009)
+        for _ in range(20):
+            store = SymbolTrades()
+            now = 1000000
+            for _ in range(rnd.randint(1, 500)):
+                now += rnd.randint(0, 30)
+                # Some trades arrive late and some are already older than the period
+                timestamp = now - rnd.choice([0, 0, 0, rnd.randint(0, 400)])
+                store.add(TradeStockRecord(timestamp=timestamp,
+                                           symbol='SYM',
+                                           price=round(rnd.uniform(0.01, 1000.0), rnd.randint(0, 4)),
+                                           quantity=rnd.randint(1, 10000)))
+                if rnd.random() < 0.3:
+                    trades = store.since(now * NANOSECONDS - store.window)
+                    vwsp = store.vwsp(now * NANOSECONDS)
+                    self.assertEqual(vwsp, self.exact_vwsp(trades))
+                    self.assertAlmostEqual(vwsp, self.naive_vwsp(trades), delta=abs(vwsp) * 1e-12)
+
+    def test__windows_match_naive_computation(self):
+        rnd = random.Random(20161011)
+        store = SymbolTrades(periods=(1, 15, 60))
+        self.assertTupleEqual(store.periods, (1, 5, 15, 60))
+        now = 1000000
+        for _ in range(1500):
+            now += rnd.randint(0, 20)
+            store.add(TradeStockRecord(timestamp=now - rnd.choice([0, 0, 0, rnd.randint(0, 4000)]),
+                                       symbol='SYM',
+                                       price=round(rnd.uniform(0.01, 1000.0), rnd.randint(0, 4)),
+                                       quantity=rnd.randint(1, 10000)))
+            if rnd.random() < 0.03:
+                vwsps = store.vwsps(now * NANOSECONDS)
+                for period, vwsp in zip(store.periods, vwsps):
+                    self.assertEqual(vwsp, self.exact_vwsp(store.since((now - period * 60) * NANOSECONDS)))
+                    self.assertEqual(store.vwsp(now * NANOSECONDS, period), vwsp)
+                self.assertEqual(store.vwsp(now * NANOSECONDS), vwsps[1])
+        self.assertRaises(ValueError, store.vwsp, now * NANOSECONDS, 30)
+
+
+class TestCandleSeries(unittest.TestCase):
+
+    @staticmethod
+    def trade(timestamp, price, quantity=1):
+        return TradeStockRecord(timestamp=timestamp, symbol='SYM', price=price, quantity=quantity)
+
+    def test__candles(self):
+        series = CandleSeries(60, 100)
+        for trade in [self.trade(125, 10.0, 2), self.trade(190, 12.0), self.trade(130, 8.0), self.trade(150, 9.0),
+                      self.trade(120, 11.0), self.trade(5, 1.0)]:
+            series.add(trade)
+        self.assertListEqual(series.select(), [
+            {'timestamp': 0, 'open': 1.0, 'high': 1.0, 'low': 1.0, 'close': 1.0, 'volume': 1, 'vwap': 1.0},
+            {'timestamp': 120, 'open': 11.0, 'high': 11.0, 'low': 8.0, 'close': 9.0, 'volume': 5, 'vwap': 9.6},
+            {'timestamp': 180, 'open': 12.0, 'high': 12.0, 'low': 12.0, 'close': 12.0, 'volume': 1, 'vwap': 12.0}
+        ])
+        self.assertListEqual([c['timestamp'] for c in series.select(since=179)], [120, 180])
+        self.assertListEqual([c['timestamp'] for c in series.select(since=180, until=180)], [])
+        self.assertListEqual([c['timestamp'] for c in series.select(until=180)], [0, 120])
+        self.assertListEqual([c['timestamp'] for c in series.select(limit=1)], [180])
+
+    def test__limit(self):
+        series = CandleSeries(1, 8)
+        for timestamp in range(1000, 1100):
+            series.add(self.trade(timestamp, 1.0))
+        self.assertGreaterEqual(len(series), 8)
+        self.assertLessEqual(len(series), 10)
+        self.assertEqual(series.select()[-1]['timestamp'], 1099)
+        oldest = series.starts[0]
+        series.add(self.trade(1000, 1.0))
+        self.assertEqual(series.starts[0], oldest, 'Trade older than the kept candles is dropped')
+
+    def test__candles_match_naive_computation(self):
+        rnd = random.Random(20161010)
+        series = CandleSeries(60, 1000)
+        trades = []
+        now = 1000000
+        for _ in range(2000):
+            now += rnd.randint(0, 5)
+            trade = self.trade(now - rnd.choice([0, 0, rnd.randint(0, 600)]), float(rnd.randint(1, 1000)),
+                               rnd.randint(1, 100))
+            trades.append(trade)
+            series.add(trade)
+        for candle in series.select():
+            bucket = [tr for tr in trades if candle['timestamp'] <= tr.timestamp < candle['timestamp'] + 60]
+            ordered = sorted(bucket, key=lambda tr: tr.timestamp)
+            self.assertEqual(candle['open'], ordered[0].price)
+            self.assertEqual(candle['close'], [tr for tr in bucket if tr.timestamp == ordered[-1].timestamp][-1].price)
+            self.assertEqual(candle['high'], max(tr.price for tr in bucket))
+            self.assertEqual(candle['low'], min(tr.price for tr in bucket))
+            self.assertEqual(candle['volume'], sum(tr.quantity for tr in bucket))
+            self.assertAlmostEqual(candle['vwap'], TestSymbolTrades.naive_vwsp(bucket))
+
+
+if __name__ == '__main__':
+    unittest.main()
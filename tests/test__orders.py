@@ -0,0 +1,174 @@
+# coding=UTF-8
+
+
+import json
+import random
+import unittest
+
+from app import app
+from models import Stock, StockRecord, Trade
+from orders import MatchingEngine, Order, OrderBook
+
+
+__author__ = 'Konstantin Kolesnikov'
+
+
+class NaiveBook(object):
+    # Reference book scanning all the resting orders for every match
+
+    def __init__(self):
+        self.orders = []
+
+    def add(self, order_id, side, price, quantity):
+        fills = []
+        while quantity:
+            opposite = [o for o in self.orders if o[1] != side and (o[2] <= price if side == 'buy' else o[2] >= price)]
+            if not opposite:
+                break
+            best = min(opposite, key=lambda o: (o[2] if side == 'buy' else -o[2], o[0]))
+            filled = min(quantity, best[3])
+            fills.append((best[2], filled))
+            quantity -= filled
+            best[3] -= filled
+            if not best[3]:
+                self.orders.remove(best)
+        if quantity:
+            self.orders.append([order_id, side, price, quantity])
+        return fills
+
+    def cancel(self, order_id):
+        for order in self.orders:
+            if order[0] == order_id:
+                self.orders.remove(order)
+                return True
+        return False
+
+
+class TestOrderBook(unittest.TestCase):
+
+    def setUp(self):
+        self.book = OrderBook('SYM')
+        self.ids = iter(range(1, 100000))
+
+    def add(self, side, price, quantity):
+        order = Order(next(self.ids), 'SYM', side, price, quantity)
+        return order, [(fill.price, fill.quantity, fill.indicator) for fill in self.book.add(order)]
+
+    def test__price_time_priority(self):
+        first, _ = self.add('sell', 10.0, 5)
+        second, _ = self.add('sell', 10.0, 5)
+        cheaper, _ = self.add('sell', 9.0, 2)
+        self.add('buy', 8.0, 1)
+        self.assertEqual(self.book.best('buy'), 8.0)
+        self.assertEqual(self.book.best('sell'), 9.0)
+
+        order, fills = self.add('buy', 10.0, 8)
+        self.assertListEqual(fills, [(9.0, 2, 'Buy'), (10.0, 5, 'Buy'), (10.0, 1, 'Buy')])
+        self.assertEqual(order.status, 'filled')
+        self.assertEqual((first.status, cheaper.status), ('filled', 'filled'))
+        self.assertEqual((second.quantity, second.filled), (4, 1))
+        self.assertDictEqual(self.book.depth(), {'bids': [{'price': 8.0, 'quantity': 1, 'orders': 1}],
+                                                 'asks': [{'price': 10.0, 'quantity': 4, 'orders': 1}]})
+
+        order, fills = self.add('sell', 7.0, 3)
+        self.assertListEqual(fills, [(8.0, 1, 'Sell')])
+        self.assertEqual((order.status, order.quantity), ('open', 2))
+        self.assertEqual(self.book.best('sell'), 7.0)
+        self.assertIsNone(self.book.best('buy'))
+
+    def test__cancel(self):
+        first, _ = self.add('buy', 10.0, 5)
+        second, _ = self.add('buy', 10.0, 3)
+        self.assertIs(self.book.cancel(first.id), first)
+        self.assertIsNone(self.book.cancel(first.id))
+        self.assertEqual(first.status, 'cancelled')
+        self.assertDictEqual(self.book.depth()['bids'][0], {'price': 10.0, 'quantity': 3, 'orders': 1})
+
+        _, fills = self.add('sell', 10.0, 5)
+        self.assertListEqual(fills, [(10.0, 3, 'Sell')])
+        self.assertIsNone(self.book.best('buy'))
+        self.assertEqual(len(self.book), 1)
+
+    def test__matches_naive_book(self):
+        rnd = random.Random(20161012)
+        naive = NaiveBook()
+        open_ids = []
+        for position in range(3000):
+            if not position % 100:
+                depth = self.book.depth(5)
+                for side, name, reverse in (('buy', 'bids', True), ('sell', 'asks', False)):
+                    prices = sorted(set(o[2] for o in naive.orders if o[1] == side), reverse=reverse)[:5]
+                    self.assertListEqual([level['price'] for level in depth[name]], prices)
+            if open_ids and rnd.random() < 0.3:
+                order_id = open_ids.pop(rnd.randrange(len(open_ids)))
+                self.assertEqual(self.book.cancel(order_id) is not None, naive.cancel(order_id))
+                continue
+            side = rnd.choice(['buy', 'sell'])
+            price = float(rnd.randint(90, 110))
+            quantity = rnd.randint(1, 20)
+            order, fills = self.add(side, price, quantity)
+            self.assertListEqual([(p, q) for p, q, _ in fills], naive.add(order.id, side, price, quantity))
+            if order.quantity:
+                open_ids.append(order.id)
+        self.assertEqual(len(self.book), len(naive.orders))
+        self.assertLessEqual(len(self.book._prices['buy']), 2 * len(self.book._levels['buy']) + 17)
+
+
+class TestMatchingEngine(unittest.TestCase):
+
+    def setUp(self):
+        Stock._instance = None
+        Trade._instance = None
+        MatchingEngine._instance = None
+        Stock.get_instance().add(StockRecord(symbol='SYM', price=10.0, type='common', par_value=1))
+        self.client = app.test_client()
+
+    def tearDown(self):
+        Stock._instance = None
+        Trade._instance = None
+        MatchingEngine._instance = None
+
+    def post(self, url, data):
+        response = self.client.post(url, data=json.dumps(data), content_type='application/json')
+        return response.status_code, json.loads(response.data)
+
+    def test__fills_are_traded(self):
+        engine = MatchingEngine.get_instance()
+        engine.submit('SYM', 'sell', 10.0, 1)
+        engine.submit('SYM', 'sell', 20.0, 3)
+        order, trades = engine.submit('SYM', 'buy', 25.0, 5)
+        self.assertEqual(len(trades), 2)
+        self.assertEqual(order.quantity, 1)
+        self.assertListEqual([tr.json() for tr in Trade.get_instance()], [tr.json() for tr in trades])
+        self.assertEqual(Trade.get_instance().get_vwsp('SYM'), 17.5)
+        self.assertAlmostEqual(Trade.get_instance().gbce_index, 17.5, delta=1e-9)
+
+    def test__orders_endpoints(self):
+        status, response = self.post('/orders', {'symbol': 'SYM', 'price': 10.0, 'quantity': 4, 'indicator': 'sell'})
+        self.assertEqual(status, 201)
+        self.assertEqual(response['order']['status'], 'open')
+        order_id = response['order']['id']
+        self.assertEqual(json.loads(self.client.get('/stocks/SYM/orders/%d' % order_id).data)['order']['quantity'], 4)
+
+        status, response = self.post('/orders', {'symbol': 'SYM', 'price': 11.0, 'quantity': 1, 'indicator': 'buy'})
+        self.assertEqual(response['order']['status'], 'filled')
+        self.assertListEqual([(tr['price'], tr['quantity']) for tr in response['trades']], [(10.0, 1)])
+        self.assertAlmostEqual(response['gbce_index'], 10.0, delta=1e-9)
+
+        response = json.loads(self.client.get('/stocks/SYM/book?levels=5').data)
+        self.assertListEqual(response['asks'], [{'price': 10.0, 'quantity': 3, 'orders': 1}])
+        self.assertListEqual(response['bids'], [])
+
+        response = self.client.delete('/stocks/SYM/orders/%d' % order_id)
+        self.assertEqual(json.loads(response.data)['order']['status'], 'cancelled')
+        self.assertEqual(self.client.delete('/stocks/SYM/orders/%d' % order_id).status_code, 404)
+        self.assertEqual(self.client.get('/stocks/SYM/orders/%d' % order_id).status_code, 404)
+
+        status, response = self.post('/orders', {'symbol': 'SYM', 'price': -1.0, 'quantity': 1, 'indicator': 'buy'})
+        self.assertEqual(status, 400)
+        self.assertEqual(self.post('/orders', {'symbol': 'NON', 'price': 1.0, 'quantity': 1,
+                                               'indicator': 'buy'})[0], 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+# coding=UTF-8
+
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from app import app
+from models import Stock, StockRecord, Trade, TradeStockRecord
+from replay import (HTTPTarget, load_stocks, load_trades, missing_stocks, ModelsTarget, replay, SetupError,
+                    synthetic_trades)
+
+
+__author__ = 'Konstantin Kolesnikov'
+
+
+class TestReplay(unittest.TestCase):
+
+    def setUp(self):
+        Stock._instance = None
+        Trade._instance = None
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        Stock._instance = None
+        Trade._instance = None
+
+    def write(self, name, data):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as f:
+            f.write(data)
+        return path
+
+    def test__load_trades(self):
+        records = [TradeStockRecord(timestamp=1002, symbol='SYM', price=11.0, quantity=2, indicator='sell'),
+                   TradeStockRecord(timestamp=1001, symbol='OTH', price=10.0, quantity=1, indicator='buy')]
+        expected = [{'symbol': 'OTH', 'price': 10.0, 'quantity': 1, 'indicator': 'buy', 'timestamp': 1001.0},
+                    {'symbol': 'SYM', 'price': 11.0, 'quantity': 2, 'indicator': 'sell', 'timestamp': 1002.0}]
+        items = [record.json() for record in records]
+        self.assertListEqual(load_trades(self.write('list.json', json.dumps(items))), expected)
+        self.assertListEqual(load_trades(self.write('response.json', json.dumps({'trades': items}))), expected)
+        self.assertListEqual(load_trades(self.write('trades.ndjson', '\n'.join(json.dumps(item) for item in items))),
+                             expected)
+        self.assertListEqual([stock['symbol'] for stock in missing_stocks(expected, [{'symbol': 'SYM'}])], ['OTH'])
+
+    def test__synthetic_trades(self):
+        symbols = ['AAA', 'BBB', 'CCC', 'DDD']
+        trades = synthetic_trades(symbols, 4000, rate=1000.0, seed=1)
+        self.assertListEqual(trades, synthetic_trades(symbols, 4000, rate=1000.0, seed=1))
+        counts = [sum(1 for trade in trades if trade['symbol'] == symbol) for symbol in symbols]
+        self.assertListEqual(counts, sorted(counts, reverse=True))
+        timestamps = [trade['timestamp'] for trade in trades]
+        self.assertListEqual(timestamps, sorted(timestamps))
+        self.assertAlmostEqual(timestamps[-1], 4.0, delta=0.5)
+
+    def test__replay_models(self):
+        trades = synthetic_trades(['AAA', 'BBB'], 200, rate=1000.0)
+        target = ModelsTarget()
+        target.setup(missing_stocks(trades))
+        results = replay(target, trades, speed=2.0)
+        self.assertEqual((results['trades'], results['errors']), (200, 0))
+        self.assertEqual(len(list(Trade.get_instance())), 200)
+        # Trades span 0.2 seconds, they are replayed twice faster
+        self.assertGreaterEqual(results['seconds'], trades[-1]['timestamp'] / 2.0)
+        self.assertLessEqual(results['latency']['p50'], results['latency']['max'])
+        self.assertIsNotNone(results['lag']['p99'])
+        self.assertIsNotNone(results['vwsp_staleness']['p50'])
+
+    def test__replay_event_time(self):
+        # Trades span 1000 seconds, they are replayed unpaced with the VWSP period sliding with them
+        trades = synthetic_trades(['AAA'], 1000, rate=1.0, seed=2)
+        target = ModelsTarget(event_time=True)
+        target.setup(missing_stocks(trades))
+        results = replay(target, trades, speed=0, batch=50)
+        self.assertEqual((results['trades'], results['errors']), (1000, 0))
+        trade = Trade.get_instance()
+        self.assertEqual(trade.clock.now(), int(round(trades[-1]['timestamp'] * 1e9)))
+        self.assertListEqual([tr.timestamp_ns for tr in trade], [int(round(tr['timestamp'] * 1e9)) for tr in trades])
+        window = [tr for tr in trades if tr['timestamp'] > trades[-1]['timestamp'] - 300]
+        self.assertAlmostEqual(trade.get_vwsp('AAA'), sum(tr['price'] * tr['quantity'] for tr in window) /
+                               sum(tr['quantity'] for tr in window), delta=1e-9)
+
+    def test__replay_app(self):
+        trades = synthetic_trades(['AAA', 'BBB'], 100, rate=1000.0)
+        trades.append(dict(trades[-1], symbol='NON'))
+        target = HTTPTarget()
+        target.setup(missing_stocks(trades[:-1]))
+        results = replay(target, trades, speed=0, batch=10)
+        self.assertEqual((results['trades'], results['errors']), (101, 1))
+        self.assertEqual(len(list(Trade.get_instance())), 100)
+        vwsp, index = target.read('AAA')
+        self.assertEqual(vwsp, Trade.get_instance().get_vwsp('AAA'))
+        self.assertAlmostEqual(index, Trade.get_instance().gbce_index, delta=1e-9)
+
+    def test__replay_stocks_dump(self):
+        Stock.get_instance().add(StockRecord(symbol='POP', price=100.0, type='preferred', last_dividend=8,
+                                             fixed_dividend=0.02, par_value=100))
+        Stock.get_instance().add(StockRecord(symbol='TEA', price=100.0, type='common', last_dividend=0,
+                                             par_value=100))
+        path = self.write('stocks.json', app.test_client().get('/stocks').data)
+        expected = sorted(dict(stock.json(), version=None, timestamp=None) for stock in Stock.get_instance())
+        stocks = load_stocks(path)
+        self.assertListEqual(sorted(stock['type'] for stock in stocks), ['common', 'preferred'])
+        trades = synthetic_trades(['POP', 'TEA'], 20, rate=1000.0)
+
+        for target in (ModelsTarget(), HTTPTarget()):
+            Stock._instance = None
+            Trade._instance = None
+            target.setup(stocks + missing_stocks(trades, stocks))
+            self.assertListEqual(sorted(dict(stock.json(), version=None, timestamp=None)
+                                        for stock in Stock.get_instance()), expected)
+            # Stocks registered already are kept
+            target.setup(stocks)
+            results = replay(target, trades, speed=0)
+            self.assertEqual((results['trades'], results['errors']), (20, 0))
+
+        self.assertRaises(SetupError, HTTPTarget().setup, [dict(stocks[0], symbol='NEW', type='Preferred')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+# coding=UTF-8
+
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from models import Trade, TradeStockRecord
+from retention import RetentionPolicy, TradeArchive
+
+
+__author__ = 'Konstantin Kolesnikov'
+
+
+class TestCompaction(unittest.TestCase):
+
+    def setUp(self):
+        Trade._instance = None
+        self.trade = Trade.get_instance()
+        self.now = int(time.time())
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'trades.log')
+
+    def tearDown(self):
+        Trade._instance = None
+        shutil.rmtree(self.directory)
+
+    def record(self, seconds_ago, price=10.0):
+        return self.trade._record(TradeStockRecord(timestamp=self.now - seconds_ago,
+                                                   symbol='SYM',
+                                                   price=price,
+                                                   quantity=1,
+                                                   indicator='sell'))
+
+    def test__compaction_drops_trades(self):
+        self.record(1000)
+        recent = self.record(10)
+
+        self.assertEqual(self.trade.compact(self.now - 600), 1)
+        self.assertListEqual(list(self.trade), [recent])
+        self.assertListEqual(list(self.trade.history()), [(1, recent)])
+        self.assertListEqual(self.trade.get_trades_for_symbol('SYM', time_range=60), [recent])
+
+    def test__compaction_keeps_vwsp(self):
+        self.record(1000, price=100.0)
+        self.record(20, price=10.0)
+        self.record(10, price=20.0)
+
+        self.trade.compact(self.now - 600)
+        self.assertEqual(self.trade.get_vwsp('SYM'), 15.0)
+
+    def test__compaction_keeps_order_state(self):
+        self.record(1000)
+        self.record(20)
+        late = self.record(30)
+        recent = self.record(10)
+        self.assertFalse(self.trade._ordered)
+
+        self.trade.compact(self.now - 600)
+        self.assertFalse(self.trade._ordered, 'Late trade is still kept')
+        self.assertListEqual([tr for _, tr in self.trade.history(since=self.now - 30, until=self.now - 25)], [late])
+
+        self.trade.compact(self.now - 20)
+        self.assertTrue(self.trade._ordered)
+        self.assertListEqual([tr for _, tr in self.trade.history(since=self.now - 15)], [recent])
+
+    def test__history_pages_through_archive(self):
+        self.trade.set_archive(TradeArchive(self.path))
+        TradeArchive.CHECKPOINT, checkpoint = 3, TradeArchive.CHECKPOINT
+        try:
+            trades = [self.record(1000 - i, price=float(i)) for i in range(10)]
+            trades.append(self.record(10, price=10.0))
+            self.assertEqual(self.trade.compact(self.now - 600), 10)
+
+            for cursor in range(12):
+                for limit in (None, 0, 1, 4, 20):
+                    expected = trades[cursor:None if limit is None else cursor + limit]
+                    history = list(self.trade.history(cursor=cursor, limit=limit))
+                    self.assertListEqual([tr.json() for _, tr in history], [tr.json() for tr in expected])
+                    self.assertListEqual([position for position, _ in history],
+                                         range(cursor, cursor + len(expected)))
+        finally:
+            TradeArchive.CHECKPOINT = checkpoint
+
+    def test__archive_is_reopened(self):
+        self.trade.set_archive(TradeArchive(self.path))
+        self.record(1000)
+        self.trade.compact(self.now - 600)
+
+        archive = TradeArchive(self.path)
+        self.assertEqual(len(archive), 1)
+        self.assertEqual(list(archive.read(0, 1))[0].indicator, 'Sell')
+
+    def test__retention_policy_hot_period(self):
+        self.assertEqual(RetentionPolicy(hot_period=1).hot_period, 5,
+                         'Trades should be kept in memory for at least VWSP period')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,12 @@
 # coding=UTF-8
 
 
+import random
 import unittest
 
 from werkzeug.datastructures import MultiDict
 
-from forms import StockRecordForm, TradeRecordForm
+from forms import StockRecordForm, TradeRecordForm, STOCK_RECORD_SCHEMA, TRADE_RECORD_SCHEMA
 from models import StockRecord, Stock
 
 
@@ -14,6 +15,10 @@ __author__ = 'Konstantin Kolesnikov'
 
 class TestStockRecordForm(unittest.TestCase):
 
+    def validate(self, data):
+        form = StockRecordForm(MultiDict(mapping=data))
+        return form.validate(), form.errors, form.data
+
     def test__empty_stock_record_creation(self):
         data = {}
         error = ['This field is required.']
@@ -24,11 +29,10 @@ class TestStockRecordForm(unittest.TestCase):
             'last_dividend': error,
             'type': error
         }
-        form = StockRecordForm(MultiDict(mapping=data))
-        validation = form.validate()
+        validation, errors, _ = self.validate(data)
 
         self.assertFalse(validation, 'Form is valid, but should be invalid')
-        self.assertDictEqual(form.errors, expected_errors,
+        self.assertDictEqual(errors, expected_errors,
                              'All fields are required.')
 
     def test__create_common_stock(self):
@@ -39,8 +43,7 @@ class TestStockRecordForm(unittest.TestCase):
             'last_dividend': 1,
             'type': 'common'
         }
-        form = StockRecordForm(MultiDict(mapping=data))
-        validation = form.validate()
+        validation, _, _ = self.validate(data)
 
         self.assertTrue(validation, 'Form is invalid, but all the required data is provided.')
 
@@ -56,11 +59,10 @@ class TestStockRecordForm(unittest.TestCase):
             'fixed_dividend': ['Fixed dividend should be defined for Preferred stock type']
         }
 
-        form = StockRecordForm(MultiDict(mapping=data))
-        validation = form.validate()
+        validation, errors, _ = self.validate(data)
 
         self.assertFalse(validation, 'Form is valid, but fixed dividend is not provided.')
-        self.assertDictEqual(form.errors, expected_error,
+        self.assertDictEqual(errors, expected_error,
                              'Fixed dividend is required for preferred stock')
 
     def test__create_preferred_stock_wit_fixed(self):
@@ -76,14 +78,21 @@ class TestStockRecordForm(unittest.TestCase):
             'fixed_dividend': ['Fixed dividend should be defined for Preferred stock type']
         }
 
-        form = StockRecordForm(MultiDict(mapping=data))
-        validation = form.validate()
+        validation, _, _ = self.validate(data)
 
         self.assertTrue(validation, 'Form is valid, but fixed dividend is not provided.')
 
 
 class TestTradeRecordForm(unittest.TestCase):
 
+    def validate(self, data):
+        form = TradeRecordForm(MultiDict(mapping=data))
+        return form.validate(), form.errors, form.data
+
+    def validate_stock(self, data):
+        form = StockRecordForm(MultiDict(mapping=data))
+        return form.validate(), form.errors, form.data
+
     def test__empty_trade_record_creation(self):
         data = {}
         error = ['This field is required.']
@@ -93,11 +102,10 @@ class TestTradeRecordForm(unittest.TestCase):
             'quantity': error,
             'indicator': error,
         }
-        form = TradeRecordForm(MultiDict(mapping=data))
-        validation = form.validate()
+        validation, errors, _ = self.validate(data)
 
         self.assertFalse(validation, 'Form is valid, but should be invalid')
-        self.assertDictEqual(form.errors, expected_errors,
+        self.assertDictEqual(errors, expected_errors,
                              'All fields are required.')
 
     def test__create_trade_record_for_non_existing_symbol(self):
@@ -112,11 +120,10 @@ class TestTradeRecordForm(unittest.TestCase):
             'quantity': 1
         }
 
-        form = TradeRecordForm(MultiDict(mapping=data))
-        validation = form.validate()
+        validation, errors, _ = self.validate(data)
 
         self.assertFalse(validation, 'It is impossible to trade not registered stocks')
-        self.assertDictEqual(form.errors, expected_error,
+        self.assertDictEqual(errors, expected_error,
                              'Can\'t trade non-registered stocks.')
 
     def test__create_trade_record_0_quantity(self):
@@ -137,20 +144,84 @@ class TestTradeRecordForm(unittest.TestCase):
             'quantity': 0
         }
 
-        stock_form = StockRecordForm(MultiDict(mapping=stock_data))
-        validation = stock_form.validate()
+        validation, _, stock_form_data = self.validate_stock(stock_data)
 
         self.assertTrue(validation, 'Stock is not registered')
 
-        Stock.get_instance().add(StockRecord(**stock_form.data))
+        Stock._instance = None
+        Stock.get_instance().add(StockRecord(**stock_form_data))
 
-        trade_form = TradeRecordForm(MultiDict(mapping=trade_data))
-        validation = trade_form.validate()
+        validation, errors, _ = self.validate(trade_data)
 
         self.assertFalse(validation, 'Can\'t trade 0 shares')
-        self.assertDictEqual(trade_form.errors, expected_error,
+        self.assertDictEqual(errors, expected_error,
                              'Should be greater than 0')
 
+    def test__create_trade_record_non_finite_numbers(self):
+        Stock._instance = None
+        Stock.get_instance().add(StockRecord(symbol='SYM', price=1.0, type='common', par_value=1))
+        for price, quantity in ((float('nan'), float('nan')), (float('inf'), float('inf')),
+                                (float('-inf'), float('-inf'))):
+            data = {'symbol': 'SYM', 'indicator': 'buy', 'price': price, 'quantity': quantity}
+
+            validation, errors, _ = self.validate(data)
+
+            self.assertFalse(validation, 'Non-finite numbers can\'t be traded')
+            self.assertListEqual(errors['price'], ['Number must be finite.'])
+            self.assertEqual(errors['quantity'][0], 'Not a valid integer value')
+
+        validation, errors, _ = self.validate({'symbol': 'SYM', 'indicator': 'buy', 'price': 1.0, 'quantity': 2 ** 63})
+        self.assertDictEqual(errors, {'quantity': ['Number must be between 1 and %s.' % (2 ** 63 - 1)]})
+
+
+class TestStockRecordSchema(TestStockRecordForm):
+
+    def validate(self, data):
+        data, errors = STOCK_RECORD_SCHEMA.validate(data)
+        return not errors, errors, data
+
+
+class TestTradeRecordSchema(TestTradeRecordForm):
+
+    def validate(self, data):
+        data, errors = TRADE_RECORD_SCHEMA.validate(data)
+        return not errors, errors, data
+
+    def validate_stock(self, data):
+        data, errors = STOCK_RECORD_SCHEMA.validate(data)
+        return not errors, errors, data
+
+    def test__stock_lookup_is_reused(self):
+        stock = StockRecord(symbol='NEW', price=1.0, type='common', par_value=1)
+        data = {'symbol': 'NEW', 'indicator': 'sell', 'price': 10.0, 'quantity': 2}
+
+        self.assertDictEqual(TRADE_RECORD_SCHEMA.validate(data, stock=stock)[1], {})
+        self.assertDictEqual(TRADE_RECORD_SCHEMA.validate_with_form(data, stock=stock)[1], {})
+        self.assertDictEqual(TRADE_RECORD_SCHEMA.validate(data, stock=None)[1],
+                             {'symbol': ['Stock symbol is not registered at the market.']})
+
+    def test__errors_match_form(self):
+        Stock._instance = None
+        Stock.get_instance().add(StockRecord(symbol='TEA', price=1.0, type='common', par_value=1))
+        values = [None, '', 0, 1, -1, 0.5, 1.5, 'abc', 'TEA', 'ab', 'abcdef', '12', '1.5', True, [], ['TEA', 'X'],
+                  'common', 'preferred', 'buy', 'sell', 'Buy', {'a': 1, 'b': 2, 'c': 3}, float('nan'), float('inf'),
+                  float('-inf'), 2 ** 63]
+        rnd = random.Random(20161009)
+
+        def outcome(validate, payload):
+            try:
+                return validate(payload)
+            except Exception as e:
+                # Both paths should fail the same way for the payloads WTForms can't process
+                return type(e)
+
+        for schema in (STOCK_RECORD_SCHEMA, TRADE_RECORD_SCHEMA):
+            names = [name for name, _, _ in schema.fields]
+            for _ in range(2000):
+                payload = dict((name, rnd.choice(values)) for name in names if rnd.random() < 0.8)
+                self.assertEqual(outcome(schema.validate, payload), outcome(schema.validate_with_form, payload),
+                                 payload)
+
 
 
 if __name__ == '__main__':
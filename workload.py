@@ -0,0 +1,34 @@
+# coding=UTF-8
+
+import math
+
+
+__author__ = 'Konstantin Kolesnikov'
+
+
+def symbol_name(position):
+    """
+    Return stock symbol of 4 letters, so markets of up to 456976 stocks pass the forms validation
+
+    :param position: Position of the stock in the market
+    :return: Stock symbol
+    """
+    letters = []
+    for _ in range(4):
+        position, letter = divmod(position, 26)
+        letters.append(chr(ord('A') + letter))
+    return ''.join(reversed(letters))
+
+
+def percentile(values, fraction):
+    """
+    Return nearest-rank percentile of the values
+
+    :param values: Measured values
+    :param fraction: Percentile as a fraction, e.g. 0.99
+    :return: Value or None if there are no values
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, int(math.ceil(fraction * len(ordered))) - 1)]